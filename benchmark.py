@@ -0,0 +1,328 @@
+"""Benchmarks for the StarGAN models.
+
+Every benchmark case runs in a fresh process so that the peak memory of one
+case does not leak into the next one.
+
+Usage:
+    python benchmark.py --task checkpointing --batch_size 16 --out_path checkpointing.json
+    python benchmark.py --task inference --model_save_dir stargan_celeba_1/models --test_iters 100000 \
+        --c_dim 3 --backends pytorch fused --batch_sizes 1 8 32 --thread_counts 1 4 --out_path inference.csv
+    python benchmark.py --task startup --repeats 10
+"""
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+from main import str2bool
+
+
+def get_device(cuda_device_name):
+    """Use the given cuda device if available, otherwise the CPU."""
+    import torch
+    if torch.cuda.is_available():
+        return torch.device(cuda_device_name if cuda_device_name else 'cuda')
+    return torch.device('cpu')
+
+
+def synchronize(device):
+    """Wait for the pending kernels so that the timings are correct."""
+    import torch
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def run_in_subprocess(func, *args):
+    """Run func(*args) in a fresh process and return its result."""
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes=1) as pool:
+        return pool.apply(func, args)
+
+
+def _run_checkpointing_case(args, checkpoint_bottleneck, checkpoint_downsample):
+    """Time the generator step of the training loop and measure its peak memory."""
+    import torch
+    import torch.nn.functional as F
+    from model import Discriminator, Generator
+    from profiling import peak_rss_mb
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    device = get_device(args.cuda_device_name)
+    torch.manual_seed(0)
+
+    G = Generator(args.g_conv_dim, args.c_dim, args.g_repeat_num,
+                  checkpoint_bottleneck=checkpoint_bottleneck,
+                  checkpoint_downsample=checkpoint_downsample).to(device)
+    D = Discriminator(args.image_size, args.d_conv_dim, args.c_dim, args.d_repeat_num).to(device)
+    g_optimizer = torch.optim.Adam(G.parameters(), 0.0001, [0.5, 0.999])
+
+    x_real = torch.randn(args.batch_size, 3, args.image_size, args.image_size, device=device)
+    c_org = torch.randint(0, 2, (args.batch_size, args.c_dim), device=device).float()
+    c_trg = c_org[torch.randperm(args.batch_size, device=device)]
+
+    def g_step():
+        # Same graph as Trainer._train_G_wasserstein
+        x_fake = G(x_real, c_trg)
+        out_src, out_cls = D(x_fake)
+        g_loss_fake = - torch.mean(out_src)
+        g_loss_cls = F.binary_cross_entropy_with_logits(out_cls, c_trg, reduction='sum') / out_cls.size(0)
+        x_reconst = G(x_fake, c_org)
+        g_loss_rec = torch.mean(torch.abs(x_real - x_reconst))
+        g_loss = g_loss_fake + 10 * g_loss_rec + g_loss_cls
+        g_optimizer.zero_grad()
+        g_loss.backward()
+        g_optimizer.step()
+
+    for _ in range(args.warmup):
+        g_step()
+    synchronize(device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+    step_times = []
+    for _ in range(args.repeats):
+        start_time = time.perf_counter()
+        g_step()
+        synchronize(device)
+        step_times.append(time.perf_counter() - start_time)
+
+    if device.type == 'cuda':
+        peak_memory = torch.cuda.max_memory_allocated(device) / 2**20
+    else:
+        peak_memory = peak_rss_mb()
+
+    return {
+        'checkpoint_bottleneck': checkpoint_bottleneck,
+        'checkpoint_downsample': checkpoint_downsample,
+        'device': str(device),
+        'batch_size': args.batch_size,
+        'peak_memory_mb': peak_memory,
+        'step_time_s': sum(step_times) / len(step_times)
+    }
+
+
+def benchmark_checkpointing(args):
+    """Report the peak-memory vs. step-time tradeoff of activation checkpointing in G.
+
+    Returns:
+        results(list<dict>): One entry per checkpointing configuration
+    """
+    cases = [(False, False), (True, False), (True, True)]
+    results = []
+    for checkpoint_bottleneck, checkpoint_downsample in cases:
+        print("Running G step with checkpoint_bottleneck={}, checkpoint_downsample={}..."
+              .format(checkpoint_bottleneck, checkpoint_downsample))
+        results.append(run_in_subprocess(_run_checkpointing_case, args,
+                                         checkpoint_bottleneck, checkpoint_downsample))
+
+    baseline = results[0]
+    print("{:<12} {:<12} {:>14} {:>10} {:>14} {:>10}".format(
+        'bottleneck', 'downsample', 'peak mem (MB)', 'mem diff', 'step time (s)', 'time diff'))
+    for result in results:
+        result['memory_change'] = result['peak_memory_mb'] / baseline['peak_memory_mb'] - 1
+        result['time_change'] = result['step_time_s'] / baseline['step_time_s'] - 1
+        print("{:<12} {:<12} {:>14.1f} {:>+10.1%} {:>14.4f} {:>+10.1%}".format(
+            str(result['checkpoint_bottleneck']), str(result['checkpoint_downsample']),
+            result['peak_memory_mb'], result['memory_change'],
+            result['step_time_s'], result['time_change']))
+
+    return results
+
+
+def build_inference_model(args, backend, num_threads, device):
+    """Build the generator run by the backend, from a checkpoint or freshly initialized."""
+    import torch
+    from inference import instance_stats_copy, load_generator
+    from model import Generator
+
+    if backend == 'int8':
+        return torch.jit.load(args.int8_path)
+
+    if args.model_save_dir:
+        G = load_generator(args.model_save_dir, args.test_iters, args.g_conv_dim, args.c_dim, args.g_repeat_num)
+    else:
+        G = Generator(args.g_conv_dim, args.c_dim, args.g_repeat_num)
+
+    if backend == 'fused':
+        G = G.to(device)
+        from fusion import optimize_for_inference
+        return optimize_for_inference(G, script=args.script_fused)
+    elif backend == 'onnx':
+        import tempfile
+        from onnx_export import OnnxGenerator, export_generator
+        onnx_path = os.path.join(tempfile.mkdtemp(), 'G.onnx')
+        export_generator(G, onnx_path, args.c_dim)
+        return OnnxGenerator(onnx_path, num_threads)
+    return instance_stats_copy(G).to(device)
+
+
+def _run_inference_case(args, backend, batch_size, num_threads, image_size):
+    """Measure the latency, throughput and peak memory of a generator forward."""
+    import numpy as np
+    import torch
+    from profiling import peak_rss_mb
+
+    torch.set_num_threads(num_threads)
+    device = get_device(args.cuda_device_name) if backend in ['pytorch', 'fused'] else torch.device('cpu')
+    G = build_inference_model(args, backend, num_threads, device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+    x = torch.rand(batch_size, 3, image_size, image_size, device=device) * 2 - 1
+    c = torch.randint(0, 2, (batch_size, args.c_dim), device=device).float()
+
+    latencies = []
+    with torch.no_grad():
+        for _ in range(args.warmup):
+            G(x, c)
+        synchronize(device)
+        for _ in range(args.repeats):
+            start_time = time.perf_counter()
+            G(x, c)
+            synchronize(device)
+            latencies.append(time.perf_counter() - start_time)
+
+    latencies = np.array(latencies)
+    if device.type == 'cuda':
+        peak_memory = torch.cuda.max_memory_allocated(device) / 2**20
+    else:
+        peak_memory = peak_rss_mb()
+
+    return {
+        'backend': backend,
+        'device': str(device),
+        'batch_size': batch_size,
+        'num_threads': num_threads,
+        'image_size': image_size,
+        'latency_p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'latency_p95_ms': float(np.percentile(latencies, 95) * 1000),
+        'latency_p99_ms': float(np.percentile(latencies, 99) * 1000),
+        'images_per_s': float(batch_size / latencies.mean()),
+        'peak_memory_mb': peak_memory
+    }
+
+
+def benchmark_inference(args):
+    """Sweep the backends, batch sizes, thread counts and image sizes of generator inference.
+
+    Returns:
+        results(list<dict>): One entry per configuration
+    """
+    assert 'int8' not in args.backends or args.int8_path, "The int8 backend needs --int8_path"
+
+    cases = itertools.product(args.backends, map(int, args.batch_sizes),
+                              map(int, args.thread_counts), map(int, args.image_sizes))
+    print("{:<8} {:>6} {:>8} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        'backend', 'batch', 'threads', 'size', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'images/s', 'mem (MB)'))
+
+    results = []
+    for backend, batch_size, num_threads, image_size in cases:
+        result = run_in_subprocess(_run_inference_case, args, backend, batch_size, num_threads, image_size)
+        print("{:<8} {:>6} {:>8} {:>6} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.1f} {:>10.1f}".format(
+            backend, batch_size, num_threads, image_size, result['latency_p50_ms'],
+            result['latency_p95_ms'], result['latency_p99_ms'], result['images_per_s'],
+            result['peak_memory_mb']))
+        results.append(result)
+
+    return results
+
+
+def benchmark_startup(args):
+    """Time the command lines which must return without importing the heavy frameworks,
+    and the imports of a training run for comparison.
+
+    Returns:
+        results(list<dict>): One entry per command
+    """
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    commands = [
+        ('python', [sys.executable, '-c', 'pass']),
+        ('main.py --help', [sys.executable, 'main.py', '--help']),
+        ('main.py invalid config', [sys.executable, 'main.py', '--use_sw_loss', 'True', '--use_max_sw_loss', 'True']),
+        ('import trainer', [sys.executable, '-c', 'import trainer'])
+    ]
+
+    print("{:<24} {:>12} {:>12}".format('command', 'median (s)', 'min (s)'))
+    results = []
+    for name, command in commands:
+        times = []
+        for _ in range(args.warmup + args.repeats):
+            start_time = time.perf_counter()
+            subprocess.run(command, cwd=repo_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start_time)
+        times = sorted(times[args.warmup:])
+        result = {'command': name, 'median_s': times[len(times) // 2], 'min_s': times[0]}
+        print("{:<24} {:>12.3f} {:>12.3f}".format(name, result['median_s'], result['min_s']))
+        results.append(result)
+
+    return results
+
+
+def save_results(results, out_path):
+    """Save the results as csv if the path ends with .csv, otherwise as json."""
+    if out_path.endswith('.csv'):
+        with open(out_path, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=list(results[0].keys()))
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(out_path, 'w') as file:
+            json.dump(results, file, indent=2)
+    print('Results saved as', out_path)
+
+
+def main(args):
+    tasks = {
+        'checkpointing': benchmark_checkpointing,
+        'inference': benchmark_inference,
+        'startup': benchmark_startup
+    }
+    results = tasks[args.task](args)
+
+    if args.out_path:
+        save_results(results, args.out_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark')
+
+    parser.add_argument('--task', type=str, default='checkpointing', choices=['checkpointing', 'inference', 'startup'])
+
+    # Model configuration.
+    parser.add_argument('--c_dim', type=int, default=5)
+    parser.add_argument('--image_size', type=int, default=128)
+    parser.add_argument('--g_conv_dim', type=int, default=64)
+    parser.add_argument('--d_conv_dim', type=int, default=64)
+    parser.add_argument('--g_repeat_num', type=int, default=6)
+    parser.add_argument('--d_repeat_num', type=int, default=6)
+    parser.add_argument('--model_save_dir', type=str, default=None,
+                        help='load the generator from this dir; if not set, use a freshly initialized one')
+    parser.add_argument('--test_iters', type=int, default=100000, help='load the generator from this step')
+
+    # Benchmark configuration.
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--warmup', type=int, default=2, help='number of untimed steps')
+    parser.add_argument('--repeats', type=int, default=10, help='number of timed steps')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch threads, 0 to keep the default')
+    parser.add_argument('--cuda_device_name', type=str, default='cuda:0')
+    parser.add_argument('--out_path', type=str, default=None, help='save the results as json, or csv if it ends with .csv')
+
+    # Inference sweep configuration.
+    parser.add_argument('--backends', nargs='+', default=['pytorch'], choices=['pytorch', 'fused', 'onnx', 'int8'])
+    parser.add_argument('--batch_sizes', nargs='+', default=[1, 16])
+    parser.add_argument('--thread_counts', nargs='+', default=[1, 4])
+    parser.add_argument('--image_sizes', nargs='+', default=[128])
+    parser.add_argument('--script_fused', type=str2bool, default=False,
+                        help='freeze the fused backend with TorchScript')
+    parser.add_argument('--int8_path', type=str, default=None, help='TorchScript model saved by quantize.py')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
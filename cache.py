@@ -0,0 +1,136 @@
+import collections
+import hashlib
+import os
+import threading
+
+import torch
+
+
+def file_hash(path, chunk_size=2**20):
+    """SHA-256 of a file, e.g. a checkpoint."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def tensor_hash(x):
+    """SHA-256 of the values and shape of a tensor."""
+    x = x.detach().cpu().contiguous()
+    sha = hashlib.sha256(str(tuple(x.shape)).encode('utf-8'))
+    sha.update(x.numpy().tobytes())
+    return sha.hexdigest()
+
+
+class TranslationCache(object):
+    """On-disk, content-addressed cache of translated images with LRU eviction.
+
+    Entries are keyed by make_key(...), usually with the checkpoint hash, the input
+    image hash, the target label and the preprocessing config. When the cache grows
+    beyond max_size_mb, the least recently used entries are deleted. The access
+    time of an entry is its file mtime, so the LRU order survives restarts.
+    """
+
+    def __init__(self, cache_dir, max_size_mb=1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_size_mb * 2**20
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        # Entries in LRU order: key => size in bytes.
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._scan()
+
+    @staticmethod
+    def make_key(*parts):
+        """Build a key from strings or tensors."""
+        sha = hashlib.sha256()
+        for part in parts:
+            if torch.is_tensor(part):
+                part = tensor_hash(part)
+            sha.update(str(part).encode('utf-8'))
+            sha.update(b'\0')
+        return sha.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.pt')
+
+    def _scan(self):
+        """Load the existing entries, oldest first."""
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith('.pt'):
+                    stat = os.stat(os.path.join(root, name))
+                    files.append((stat.st_mtime, name[:-len('.pt')], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+
+    def get(self, key):
+        """Return the cached tensor, or None on a miss."""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+
+        path = self._path(key)
+        try:
+            os.utime(path, None)
+            return torch.load(path)
+        except (OSError, RuntimeError, EOFError):
+            # Evicted in the meantime, possibly by another process.
+            with self.lock:
+                self.hits -= 1
+                self.misses += 1
+                if key in self.entries:
+                    self.total_bytes -= self.entries.pop(key)
+            return None
+
+    def put(self, key, x):
+        """Store a tensor, then evict the least recently used entries beyond the size limit."""
+        path = self._path(key)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so readers never see a partial entry. The name is
+        # unique across the threads and processes sharing the cache.
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        torch.save(x.detach().cpu().clone(), tmp_path)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+
+        with self.lock:
+            self.total_bytes += size - self.entries.get(key, 0)
+            self.entries[key] = size
+            self.entries.move_to_end(key)
+            evicted = []
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                old_key, old_size = self.entries.popitem(last=False)
+                self.total_bytes -= old_size
+                evicted.append(old_key)
+
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def stats(self):
+        """Hit/miss counters and the size of the cache."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'entries': len(self.entries),
+                'size_mb': self.total_bytes / 2**20
+            }
@@ -0,0 +1,325 @@
+import contextlib
+import json
+import os
+import random
+import re
+import threading
+
+import numpy as np
+import torch
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: the index is only locked within the process.
+    fcntl = None
+
+
+def snapshot(obj):
+    """Copy the tensors of a (nested) state dict to the CPU, so that training can keep
+    updating the originals while the copy is being serialized."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def get_rng_state():
+    """States of all the random number generators used in training."""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state()
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state, restore_torch=True):
+    """Restore the states saved by get_rng_state().
+
+    Args:
+        state(dict): States returned by get_rng_state()
+        restore_torch(bool): Also restore the torch and cuda generators
+    """
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    if restore_torch:
+        torch.set_rng_state(state['torch'])
+        if 'cuda' in state and torch.cuda.is_available() and len(state['cuda']) == torch.cuda.device_count():
+            torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def load_checkpoint(path, weights_only=True):
+    """Load a checkpoint on the CPU, memory-mapping its tensor data when supported.
+
+    With mmap, the tensors are read lazily from the page cache instead of being
+    copied into memory up front, so processes loading the same file share its pages.
+    Older torch versions and checkpoints not saved in the zip format fall back to
+    a regular load.
+
+    Args:
+        path(str): Path of the checkpoint
+        weights_only(bool): Only unpickle tensors and containers; the training state
+            holds RNG states and must be loaded with weights_only=False
+    """
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=weights_only)
+    except TypeError:
+        # mmap and weights_only need torch >= 2.1
+        return torch.load(path, map_location=lambda storage, loc: storage)
+    except RuntimeError:
+        # Legacy, non-zip format, which cannot be memory-mapped
+        return torch.load(path, map_location=lambda storage, loc: storage, weights_only=weights_only)
+
+
+def load_weights(model, state_dict, assign=False):
+    """Load a state dict into a model.
+
+    With assign=True, the model takes the loaded tensors themselves instead of copying
+    them into its own, which keeps memory-mapped weights zero-copy. This is only done
+    when the dtypes match (e.g. not for float16 checkpoints) and is meant for freshly
+    built CPU models: the parameters are replaced, so optimizers built before would
+    not see them.
+    """
+    if assign:
+        own_state = model.state_dict()
+        assign = all(key in state_dict and state_dict[key].dtype == value.dtype
+                     for key, value in own_state.items())
+    if assign:
+        try:
+            return model.load_state_dict(state_dict, assign=True)
+        except TypeError:
+            # assign needs torch >= 2.1
+            pass
+    return model.load_state_dict(state_dict)
+
+
+def half_precision(state_dict):
+    """Cast the floating point tensors of a state dict to float16."""
+    return type(state_dict)((key, value.half() if torch.is_tensor(value) and value.is_floating_point() else value)
+                            for key, value in state_dict.items())
+
+
+def atomic_save(obj, path):
+    """torch.save to a temporary file which is synced and then renamed, so that a crash
+    never leaves a partial checkpoint at path."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        torch.save(obj, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    sync_dir(os.path.dirname(path))
+
+
+def sync_dir(dir_path):
+    """Make a rename in the directory durable. Not supported on Windows."""
+    try:
+        fd = os.open(dir_path or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class CheckpointManager(object):
+    """Store of the checkpoints of a run in model_save_dir.
+
+    Each checkpoint is a generator file '{step}-G.ckpt', used for testing, and a
+    training state file '{step}-state.ckpt', used for resuming. Files are written
+    atomically. After each save, only the last keep_last checkpoints, those whose step
+    is a multiple of keep_every and the best one are kept (keep_last=0 keeps them all).
+
+    The index file 'checkpoints.json' lists the checkpoints with their optional score,
+    and the latest and best (lowest score) steps. Directories written before the index
+    existed are indexed on first use. Several processes can share the index, e.g. a
+    training run and an evaluation scoring its checkpoints: each update re-reads the
+    index under a lock file and rewrites it atomically, so no update is lost.
+    """
+
+    INDEX_NAME = 'checkpoints.json'
+    LOCK_NAME = 'checkpoints.lock'
+
+    def __init__(self, model_save_dir, keep_last=0, keep_every=0, half_precision_G=False):
+        self.model_save_dir = model_save_dir
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.half_precision_G = half_precision_G
+        self.lock = threading.Lock()
+
+    def G_path(self, step):
+        return os.path.join(self.model_save_dir, '{}-G.ckpt'.format(step))
+
+    def D_path(self, step):
+        """Discriminator of runs saved before the training state existed."""
+        return os.path.join(self.model_save_dir, '{}-D.ckpt'.format(step))
+
+    def state_path(self, step):
+        return os.path.join(self.model_save_dir, '{}-state.ckpt'.format(step))
+
+    def _index_path(self):
+        return os.path.join(self.model_save_dir, self.INDEX_NAME)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the index lock of this process and, where supported, of all the processes."""
+        with self.lock:
+            if fcntl is None or not os.path.isdir(self.model_save_dir):
+                yield
+                return
+            with open(os.path.join(self.model_save_dir, self.LOCK_NAME), 'a') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _load_index(self):
+        """Read the index from disk. Call with the lock held."""
+        if os.path.exists(self._index_path()):
+            with open(self._index_path()) as file:
+                return json.load(file)
+
+        # Index the checkpoints of older runs.
+        steps = set()
+        if os.path.isdir(self.model_save_dir):
+            for name in os.listdir(self.model_save_dir):
+                match = re.match(r'^(\d+)-(G|D|state)\.ckpt$', name)
+                if match:
+                    steps.add(int(match.group(1)))
+        index = {'checkpoints': [{'step': step, 'score': None} for step in sorted(steps)]}
+        self._update_pointers(index)
+        return index
+
+    @staticmethod
+    def _update_pointers(index):
+        checkpoints = index['checkpoints']
+        index['latest'] = checkpoints[-1]['step'] if checkpoints else None
+        scored = [ckpt for ckpt in checkpoints if ckpt['score'] is not None]
+        index['best'] = min(scored, key=lambda ckpt: ckpt['score'])['step'] if scored else None
+
+    def _write_index(self, index):
+        tmp_path = '{}.{}.tmp'.format(self._index_path(), os.getpid())
+        with open(tmp_path, 'w') as file:
+            json.dump(index, file, indent=2)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self._index_path())
+
+    def latest_step(self):
+        """Step of the latest checkpoint, or None."""
+        with self._locked():
+            return self._load_index()['latest']
+
+    def best_step(self):
+        """Step of the checkpoint with the lowest score, or None."""
+        with self._locked():
+            return self._load_index()['best']
+
+    def steps(self):
+        """Steps of the indexed checkpoints, in increasing order."""
+        with self._locked():
+            return [ckpt['step'] for ckpt in self._load_index()['checkpoints']]
+
+    def resolve_step(self, step):
+        """Map step -1 to the latest checkpoint."""
+        if step == -1:
+            step = self.latest_step()
+            assert step is not None, "No checkpoint found in {}".format(self.model_save_dir)
+        return step
+
+    def set_score(self, step, score):
+        """Record the evaluation score of a saved checkpoint, which may make it the best one."""
+        with self._locked():
+            index = self._load_index()
+            for ckpt in index['checkpoints']:
+                if ckpt['step'] == step:
+                    ckpt['score'] = score
+            self._update_pointers(index)
+            self._write_index(index)
+
+    def save(self, step, G_state, state, score=None):
+        """Atomically write the checkpoint of a step, update the index and delete the
+        checkpoints which are not kept anymore.
+
+        Args:
+            step(int): Number of iterations done
+            G_state(dict): State dict of the generator, saved in float16 if half_precision_G
+            state(dict): Full training state
+            score(float): Optional evaluation score of the checkpoint, lower is better
+        """
+        if self.half_precision_G:
+            G_state = half_precision(G_state)
+        atomic_save(G_state, self.G_path(step))
+        atomic_save(state, self.state_path(step))
+
+        with self._locked():
+            index = self._load_index()
+            checkpoints = [ckpt for ckpt in index['checkpoints'] if ckpt['step'] != step]
+            checkpoints.append({'step': step, 'score': score})
+            checkpoints.sort(key=lambda ckpt: ckpt['step'])
+            index['checkpoints'] = checkpoints
+            self._update_pointers(index)
+
+            removed = []
+            if self.keep_last > 0:
+                recent = set(ckpt['step'] for ckpt in checkpoints[-self.keep_last:])
+                kept = []
+                for ckpt in checkpoints:
+                    if (ckpt['step'] in recent or ckpt['step'] == index['best'] or
+                            (self.keep_every > 0 and ckpt['step'] % self.keep_every == 0)):
+                        kept.append(ckpt)
+                    else:
+                        removed.append(ckpt['step'])
+                index['checkpoints'] = kept
+
+            # The index never points to deleted files.
+            self._write_index(index)
+
+        for old_step in removed:
+            for path in [self.G_path(old_step), self.D_path(old_step), self.state_path(old_step)]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+class AsyncCheckpointSaver(object):
+    """Serialize checkpoints on a background thread.
+
+    save() takes a function writing objects already snapshotted to the CPU and returns
+    right away. At most one save is in flight: a new save() first waits for the previous
+    one. An error raised while saving is re-raised by the next call to save() or wait().
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def save(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in the background."""
+        self.wait()
+        self.thread = threading.Thread(target=self._run, args=(func, args, kwargs), daemon=True)
+        self.thread.start()
+
+    def wait(self):
+        """Wait for the pending save to finish."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def _run(self, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            self.error = e
@@ -4,7 +4,9 @@ from torchvision.datasets import ImageFolder
 from PIL import Image
 import torch
 import os
+import queue
 import random
+import threading
 
 
 class CelebA(data.Dataset):
@@ -78,25 +80,211 @@ class CelebA(data.Dataset):
         return self.num_images
 
 
-def get_loader(image_dir, attr_path, selected_attrs, crop_size=178, image_size=128, 
-               batch_size=16, dataset='CelebA', mode='train', num_workers=1):
-    """Build and return a data loader."""
+class RandomFlip(data.Dataset):
+    """Flip the images of a dataset horizontally at random, with a flip which only depends
+    on (seed, epoch, index), so that it does not depend on which loader worker (or thread)
+    loads the image and is reproduced when resuming."""
+
+    def __init__(self, dataset, seed=0):
+        self.dataset = dataset
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __getitem__(self, index):
+        image, label = self.dataset[index]
+        generator = torch.Generator()
+        generator.manual_seed(((self.seed * 1000003 + self.epoch) * len(self.dataset) + index) % 2**63)
+        if torch.rand(1, generator=generator).item() < 0.5:
+            image = image.flip(-1)
+        return image, label
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class ResumableSampler(data.DistributedSampler):
+    """Shuffling sampler whose order only depends on (seed, epoch), so that training can be
+    resumed in the middle of an epoch with set_epoch() and set_start_index().
+
+    With num_replicas > 1, each rank gets its own shard of the data. set_epoch() also
+    sets the epoch of the random flips of the dataset (see RandomFlip).
+    """
+
+    def __init__(self, dataset, num_replicas=1, rank=0, shuffle=True, seed=0):
+        super(ResumableSampler, self).__init__(dataset, num_replicas=num_replicas, rank=rank,
+                                               shuffle=shuffle, seed=seed)
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        super(ResumableSampler, self).set_epoch(epoch)
+        if isinstance(self.dataset, RandomFlip):
+            self.dataset.set_epoch(epoch)
+
+    def set_start_index(self, start_index):
+        """Skip the first start_index samples of the next pass."""
+        self.start_index = start_index
+
+    def __iter__(self):
+        indices = list(super(ResumableSampler, self).__iter__())[self.start_index:]
+        self.start_index = 0
+        return iter(indices)
+
+
+class AlternatingLoader(object):
+    """Alternate the batches of several training loaders, each prefetched by its own thread.
+
+    Each loader is iterated by a background thread, which keeps up to prefetch batches in
+    a queue and starts the next epoch when the loader is exhausted, so the loaders load
+    concurrently. next() returns the batches of the loaders in turn. When the loader
+    whose turn it is has no batch ready, a ready batch of another loader is returned
+    instead, as long as that loader is less than max_lag batches ahead, so the training
+    loop does not stall on the slower loader. max_lag=0 alternates strictly, which keeps
+    the ranks of distributed training in step.
+
+    positions holds the (epoch, batch index) of the last batch returned from each
+    loader, from which start() resumes.
+
+    The epochs are iterated with epoch_iter() and the images flipped by RandomFlip, so
+    the threads never draw from the global generator, also with num_workers=0, and the
+    data do not depend on the timing of the threads nor change when resuming.
+    """
+
+    def __init__(self, loaders, prefetch=2, max_lag=2, positions=None):
+        """
+        Args:
+            loaders(OrderedDict): Key = dataset name, val = data loader with a ResumableSampler
+            prefetch(int): Max number of batches prefetched per loader
+            max_lag(int): Max number of batches a loader can get ahead of the others
+            positions(dict): Positions to resume from, as saved from self.positions
+        """
+        self.loaders = loaders
+        self.names = list(loaders.keys())
+        self.max_lag = max_lag
+        self.positions = dict(positions) if positions else {name: (0, 0) for name in self.names}
+        self.consumed = {name: 0 for name in self.names}
+        self.queues = {name: queue.Queue(max(prefetch, 1)) for name in self.names}
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def start(self):
+        """Start prefetching from the saved positions."""
+        for name in self.names:
+            loader = self.loaders[name]
+            epoch, batch_index = self.positions[name]
+            data_iter = epoch_iter(loader, epoch, batch_index * loader.batch_size)
+            thread = threading.Thread(target=self._prefetch, args=(name, data_iter, epoch, batch_index),
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _prefetch(self, name, data_iter, epoch, batch_index):
+        loader = self.loaders[name]
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    batch = next(data_iter)
+                except StopIteration:
+                    epoch, batch_index = epoch + 1, 0
+                    data_iter = epoch_iter(loader, epoch)
+                    continue
+                batch_index += 1
+                self._put(name, (epoch, batch_index, batch))
+        except Exception as e:
+            # Raised by next() in the training loop.
+            self._put(name, e)
+
+    def _put(self, name, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queues[name].put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def next(self):
+        """Return the name of the dataset and the next batch."""
+        # The loader with the fewest batches returned so far has the turn.
+        name = min(self.names, key=lambda name: self.consumed[name])
+        if self.queues[name].empty():
+            for other in self.names:
+                if (other != name and not self.queues[other].empty() and
+                        self.consumed[other] - self.consumed[name] < self.max_lag):
+                    name = other
+                    break
+
+        item = self.queues[name].get()
+        if isinstance(item, Exception):
+            raise item
+        epoch, batch_index, batch = item
+        self.positions[name] = (epoch, batch_index)
+        self.consumed[name] += 1
+        return name, batch
+
+    def close(self):
+        """Stop the prefetching threads."""
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout=1)
+        self.threads = []
+
+
+def epoch_iter(loader, epoch, start_index=0):
+    """Iterator over an epoch of a training loader, starting at the start_index-th sample.
+
+    The loader's own generator, which the worker seeds are drawn from, is reseeded from
+    (seed, epoch), so creating the iterator does not draw from the global generator and
+    a resumed epoch loads the same data as an uninterrupted one.
+    """
+    loader.sampler.set_epoch(epoch)
+    loader.sampler.set_start_index(start_index)
+    loader.generator.manual_seed(loader.sampler.seed * 1000003 + epoch)
+    return iter(loader)
+
+
+def build_transform(crop_size=178, image_size=128):
+    """Build the transform mapping a PIL image to a normalized tensor in [-1, 1].
+    A crop_size of 0 skips the center crop. The training images are flipped by RandomFlip."""
     transform = []
-    if mode == 'train':
-        transform.append(T.RandomHorizontalFlip())
-    transform.append(T.CenterCrop(crop_size))
+    if crop_size:
+        transform.append(T.CenterCrop(crop_size))
     transform.append(T.Resize(image_size))
     transform.append(T.ToTensor())
     transform.append(T.Normalize(mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5)))
-    transform = T.Compose(transform)
+    return T.Compose(transform)
+
+
+def get_loader(image_dir, attr_path, selected_attrs, crop_size=178, image_size=128, 
+               batch_size=16, dataset='CelebA', mode='train', num_workers=1,
+               num_replicas=1, rank=0, seed=0):
+    """Build and return a data loader.
+
+    The training data is shuffled by a ResumableSampler and randomly flipped by RandomFlip,
+    and is iterated with epoch_iter(). If num_replicas > 1, it is split into num_replicas
+    shards and the loader only yields the shard of the given rank.
+    """
+    transform = build_transform(crop_size, image_size)
 
     if dataset == 'CelebA':
         dataset = CelebA(image_dir, attr_path, selected_attrs, transform, mode)
     elif dataset == 'RaFD':
         dataset = ImageFolder(image_dir, transform)
 
+    sampler = None
+    generator = None
+    if mode == 'train':
+        dataset = RandomFlip(dataset, seed)
+        sampler = ResumableSampler(dataset, num_replicas=num_replicas, rank=rank,
+                                   shuffle=True, seed=seed)
+        generator = torch.Generator()
+
     data_loader = data.DataLoader(dataset=dataset,
                                   batch_size=batch_size,
-                                  shuffle=(mode=='train'),
-                                  num_workers=num_workers)
+                                  shuffle=(mode=='train' and sampler is None),
+                                  sampler=sampler,
+                                  num_workers=num_workers,
+                                  generator=generator,
+                                  pin_memory=torch.cuda.is_available())
     return data_loader
\ No newline at end of file
@@ -0,0 +1,90 @@
+"""Helpers for multi-process data-parallel training with torch.distributed.
+
+Every process (rank) holds a full copy of G and D and trains on its own shard of
+the data. The gradients are averaged across the ranks before each optimizer step,
+so all the replicas stay identical.
+"""
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def init_distributed(rank, world_size, backend='gloo', init_method='tcp://127.0.0.1:23456'):
+    """Join the process group of the current training job."""
+    dist.init_process_group(backend=backend, init_method=init_method,
+                            rank=rank, world_size=world_size)
+
+
+def cleanup_distributed():
+    """Leave the process group if the current process has joined one."""
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def broadcast_model(model, src=0):
+    """Copy the parameters and buffers of the model on rank src to all the other ranks."""
+    for tensor in model.state_dict().values():
+        dist.broadcast(tensor, src)
+
+
+def average_gradients(model):
+    """Average the gradients of the model across all ranks.
+
+    The gradients are flattened into a single buffer so that a step needs only one
+    all-reduce call.
+    """
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    if not grads:
+        return
+
+    flat_grads = _flatten_dense_tensors(grads)
+    dist.all_reduce(flat_grads)
+    flat_grads /= get_world_size()
+    for grad, synced in zip(grads, _unflatten_dense_tensors(flat_grads, grads)):
+        grad.copy_(synced)
+
+
+class _AllGather(torch.autograd.Function):
+    """All-gather that passes the gradients back to the rank owning each slice."""
+
+    @staticmethod
+    def forward(ctx, tensor):
+        ctx.batch_size = tensor.size(0)
+        gathered = [torch.zeros_like(tensor) for _ in range(get_world_size())]
+        dist.all_gather(gathered, tensor.contiguous())
+        return torch.cat(gathered, dim=0)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        # Every rank computes the same loss on the global batch, so the gradients of
+        # all ranks are summed. Together with average_gradients this yields the
+        # gradient of the global loss.
+        grad_output = grad_output.contiguous()
+        dist.all_reduce(grad_output)
+        start = get_rank() * ctx.batch_size
+        return grad_output[start:start + ctx.batch_size]
+
+
+def all_gather_with_grad(tensor):
+    """Concatenate the tensors of all ranks along dim 0, keeping the autograd graph.
+
+    Args:
+        tensor(tensor): Local samples, shape (N, ...). N must be the same on all ranks.
+    Returns:
+        Global samples, shape (world_size * N, ...)
+    """
+    if not is_distributed() or get_world_size() == 1:
+        return tensor
+    return _AllGather.apply(tensor)
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from checkpoint import atomic_save, load_checkpoint
+
+PATCH_SIZE = 7
+# Bumped when the layout of the cached real set statistics changes.
+CACHE_VERSION = 2
+
+
+class ImageDescriptor(object):
+    """Map images to the vectors the SWD is computed on.
+
+    The descriptors do not depend on the checkpoint, so the statistics of the real set
+    can be reused for all the checkpoints of an experiment.
+    - 'pixel': the image average-pooled to size x size, flattened
+    - 'patch': patches_per_image 7x7 patches at fixed random positions (the same for
+      all images), which compares the local textures rather than whole images
+    """
+
+    def __init__(self, features='pixel', size=64, patches_per_image=16, image_size=128, seed=0):
+        self.features = features
+        self.size = size
+        self.patches_per_image = patches_per_image
+        if features == 'patch':
+            rng = np.random.RandomState(seed)
+            self.positions = rng.randint(0, image_size - PATCH_SIZE + 1, size=(patches_per_image, 2))
+            self.num_features = 3 * PATCH_SIZE * PATCH_SIZE
+        else:
+            self.num_features = 3 * size * size
+
+    def __call__(self, x):
+        """Return the descriptors of images of shape (N, C, H, W), in shape (M, num_features)."""
+        if self.features == 'patch':
+            patches = [x[:, :, i:i+PATCH_SIZE, j:j+PATCH_SIZE] for i, j in self.positions]
+            return torch.stack(patches, dim=1).reshape(-1, self.num_features)
+        if x.size(-1) != self.size:
+            x = F.adaptive_avg_pool2d(x, self.size)
+        return x.reshape(x.size(0), -1)
+
+
+class ProjectedSets(object):
+    """Random projections of the descriptors of several sets of images (e.g. one per
+    domain), accumulated batch by batch.
+
+    The SWD between two sets only needs their projections sorted along each direction,
+    so the descriptors themselves are not kept.
+    """
+
+    def __init__(self, descriptor, projections):
+        self.descriptor = descriptor
+        self.projections = projections
+        self.chunks = {}
+
+    def add(self, x, masks):
+        """Project images and add them to the sets they belong to.
+
+        Args:
+            x(tensor): Images, shape (N, C, H, W)
+            masks(dict): Key = set name, val = bool tensor of shape (N,) selecting the
+                images of the set
+        """
+        projected = torch.matmul(self.descriptor(x), self.projections)
+        # Descriptors of the same image are contiguous.
+        projected = projected.view(x.size(0), -1, projected.size(-1))
+        for name, mask in masks.items():
+            if mask.any():
+                self.chunks.setdefault(name, []).append(projected[mask].reshape(-1, projected.size(-1)).cpu())
+
+    def sorted(self):
+        """Key = set name, val = sorted projections, shape (num_samples, num_projections)."""
+        return {name: torch.sort(torch.cat(chunks, dim=0), dim=0)[0] for name, chunks in self.chunks.items()}
+
+
+def quantiles(sorted_values, num):
+    """Linearly interpolated quantiles at num evenly spaced levels of values sorted along dim 0."""
+    if sorted_values.size(0) == num:
+        return sorted_values
+    positions = torch.linspace(0, sorted_values.size(0) - 1, num)
+    low = positions.floor().long()
+    high = positions.ceil().long()
+    weight = (positions - low.float()).unsqueeze(1)
+    return sorted_values[low] * (1 - weight) + sorted_values[high] * weight
+
+
+def sliced_wasserstein_sorted(sorted_real, sorted_fake):
+    """SWD between two sets given by their sorted projections, with the same normalization
+    as swd.sliced_wasserstein_distance(). Sets of different sizes are compared on the
+    quantiles of the larger one."""
+    num = max(sorted_real.size(0), sorted_fake.size(0))
+    return torch.pow(quantiles(sorted_real, num) - quantiles(sorted_fake, num), 2).mean().item()
+
+
+class RealSetCache(object):
+    """Projection directions and sorted projections of the real test images of each domain,
+    cached on disk.
+
+    The file name hashes the options which the real set and the descriptors depend on,
+    so the cache is shared by all the checkpoints of an experiment (and by experiments
+    evaluated with the same options and cache dir) and rebuilt when they change.
+    """
+
+    def __init__(self, cache_dir, descriptor, num_projections, seed, *data_options):
+        self.cache_dir = cache_dir
+        self.descriptor = descriptor
+        self.num_projections = num_projections
+        self.seed = seed
+        key = json.dumps([CACHE_VERSION, descriptor.features, descriptor.size, descriptor.patches_per_image,
+                          num_projections, seed] + [str(option) for option in data_options])
+        self.path = os.path.join(cache_dir, 'real-{}.pt'.format(hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]))
+
+    def load(self):
+        """Return (projections, dict of the sorted real projections of each domain), or None
+        if not cached."""
+        if not os.path.exists(self.path):
+            return None
+        stats = load_checkpoint(self.path)
+        return stats['projections'], stats['sorted_real']
+
+    def new_projections(self):
+        """Random unit directions, shape (num_features, num_projections)."""
+        rng = np.random.RandomState(self.seed)
+        projections = rng.normal(size=(self.descriptor.num_features, self.num_projections)).astype(np.float32)
+        return F.normalize(torch.from_numpy(projections), p=2, dim=0)
+
+    def save(self, projections, sorted_real):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        atomic_save({'projections': projections.cpu(), 'sorted_real': sorted_real}, self.path)
+
+
+def load_results(results_path):
+    if not os.path.exists(results_path):
+        return {}
+    with open(results_path) as file:
+        return json.load(file)
+
+
+def save_results(results, results_path):
+    tmp_path = results_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, results_path)
@@ -0,0 +1,147 @@
+"""Optimize a trained generator for inference by folding the InstanceNorm layers
+into the preceding convolutions.
+
+In eval mode, an InstanceNorm2d layer with track_running_stats=True normalizes
+with its running stats, i.e. it applies a fixed per-channel affine transform that
+can be folded into the weights and bias of the convolution before it. The fused
+generator computes the same outputs as G.eval() with one kernel less per layer.
+
+Note that Trainer.test() runs G in train mode, where InstanceNorm normalizes each
+image with its own statistics. That transform depends on the input and cannot be
+folded, so the fused generator matches G.eval(), not the outputs of the default
+test backend.
+
+Usage:
+    python fusion.py --model_save_dir stargan_celeba_1/models --test_iters 100000 --c_dim 3
+"""
+import argparse
+import copy
+
+import torch
+import torch.nn as nn
+
+from inference import load_generator
+from model import ResidualBlock
+
+
+def fold_instance_norm(conv, norm):
+    """Return a copy of conv with the eval-mode transform of norm folded in."""
+    if not (norm.affine and norm.track_running_stats):
+        raise ValueError("Only InstanceNorm layers with affine=True and track_running_stats=True can be folded")
+
+    with torch.no_grad():
+        scale = norm.weight / torch.sqrt(norm.running_var + norm.eps)
+        shift = norm.bias - norm.running_mean * scale
+
+        fused = copy.deepcopy(conv)
+        # The output channels are dim 0 of Conv2d weights but dim 1 of ConvTranspose2d weights.
+        if isinstance(conv, nn.ConvTranspose2d):
+            weight = conv.weight * scale.view(1, -1, 1, 1)
+        else:
+            weight = conv.weight * scale.view(-1, 1, 1, 1)
+        bias = shift if conv.bias is None else conv.bias * scale + shift
+
+        fused.weight = nn.Parameter(weight)
+        fused.bias = nn.Parameter(bias)
+    return fused
+
+
+def fuse_layers(layers):
+    """Fold every (conv, InstanceNorm) pair of the layers and fuse the residual blocks."""
+    fused_layers = []
+    i = 0
+    while i < len(layers):
+        layer = layers[i]
+        next_layer = layers[i + 1] if i + 1 < len(layers) else None
+
+        if isinstance(layer, (nn.Conv2d, nn.ConvTranspose2d)) and isinstance(next_layer, nn.InstanceNorm2d):
+            fused_layers.append(fold_instance_norm(layer, next_layer))
+            i += 2
+        elif isinstance(layer, ResidualBlock):
+            fused_layers.append(FusedResidualBlock(fuse_layers(list(layer.main))))
+            i += 1
+        else:
+            fused_layers.append(copy.deepcopy(layer))
+            i += 1
+    return fused_layers
+
+
+class FusedResidualBlock(nn.Module):
+    """Residual block with the InstanceNorm layers folded into the convolutions."""
+    def __init__(self, layers):
+        super(FusedResidualBlock, self).__init__()
+        self.main = nn.Sequential(*layers)
+
+    def forward(self, x):
+        return x + self.main(x)
+
+
+class FusedGenerator(nn.Module):
+    """Generator with the InstanceNorm layers folded into the convolutions."""
+    def __init__(self, layers):
+        super(FusedGenerator, self).__init__()
+        self.main = nn.Sequential(*layers)
+
+    def forward(self, x, c):
+        # Replicate spatially and concatenate domain information.
+        c = c.view(c.size(0), c.size(1), 1, 1)
+        c = c.expand(-1, -1, x.size(2), x.size(3))
+        x = torch.cat([x, c], dim=1)
+        return self.main(x)
+
+
+def optimize_for_inference(G, script=False):
+    """Return an eval-mode generator with the InstanceNorm layers folded into the convolutions.
+
+    Args:
+        G(Generator): Trained generator
+        script(bool): Also freeze the model with TorchScript, which fuses the
+            conv + ReLU (+ residual add) patterns where the backend supports it (e.g. oneDNN)
+    Returns:
+        Fused generator, giving the same outputs as G.eval()
+    """
+    fused = FusedGenerator(fuse_layers(list(G.main))).eval()
+    if script:
+        fused = torch.jit.optimize_for_inference(torch.jit.script(fused))
+    return fused
+
+
+def count_layers(model):
+    """Count the leaf modules, i.e. the kernels launched per forward (excluding the residual adds)."""
+    return sum(1 for module in model.modules() if len(list(module.children())) == 0)
+
+
+def main(args):
+    G = load_generator(args.model_save_dir, args.test_iters, args.g_conv_dim, args.c_dim, args.g_repeat_num)
+    G.eval()
+    fused = optimize_for_inference(G)
+    print("Layers per forward: {} => {}".format(count_layers(G), count_layers(fused)))
+
+    x = torch.rand(args.batch_size, 3, args.image_size, args.image_size) * 2 - 1
+    c = torch.randint(0, 2, (args.batch_size, args.c_dim)).float()
+    with torch.no_grad():
+        diff = (G(x, c) - fused(x, c)).abs().max().item()
+    print("Max abs diff vs. G.eval(): {:.2e}".format(diff))
+
+    if args.fused_path:
+        torch.jit.save(optimize_for_inference(G, script=True), args.fused_path)
+        print('Saved the fused generator into {}...'.format(args.fused_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fusion')
+
+    # Model configuration.
+    parser.add_argument('--c_dim', type=int, default=5)
+    parser.add_argument('--g_conv_dim', type=int, default=64)
+    parser.add_argument('--g_repeat_num', type=int, default=6)
+    parser.add_argument('--image_size', type=int, default=128)
+    parser.add_argument('--model_save_dir', type=str, default='stargan/models')
+    parser.add_argument('--test_iters', type=int, default=100000, help='fuse the model from this step')
+    parser.add_argument('--batch_size', type=int, default=4, help='batch size of the parity check')
+    parser.add_argument('--fused_path', type=str, default=None, help='save the fused model as TorchScript')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
@@ -0,0 +1,79 @@
+import atexit
+import queue
+import threading
+
+from torchvision.utils import save_image
+
+
+class ImageWriter(object):
+    """Encode and write images on background threads, off the training/testing loop.
+
+    submit() blocks while max_pending images are waiting (backpressure). An error
+    raised by a worker is re-raised by the next call to submit(), flush() or close().
+    The pending images are flushed at exit. With num_workers=0 the images are written
+    synchronously by submit().
+    """
+
+    def __init__(self, num_workers=2, max_pending=16):
+        self.num_workers = num_workers
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.error_lock = threading.Lock()
+        self.closed = False
+
+        self.workers = []
+        for _ in range(num_workers):
+            worker = threading.Thread(target=self._run, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        atexit.register(self.close)
+
+    def submit(self, tensor, path, **kwargs):
+        """Write the tensor as an image with torchvision's save_image(tensor, path, **kwargs).
+
+        The writer takes over the tensor: device tensors are copied to the CPU here, CPU
+        tensors are written as they are and must not be modified by the caller afterwards.
+        """
+        self._raise_error()
+        if self.num_workers == 0:
+            save_image(tensor, path, **kwargs)
+            return
+        self.queue.put((tensor.detach().cpu(), path, kwargs))
+
+    def flush(self):
+        """Wait until all the submitted images are written."""
+        if self.num_workers > 0:
+            self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Flush the pending images and stop the workers."""
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self._raise_error()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                tensor, path, kwargs = item
+                save_image(tensor, path, **kwargs)
+            except Exception as e:
+                with self.error_lock:
+                    if self.error is None:
+                        self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        with self.error_lock:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
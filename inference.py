@@ -0,0 +1,170 @@
+import copy
+import os
+
+import torch
+import torch.nn as nn
+
+from checkpoint import load_checkpoint, load_weights
+from model import Generator
+
+
+def load_generator(model_save_dir, iters, g_conv_dim=64, c_dim=5, g_repeat_num=6, device='cpu'):
+    """Build a generator and load the weights of the {iters}-G.ckpt checkpoint.
+
+    The checkpoint is memory-mapped and, on the CPU, the generator uses the mapped
+    weights without copying them, so worker processes loading the same checkpoint
+    share its pages.
+
+    Like in Trainer.test(), the generator is left in train mode, i.e. InstanceNorm uses
+    the statistics of each image. Call G.eval() to use the running stats instead.
+    """
+    G = Generator(g_conv_dim, c_dim, g_repeat_num)
+    G_path = os.path.join(model_save_dir, '{}-G.ckpt'.format(iters))
+    load_weights(G, load_checkpoint(G_path), assign=True)
+    return G.to(device)
+
+
+def instance_stats_copy(G, inplace=False):
+    """Return an eval-mode copy of G whose InstanceNorm layers use the statistics of each image.
+
+    This computes the same outputs as G in train mode, which is how Trainer.test() runs
+    the generator, but it does not update the running stats. Exported or optimized
+    models are built from this copy. With inplace=True, G itself is converted, which
+    keeps the weights memory-mapped by load_generator() shared.
+    """
+    if not inplace:
+        G = copy.deepcopy(G)
+    for module in G.modules():
+        if isinstance(module, nn.InstanceNorm2d):
+            module.track_running_stats = False
+            module.running_mean = None
+            module.running_var = None
+            module.num_batches_tracked = None
+    return G.eval()
+
+
+HAIR_COLORS = ['Black_Hair', 'Blond_Hair', 'Brown_Hair', 'Gray_Hair']
+
+
+def create_celeba_labels(c_org, selected_attrs):
+    """Generate the target labels of each CelebA attribute: a hair color is set and the
+    other hair colors cleared, since they are exclusive, and any other attribute is reversed.
+
+    Args:
+        c_org(tensor): Original labels, shape (N, c_dim)
+        selected_attrs(list<str>): Names of the attributes of the labels
+    Returns:
+        c_trg_list(list<tensor>): Target labels, each item's shape = (N, c_dim)
+    """
+    hair_color_indices = [i for i, attr_name in enumerate(selected_attrs) if attr_name in HAIR_COLORS]
+
+    c_trg_list = []
+    for i in range(c_org.size(1)):
+        c_trg = c_org.clone()
+        if i in hair_color_indices:  # Set one hair color to 1 and the rest to 0.
+            c_trg[:, i] = 1
+            for j in hair_color_indices:
+                if j != i:
+                    c_trg[:, j] = 0
+        else:
+            c_trg[:, i] = (c_trg[:, i] == 0)  # Reverse attribute value.
+        c_trg_list.append(c_trg)
+    return c_trg_list
+
+
+def generate(G, x, c, max_batch_size=0):
+    """Run G on the (image, label) pairs in chunks of at most max_batch_size pairs.
+
+    Args:
+        x(tensor): Real images, shape (N, C, H, W)
+        c(tensor): Target labels, shape (N, c_dim)
+    Returns:
+        Translated images, shape (N, C, H, W)
+    """
+    if max_batch_size <= 0 or x.size(0) <= max_batch_size:
+        return G(x, c)
+    return torch.cat([
+        G(x_chunk, c_chunk) for x_chunk, c_chunk in
+        zip(x.split(max_batch_size), c.split(max_batch_size))
+    ], dim=0)
+
+
+def classify(D, x, max_batch_size=0):
+    """Domain classification logits of D for the images, in chunks of at most
+    max_batch_size images.
+
+    Args:
+        x(tensor): Images, shape (N, C, H, W)
+    Returns:
+        Logits, shape (N, c_dim)
+    """
+    if max_batch_size <= 0 or x.size(0) <= max_batch_size:
+        return D(x)[1].view(x.size(0), -1)
+    return torch.cat([D(x_chunk)[1].view(x_chunk.size(0), -1) for x_chunk in x.split(max_batch_size)], dim=0)
+
+
+def translate(G, x, c_trg_list, max_batch_size=0):
+    """Translate the images into every target domain with batched generator forwards.
+
+    The target domains are stacked into a single batch of N * len(c_trg_list) images,
+    which is run through G in chunks of at most max_batch_size images.
+
+    Args:
+        G(nn.Module): Generator
+        x(tensor): Real images, shape (N, C, H, W)
+        c_trg_list(list<tensor>): Target labels, each item's shape = (N, c_dim)
+        max_batch_size(int): Max number of images per forward, 0 for no limit
+    Returns:
+        x_fake_list(list<tensor>): Translated images, each item's shape = (N, C, H, W)
+    """
+    num_samples = x.size(0)
+    num_targets = len(c_trg_list)
+
+    # Layout [x for c_trg_1, x for c_trg_2, ...] so the output splits back per target.
+    x_all = x.repeat(num_targets, 1, 1, 1)
+    c_all = torch.cat(c_trg_list, dim=0)
+    x_fake = generate(G, x_all, c_all, max_batch_size)
+    return list(x_fake.split(num_samples, dim=0))
+
+
+def cached_translate(G, x, c_trg_list, cache, key_prefix, max_batch_size=0):
+    """Same as translate(), but look up every (image, target) pair in the cache first.
+
+    Only the missing pairs are run through G, in a single batched pass, and then stored.
+    The images and labels are copied to the host once to be hashed, and the translations
+    once to be stored.
+
+    Args:
+        cache(TranslationCache): Cache of the translated images
+        key_prefix(str): Identifies the checkpoint, backend and preprocessing config
+    Returns:
+        x_fake_list(list<tensor>): Translated images, each item's shape = (N, C, H, W)
+    """
+    from cache import tensor_hash
+
+    num_samples = x.size(0)
+    x_host = x.detach().cpu()
+    c_host = torch.stack(c_trg_list).cpu()
+    image_hashes = [tensor_hash(x_host[j]) for j in range(num_samples)]
+
+    outputs, keys, missing = {}, {}, []
+    for t in range(len(c_trg_list)):
+        for j in range(num_samples):
+            key = cache.make_key(key_prefix, image_hashes[j], c_host[t, j])
+            cached = cache.get(key)
+            if cached is None:
+                keys[(t, j)] = key
+                missing.append((t, j))
+            else:
+                outputs[(t, j)] = cached.to(x.device)
+
+    if missing:
+        x_missing = torch.stack([x[j] for _, j in missing])
+        c_missing = torch.stack([c_trg_list[t][j] for t, j in missing])
+        x_fake = generate(G, x_missing, c_missing, max_batch_size)
+        for (t, j), x_out, x_out_host in zip(missing, x_fake, x_fake.detach().cpu()):
+            cache.put(keys[(t, j)], x_out_host)
+            outputs[(t, j)] = x_out
+
+    return [torch.stack([outputs[(t, j)] for j in range(num_samples)])
+            for t in range(len(c_trg_list))]
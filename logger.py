@@ -1,45 +1,177 @@
-import tensorflow as tf
+import atexit
 import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+
+def _make_crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _make_crc32c_table()
+
+
+def crc32c(data):
+    """CRC-32C (Castagnoli) checksum of bytes."""
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc = _CRC32C_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def masked_crc32c(data):
+    """Masked CRC-32C used by the TFRecord format."""
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def tfrecord(data):
+    """Frame bytes as a TFRecord: length, length CRC, data, data CRC."""
+    header = struct.pack('<Q', len(data))
+    return (header + struct.pack('<I', masked_crc32c(header)) +
+            data + struct.pack('<I', masked_crc32c(data)))
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        bits = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+def _length_delimited(field, data):
+    return _varint(field << 3 | 2) + _varint(len(data)) + data
+
+
+def encode_event(wall_time, step=None, file_version=None, summary=None):
+    """Encode a tensorflow.Event protobuf message.
+
+    Args:
+        wall_time(float): Timestamp in seconds
+        step(int): Global step
+        file_version(str): Set in the first event of a file
+        summary(bytes): Encoded Summary message
+    """
+    out = _varint(1 << 3 | 1) + struct.pack('<d', wall_time)
+    if step is not None:
+        out += _varint(2 << 3 | 0) + _varint(step & 0xFFFFFFFFFFFFFFFF)
+    if file_version is not None:
+        out += _length_delimited(3, file_version.encode('utf-8'))
+    if summary is not None:
+        out += _length_delimited(5, summary)
+    return out
+
+
+def encode_scalar_summary(tag, value):
+    """Encode a tensorflow.Summary message holding one simple_value."""
+    summary_value = _length_delimited(1, tag.encode('utf-8')) + _varint(2 << 3 | 5) + struct.pack('<f', value)
+    return _length_delimited(1, summary_value)
+
 
 class Logger(object):
-    """Tensorboard logger."""
+    """Tensorboard logger.
 
-    def __init__(self, log_dir):
+    Writes TensorBoard event files directly, without TensorFlow. The records are
+    buffered and written by a background thread every flush_secs seconds, or as soon as
+    max_queue records are pending. The pending records are flushed at exit.
+    """
+
+    def __init__(self, log_dir, max_queue=100, flush_secs=10):
         """Initialize summary writer."""
-        self.writer = tf.summary.FileWriter(log_dir)
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        filename = 'events.out.tfevents.{:010d}.{}'.format(int(time.time()), socket.gethostname())
+        self.event_path = os.path.join(log_dir, filename)
+        self.file = open(self.event_path, 'ab')
+        self.max_queue = max_queue
+        self.flush_secs = flush_secs
+
+        self.records = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.closed = False
+
+        self.records.append(tfrecord(encode_event(time.time(), step=0, file_version='brain.Event:2')))
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
 
     def scalar_summary(self, tag, value, step):
         """Add scalar summary."""
-        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value)])
-        self.writer.add_summary(summary, step)
+        event = encode_event(time.time(), step=step, summary=encode_scalar_summary(tag, float(value)))
+        with self.lock:
+            self.records.append(tfrecord(event))
+            if len(self.records) >= self.max_queue:
+                self.wakeup.notify()
+
+    def flush(self):
+        """Write the pending records to disk."""
+        with self.lock:
+            records, self.records = self.records, []
+        if records:
+            self.file.write(b''.join(records))
+            self.file.flush()
+
+    def close(self):
+        """Flush the pending records and close the file."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.wakeup.notify()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.closed and len(self.records) < self.max_queue:
+                    self.wakeup.wait(self.flush_secs)
+                if self.closed:
+                    return
+            self.flush()
 
 
 class EventLogger:
-    def __init__(self, name, out_path):
+    def __init__(self, name, out_path, level=logging.INFO):
         """Event logger to print the event to console and save it to file.
         
         Args:
             name: name of the logger
-            out_path: complete path to save the file
+            out_path: complete path to save the file, None to log to console only
+            level: messages below this level are dropped
         """
         # Create a custom logger
         self.logger = logging.getLogger(name)
-        self.logger.setLevel(logging.INFO)
-
-        # Create handlers
-        file_hdl = logging.FileHandler(out_path)
-        console_hdl = logging.StreamHandler()
+        self.logger.setLevel(level)
 
         # Create formatters and add it to handlers
         formatter = logging.Formatter(
             '[%(asctime)s] %(message)s', datefmt='%d-%b-%y %H:%M:%S'
         )
-        file_hdl.setFormatter(formatter)
+        console_hdl = logging.StreamHandler()
         console_hdl.setFormatter(formatter)
-
-        # Add handlers to the logger
-        self.logger.addHandler(file_hdl)
         self.logger.addHandler(console_hdl)
+
+        if out_path is not None:
+            file_hdl = logging.FileHandler(out_path)
+            file_hdl.setFormatter(formatter)
+            self.logger.addHandler(file_hdl)
     
     def log(self, message):
         """Log the message (str)"""
@@ -1,20 +1,14 @@
 import argparse
 import os
 
-from click.decorators import password_option
-from torch.backends import cudnn
-
-from data_loader import get_loader
-from trainer import Trainer
+# torch and the trainer are only imported once the config is validated and the
+# directories are set up, so that --help and invalid configs return right away.
 
 
 def str2bool(v):
     return v.lower() in ('true')
 
 def main(config):
-    # For fast training.
-    cudnn.benchmark = True
-
     # Create directories if not exist.
     if not os.path.exists(config.log_dir):
         os.makedirs(config.log_dir)
@@ -35,14 +29,57 @@ def main(config):
         for arg in config_dict:
             file.write("{}: {}\n".format(arg, config_dict[arg]))
 
+    # Launched by torchrun (possibly on several nodes): one process per rank.
+    if 'RANK' in os.environ:
+        config.world_size = int(os.environ['WORLD_SIZE'])
+        config.dist_init_method = 'env://'
+        run(int(os.environ['RANK']), config)
+    # Launch all the ranks as local processes.
+    elif config.world_size > 1:
+        import torch.multiprocessing
+        torch.multiprocessing.spawn(run, args=(config,), nprocs=config.world_size)
+    else:
+        run(0, config)
+
+
+def run(rank, config):
+    """Train or test StarGAN as the given rank."""
+    import torch
+    from torch.backends import cudnn
+
+    from data_loader import get_loader
+    from distributed import cleanup_distributed, init_distributed
+    from trainer import Trainer
+
+    # For fast training.
+    cudnn.benchmark = True
+
+    config.rank = rank
+    if config.world_size > 1:
+        init_distributed(rank, config.world_size, config.dist_backend, config.dist_init_method)
+
+    # Share the CPU cores among the local processes.
+    num_threads = config.num_threads
+    if num_threads == 0 and config.world_size > 1:
+        num_threads = max(1, os.cpu_count() // config.world_size)
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+
     # Data loader.
     celeba_loader = None
     rafd_loader = None
-    assert config.dataset == 'CelebA', print("{} dataset is not supported".format(config.dataset))
 
-    celeba_loader = get_loader(config.celeba_image_dir, config.attr_path, config.selected_attrs,
-                                config.celeba_crop_size, config.image_size, config.batch_size,
-                                'CelebA', config.mode, config.num_workers)
+    if config.dataset in ['CelebA', 'Both']:
+        celeba_loader = get_loader(config.celeba_image_dir, config.attr_path, config.selected_attrs,
+                                    config.celeba_crop_size, config.image_size, config.batch_size,
+                                    'CelebA', config.mode, config.num_workers,
+                                    num_replicas=config.world_size, rank=rank, seed=config.seed)
+    # Joint models are tested on the CelebA images only.
+    if config.dataset == 'RaFD' or (config.dataset == 'Both' and config.mode == 'train'):
+        rafd_loader = get_loader(config.rafd_image_dir, None, None,
+                                 config.rafd_crop_size, config.image_size, config.batch_size,
+                                 'RaFD', config.mode, config.num_workers,
+                                 num_replicas=config.world_size, rank=rank, seed=config.seed)
 
     # Trainer for training and testing StarGAN.
     trainer = Trainer(celeba_loader, rafd_loader, config)
@@ -50,13 +87,30 @@ def main(config):
     # Ensure test iter is no greater than train iters
     config.test_iters = min(config.test_iters, config.num_iters)
 
-    if config.mode == 'train':
-        trainer.train()
+    report = None
+    if config.mode == 'train' and config.dry_run_steps > 0:
+        report = trainer.dry_run(config.dry_run_steps)
+    elif config.mode == 'train':
+        if config.dataset in ['CelebA', 'RaFD']:
+            trainer.train()
+        elif config.dataset in ['Both']:
+            trainer.train_multi()
     elif config.mode == 'test':
-        trainer.test()
+        if config.dataset in ['CelebA', 'RaFD']:
+            trainer.test()
+        elif config.dataset in ['Both']:
+            trainer.test_multi()
+    elif config.mode == 'eval':
+        trainer.evaluate()
     else:
         pass
 
+    cleanup_distributed()
+
+    # Let launchers tell configs which do not fit apart from failed runs.
+    if report is not None and not report.get('fits', True):
+        raise SystemExit(3)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -74,6 +128,10 @@ if __name__ == '__main__':
     parser.add_argument('--lambda_cls', type=float, default=1, help='weight for domain classification loss')
     parser.add_argument('--lambda_rec', type=float, default=10, help='weight for reconstruction loss')
     parser.add_argument('--lambda_gp', type=float, default=10, help='weight for gradient penalty')
+    parser.add_argument('--g_checkpoint_bottleneck', type=str2bool, default=False,
+                        help='recompute the residual blocks of G in the backward pass to save memory')
+    parser.add_argument('--g_checkpoint_downsample', type=str2bool, default=False,
+                        help='recompute the down-sampling layers of G in the backward pass to save memory')
     
     # Training configuration.
     parser.add_argument('--dataset', type=str, default='CelebA', choices=['CelebA', 'RaFD', 'Both'])
@@ -85,9 +143,14 @@ if __name__ == '__main__':
     parser.add_argument('--n_critic', type=int, default=5, help='number of D updates per each G update')
     parser.add_argument('--beta1', type=float, default=0.5, help='beta1 for Adam optimizer')
     parser.add_argument('--beta2', type=float, default=0.999, help='beta2 for Adam optimizer')
-    parser.add_argument('--resume_iters', type=int, default=None, help='resume training from this step')
+    parser.add_argument('--resume_iters', type=int, default=None, help='resume training from this step, -1 for the latest')
     parser.add_argument('--selected_attrs', '--list', nargs='+', help='selected attributes for the CelebA dataset',
                         default=['Black_Hair', 'Blond_Hair', 'Brown_Hair', 'Male', 'Young'])
+    parser.add_argument('--multi_prefetch', type=int, default=2,
+                        help='batches prefetched per dataset when training on both datasets')
+    parser.add_argument('--multi_max_lag', type=int, default=2,
+                        help='max batches a dataset can get ahead of the other when its loader is slower; '
+                             '0 to alternate strictly')
 
     # Training configuration for sliced wasserstein loss.
     parser.add_argument("--d_criterion", default='BCE', const='BCE', nargs='?', choices=['BCE', 'WGAN-GP'],
@@ -103,17 +166,56 @@ if __name__ == '__main__':
                         help='sort scalar output [w^T*h] when computing the max swd; if false, sort vector output [h]') 
 
     # Test configuration.
-    parser.add_argument('--test_iters', type=int, default=100000, help='test model from this step')
+    parser.add_argument('--test_iters', type=int, default=100000, help='test model from this step, -1 for the latest')
     parser.add_argument('--test_type', default='general', const='general', nargs='?', choices=['general', 'small'], 
                         help='type of the test to perform')
     parser.add_argument('--test_img_numbers', nargs='+', default=[10, 165],
                         help='the No. of the selected images for small test')
+    parser.add_argument('--test_max_batch_size', type=int, default=128,
+                        help='max number of images per generator forward when translating '
+                             'into all target domains; 0 for no limit')
+    parser.add_argument('--result_cache_dir', type=str, default=None,
+                        help='cache the translated test images in this dir and reuse them across runs')
+    parser.add_argument('--result_cache_size_mb', type=int, default=2048,
+                        help='max size of the result cache; least recently used entries are evicted')
+    parser.add_argument('--test_backend', type=str, default='pytorch', choices=['pytorch', 'onnx', 'fused'],
+                        help='run the generator with PyTorch, with ONNX Runtime on the CPU, or with the '
+                             'InstanceNorm layers folded into the convolutions (eval-mode semantics)')
+
+    # Evaluation configuration.
+    parser.add_argument('--eval_iters', type=int, nargs='+', default=None,
+                        help='checkpoints to evaluate, -1 for the latest; defaults to all the checkpoints')
+    parser.add_argument('--eval_features', type=str, default='pixel', choices=['pixel', 'patch'],
+                        help='compute the swd on downsampled images or on 7x7 patches')
+    parser.add_argument('--eval_swd_size', type=int, default=64, help='image size for the pixel swd')
+    parser.add_argument('--eval_patches_per_image', type=int, default=16, help='patches per image for the patch swd')
+    parser.add_argument('--eval_num_projections', type=int, default=512, help='num of projections of the swd')
+    parser.add_argument('--eval_num_images', type=int, default=0, help='evaluate on the first N test images, 0 for all')
+    parser.add_argument('--eval_cache_dir', type=str, default=None,
+                        help='dir caching the real set statistics, defaults to result_dir/eval_cache')
 
     # Miscellaneous.
     parser.add_argument('--num_workers', type=int, default=1)
-    parser.add_argument('--mode', type=str, default='train', choices=['train', 'test'])
+    parser.add_argument('--mode', type=str, default='train', choices=['train', 'test', 'eval'])
     parser.add_argument('--use_tensorboard', type=str2bool, default=True)
     parser.add_argument('--cuda_device_name', type=str, default='cuda:0', choices=['cuda:0', 'cuda:1', 'cuda:2'])
+    parser.add_argument('--num_image_writers', type=int, default=2,
+                        help='threads encoding and writing the images; 0 to write them synchronously')
+    parser.add_argument('--max_pending_images', type=int, default=16,
+                        help='max queued images before saving blocks the loop')
+    parser.add_argument('--save_individual_images', type=str2bool, default=False,
+                        help='also save each real and translated image on its own')
+    parser.add_argument('--num_threads', type=int, default=0,
+                        help='torch threads per process; 0 keeps the default, or splits the cores among the ranks')
+    parser.add_argument('--seed', type=int, default=1234,
+                        help='seed of the data order; in distributed training, rank r also seeds its generators with seed + r')
+
+    # Distributed training configuration.
+    parser.add_argument('--world_size', type=int, default=1,
+                        help='number of training processes; overridden by torchrun')
+    parser.add_argument('--dist_backend', type=str, default='gloo', choices=['gloo', 'nccl'])
+    parser.add_argument('--dist_init_method', type=str, default='tcp://127.0.0.1:23456',
+                        help='rendezvous address of the ranks')
 
     # Directories.
     parser.add_argument('--celeba_image_dir', type=str, default='data/celeba/images')
@@ -132,11 +234,41 @@ if __name__ == '__main__':
     parser.add_argument('--model_save_step', type=int, default=10000)
     parser.add_argument('--lr_update_step', type=int, default=1000)
 
+    # Profiling.
+    parser.add_argument('--phase_timers', type=str2bool, default=True,
+                        help='log the time per iteration of each training phase')
+    parser.add_argument('--profile_steps', type=int, nargs=2, default=None, metavar=('START', 'END'),
+                        help='capture a torch profiler trace of the iterations START to END')
+    parser.add_argument('--profile_dir', type=str, default=None, help='dir of the profiler traces, defaults to log_dir/profile')
+    parser.add_argument('--track_memory', type=str2bool, default=False,
+                        help='log the RSS and CUDA memory of each training phase')
+    parser.add_argument('--dry_run_steps', type=int, default=0,
+                        help='only run this many training steps and report the projected peak memory; '
+                             'exits with status 3 if it does not fit on the GPU')
+    parser.add_argument('--dry_run_margin_mb', type=int, default=512,
+                        help='device memory the dry run keeps free for the CUDA context and fragmentation')
+
+    # Checkpoint store.
+    parser.add_argument('--keep_last_ckpts', type=int, default=0, help='keep the last N checkpoints, 0 to keep all')
+    parser.add_argument('--keep_every_ckpt', type=int, default=0,
+                        help='also keep the checkpoints whose step is a multiple of this, 0 to disable')
+    parser.add_argument('--half_precision_G_ckpt', type=str2bool, default=False,
+                        help='save the generator checkpoints used for testing in float16')
+
     config = parser.parse_args()
 
     # Validate the training configs
     assert not (config.use_sw_loss and config.use_max_sw_loss), \
         print("Config use_sw_loss and use_max_sw_loss cannot be True at the same time.")
+    assert config.world_size == 1 or config.mode == 'train', \
+        print("Distributed mode is only supported for training.")
+    assert config.dataset != 'Both' or config.mode != 'eval', \
+        print("Evaluation is not supported for models trained on both datasets.")
+    assert config.dry_run_steps == 0 or (config.mode == 'train' and config.world_size == 1), \
+        print("Dry runs are only supported for single-process training.")
+    if config.dry_run_steps > 0:
+        # Keep the loss history of the run clean.
+        config.use_tensorboard = False
 
     print(config)
 
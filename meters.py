@@ -0,0 +1,61 @@
+import torch
+
+
+class LossMeter(object):
+    """Running mean, min and max of the losses over a log window.
+
+    The statistics stay on the device of the losses, so updating the meter does not
+    force a host-device sync. They are brought to the host only by summarize().
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Start a new log window."""
+        self.sum = {}
+        self.min = {}
+        self.max = {}
+        self.count = {}
+
+    def update(self, loss):
+        """Add the losses of a step.
+
+        Args:
+            loss(dict): Dict, key = loss tag, val = scalar loss tensor
+        """
+        for tag, value in loss.items():
+            value = value.detach()
+            if tag not in self.sum:
+                self.sum[tag] = value.clone()
+                self.min[tag] = value.clone()
+                self.max[tag] = value.clone()
+                self.count[tag] = 1
+            else:
+                self.sum[tag] += value
+                self.min[tag] = torch.min(self.min[tag], value)
+                self.max[tag] = torch.max(self.max[tag], value)
+                self.count[tag] += 1
+
+    def summarize(self):
+        """Return the statistics of the current window and start a new one.
+
+        Returns:
+            stats(dict): Dict, key = loss tag, val = dict with keys 'mean', 'min', 'max'
+        """
+        tags = list(self.sum.keys())
+        if not tags:
+            return {}
+
+        # A single transfer for all the statistics.
+        values = torch.stack([
+            torch.stack([self.sum[tag] / self.count[tag], self.min[tag], self.max[tag]])
+            for tag in tags
+        ]).tolist()
+
+        stats = {}
+        for tag, (mean, min_value, max_value) in zip(tags, values):
+            stats[tag] = {'mean': mean, 'min': min_value, 'max': max_value}
+
+        self.reset()
+        return stats
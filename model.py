@@ -1,7 +1,16 @@
+import inspect
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
+from torch.utils.checkpoint import checkpoint
+
+
+# Non-reentrant checkpointing (PyTorch 1.11+) also works when the segment input
+# does not require grad; fall back to the reentrant version on older releases.
+_CHECKPOINT_KWARGS = ({'use_reentrant': False}
+                      if 'use_reentrant' in inspect.signature(checkpoint).parameters else {})
 
 
 class ResidualBlock(nn.Module):
@@ -20,9 +29,19 @@ class ResidualBlock(nn.Module):
 
 
 class Generator(nn.Module):
-    """Generator network."""
-    def __init__(self, conv_dim=64, c_dim=5, repeat_num=6):
+    """Generator network.
+
+    If checkpoint_bottleneck (checkpoint_downsample) is enabled, the residual blocks
+    (down-sampling layers) do not keep their activations during training; they are
+    recomputed in the backward pass instead, trading compute for memory.
+    Note that the running stats of the recomputed InstanceNorm layers get updated twice
+    per forward. The running stats are only used in eval mode.
+    """
+    def __init__(self, conv_dim=64, c_dim=5, repeat_num=6,
+                 checkpoint_bottleneck=False, checkpoint_downsample=False):
         super(Generator, self).__init__()
+        self.checkpoint_bottleneck = checkpoint_bottleneck
+        self.checkpoint_downsample = checkpoint_downsample
 
         layers = []
         layers.append(nn.Conv2d(3+c_dim, conv_dim, kernel_size=7, stride=1, padding=3, bias=False))
@@ -30,6 +49,7 @@ class Generator(nn.Module):
         layers.append(nn.ReLU(inplace=True))
 
         # Down-sampling layers.
+        self.down_start = len(layers)
         curr_dim = conv_dim
         for i in range(2):
             layers.append(nn.Conv2d(curr_dim, curr_dim*2, kernel_size=4, stride=2, padding=1, bias=False))
@@ -38,8 +58,10 @@ class Generator(nn.Module):
             curr_dim = curr_dim * 2
 
         # Bottleneck layers.
+        self.bottleneck_start = len(layers)
         for i in range(repeat_num):
             layers.append(ResidualBlock(dim_in=curr_dim, dim_out=curr_dim))
+        self.bottleneck_end = len(layers)
 
         # Up-sampling layers.
         for i in range(2):
@@ -55,9 +77,39 @@ class Generator(nn.Module):
     def forward(self, x, c):
         # Replicate spatially and concatenate domain information.
         c = c.view(c.size(0), c.size(1), 1, 1)
-        c = c.repeat(1, 1, x.size(2), x.size(3))
+        c = c.expand(-1, -1, x.size(2), x.size(3))
         x = torch.cat([x, c], dim=1)
-        return self.main(x)
+
+        use_checkpoint = self.checkpoint_bottleneck or self.checkpoint_downsample
+        if not (use_checkpoint and self.training and torch.is_grad_enabled()):
+            return self.main(x)
+        return self._forward_checkpointed(x)
+
+    def _forward_checkpointed(self, x):
+        """Run self.main with the selected segments checkpointed."""
+        layers = list(self.main)
+
+        # Stem: keeps its activations so the checkpointed segments get an input
+        # that requires grad.
+        for layer in layers[:self.down_start]:
+            x = layer(x)
+
+        down = nn.Sequential(*layers[self.down_start:self.bottleneck_start])
+        if self.checkpoint_downsample:
+            x = checkpoint(down, x, **_CHECKPOINT_KWARGS)
+        else:
+            x = down(x)
+
+        # Checkpoint each residual block so that only the block inputs are stored.
+        for block in layers[self.bottleneck_start:self.bottleneck_end]:
+            if self.checkpoint_bottleneck:
+                x = checkpoint(block, x, **_CHECKPOINT_KWARGS)
+            else:
+                x = block(x)
+
+        for layer in layers[self.bottleneck_end:]:
+            x = layer(x)
+        return x
 
 
 class Discriminator(nn.Module):
@@ -0,0 +1,157 @@
+"""Export a trained generator to ONNX and run it with ONNX Runtime on the CPU.
+
+The exported graph takes the images and the target labels as separate inputs,
+with a dynamic batch size and image size.
+
+Usage:
+    python onnx_export.py --model_save_dir stargan_celeba_1/models --test_iters 100000 --c_dim 3 \
+        --verify True --benchmark True
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+
+from inference import instance_stats_copy, load_generator
+from main import str2bool
+
+
+def export_generator(G, onnx_path, c_dim, image_size=128, opset_version=11):
+    """Export the generator to an ONNX file.
+
+    The graph computes the outputs of G in train mode (instance statistics), like
+    Trainer.test() does.
+    """
+    G = instance_stats_copy(G).cpu()
+    x = torch.randn(1, 3, image_size, image_size)
+    c = torch.zeros(1, c_dim)
+    torch.onnx.export(G, (x, c), onnx_path,
+                      input_names=['image', 'label'],
+                      output_names=['output'],
+                      dynamic_axes={'image': {0: 'batch', 2: 'height', 3: 'width'},
+                                    'label': {0: 'batch'},
+                                    'output': {0: 'batch', 2: 'height', 3: 'width'}},
+                      opset_version=opset_version)
+
+
+def get_onnx_path(model_save_dir, iters):
+    return os.path.join(model_save_dir, '{}-G.onnx'.format(iters))
+
+
+class OnnxGenerator(object):
+    """Run an exported generator with ONNX Runtime; called like the Generator module."""
+
+    def __init__(self, onnx_path, num_threads=0):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, x, c):
+        inputs = {
+            'image': x.detach().cpu().float().numpy(),
+            'label': c.detach().cpu().float().numpy()
+        }
+        output = self.session.run(['output'], inputs)[0]
+        return torch.from_numpy(output).to(x.device)
+
+
+def check_parity(G, onnx_G, c_dim, image_size, batch_sizes, atol=1e-4):
+    """Compare the outputs of the PyTorch and the ONNX Runtime generators.
+
+    Returns:
+        max_diff(float): Max absolute difference over all batch sizes
+    """
+    G = instance_stats_copy(G).cpu()
+    max_diff = 0.0
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            x = torch.rand(batch_size, 3, image_size, image_size) * 2 - 1
+            c = torch.randint(0, 2, (batch_size, c_dim)).float()
+            diff = (G(x, c) - onnx_G(x, c)).abs().max().item()
+            print("Batch size {}: max abs diff {:.2e}".format(batch_size, diff))
+            max_diff = max(max_diff, diff)
+
+    status = 'PASSED' if max_diff <= atol else 'FAILED'
+    print("Parity check {} (max abs diff {:.2e}, atol {:.0e})".format(status, max_diff, atol))
+    return max_diff
+
+
+def time_generator(G, x, c, warmup, repeats):
+    """Return the latencies of repeated forwards in seconds."""
+    latencies = []
+    with torch.no_grad():
+        for _ in range(warmup):
+            G(x, c)
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            G(x, c)
+            latencies.append(time.perf_counter() - start_time)
+    return np.array(latencies)
+
+
+def compare_latency(G, onnx_G, c_dim, image_size, batch_sizes, warmup=3, repeats=20):
+    """Print the CPU latency and throughput of PyTorch vs. ONNX Runtime."""
+    G = instance_stats_copy(G).cpu()
+    backends = [('pytorch', G), ('onnxruntime', onnx_G)]
+
+    print("{:<12} {:>6} {:>12} {:>12} {:>10}".format('backend', 'batch', 'p50 (ms)', 'p95 (ms)', 'images/s'))
+    for batch_size in batch_sizes:
+        x = torch.rand(batch_size, 3, image_size, image_size) * 2 - 1
+        c = torch.randint(0, 2, (batch_size, c_dim)).float()
+        for name, model in backends:
+            latencies = time_generator(model, x, c, warmup, repeats)
+            print("{:<12} {:>6} {:>12.2f} {:>12.2f} {:>10.1f}".format(
+                name, batch_size, np.percentile(latencies, 50) * 1000,
+                np.percentile(latencies, 95) * 1000, batch_size / latencies.mean()))
+
+
+def main(args):
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    G = load_generator(args.model_save_dir, args.test_iters, args.g_conv_dim, args.c_dim, args.g_repeat_num)
+    onnx_path = args.onnx_path or get_onnx_path(args.model_save_dir, args.test_iters)
+    export_generator(G, onnx_path, args.c_dim, args.image_size, args.opset_version)
+    print('Exported the generator into {}...'.format(onnx_path))
+
+    batch_sizes = list(map(int, args.batch_sizes))
+    onnx_G = OnnxGenerator(onnx_path, args.num_threads)
+    max_diff = None
+    if args.verify:
+        max_diff = check_parity(G, onnx_G, args.c_dim, args.image_size, batch_sizes, args.atol)
+    if args.benchmark:
+        compare_latency(G, onnx_G, args.c_dim, args.image_size, batch_sizes)
+
+    # Let scripts and CI detect a broken export.
+    if max_diff is not None and max_diff > args.atol:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ONNX export')
+
+    # Model configuration.
+    parser.add_argument('--c_dim', type=int, default=5)
+    parser.add_argument('--g_conv_dim', type=int, default=64)
+    parser.add_argument('--g_repeat_num', type=int, default=6)
+    parser.add_argument('--image_size', type=int, default=128)
+    parser.add_argument('--model_save_dir', type=str, default='stargan/models')
+    parser.add_argument('--test_iters', type=int, default=100000, help='export the model from this step')
+
+    # Export configuration.
+    parser.add_argument('--onnx_path', type=str, default=None, help='defaults to {model_save_dir}/{test_iters}-G.onnx')
+    parser.add_argument('--opset_version', type=int, default=11)
+    parser.add_argument('--verify', type=str2bool, default=True, help='check the outputs against PyTorch')
+    parser.add_argument('--atol', type=float, default=1e-4)
+    parser.add_argument('--benchmark', type=str2bool, default=False, help='compare the CPU latency with PyTorch')
+    parser.add_argument('--batch_sizes', nargs='+', default=[1, 16])
+    parser.add_argument('--num_threads', type=int, default=0, help='threads for both backends, 0 for the default')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
@@ -0,0 +1,210 @@
+import collections
+import contextlib
+import os
+import resource
+import sys
+import time
+
+import torch
+
+
+def current_rss_mb():
+    """Current resident set size of the process in MB."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        # No procfs (e.g. MacOS): fall back to the peak
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """Peak resident set size of the process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in KB on Linux but in bytes on MacOS
+    if sys.platform == 'darwin':
+        peak /= 1024.0
+    return peak / 1024.0
+
+
+def memory_usage(device):
+    """Current and peak memory of the process, and of the CUDA device if used.
+
+    Returns:
+        usage(dict): 'rss_mb', 'peak_rss_mb' and, on CUDA, 'cuda_allocated_mb',
+            'cuda_peak_allocated_mb', 'cuda_reserved_mb' and 'cuda_total_mb'
+    """
+    usage = {'rss_mb': current_rss_mb(), 'peak_rss_mb': peak_rss_mb()}
+    device = torch.device(device)
+    if device.type == 'cuda':
+        usage['cuda_allocated_mb'] = torch.cuda.memory_allocated(device) / 2**20
+        usage['cuda_peak_allocated_mb'] = torch.cuda.max_memory_allocated(device) / 2**20
+        usage['cuda_reserved_mb'] = torch.cuda.memory_reserved(device) / 2**20
+        usage['cuda_total_mb'] = torch.cuda.get_device_properties(device).total_memory / 2**20
+    return usage
+
+
+class PhaseTimer(object):
+    """Named timing scopes aggregated per phase over a log window.
+
+    On CUDA, a scope records a pair of events on the current stream instead of
+    synchronizing, so it does not stall the pipeline; the elapsed times are resolved
+    by summarize() at log time. Scopes with host=True (e.g. data loading, writing
+    files) measure the wall time on the host instead. When disabled, scope() costs
+    nothing. Inside a torch profiler trace, each scope also shows up as a range.
+
+    With track_memory=True, each scope also records the peak CUDA memory allocated
+    within it (nested scopes included) and the RSS at its end. Besides the per-window
+    values, the peaks since the start are kept in peaks.
+
+    When an exception (e.g. CUDA out of memory) escapes a scope, the innermost enabled
+    scope it was raised in is kept in failed_phase.
+    """
+
+    def __init__(self, device, enabled=True, track_memory=False):
+        self.device = torch.device(device)
+        self.use_cuda_events = self.device.type == 'cuda'
+        self.enabled = enabled or track_memory
+        self.track_memory = track_memory
+        self.profiling = False
+        self.peaks = collections.OrderedDict()
+        self.memory_stack = []
+        self.failed_phase = None
+        self.reset()
+
+    def reset(self):
+        self.totals = collections.OrderedDict()
+        self.counts = collections.Counter()
+        self.memory = collections.OrderedDict()
+        self.pending = []
+
+    @contextlib.contextmanager
+    def scope(self, name, host=False):
+        """Time the enclosed code as the phase name."""
+        if not self.enabled:
+            yield
+            return
+
+        try:
+            with torch.profiler.record_function(name) if self.profiling else contextlib.nullcontext():
+                if self.track_memory:
+                    self._start_memory()
+                if self.use_cuda_events and not host:
+                    start = torch.cuda.Event(enable_timing=True)
+                    end = torch.cuda.Event(enable_timing=True)
+                    stream = torch.cuda.current_stream(self.device)
+                    start.record(stream)
+                    yield
+                    end.record(stream)
+                    self.pending.append((name, start, end))
+                else:
+                    start_time = time.perf_counter()
+                    yield
+                    self._add(name, (time.perf_counter() - start_time) * 1000)
+                if self.track_memory:
+                    self._end_memory(name)
+        except Exception:
+            # The innermost scope sees the exception first.
+            if self.failed_phase is None:
+                self.failed_phase = name
+            raise
+
+    def _add(self, name, elapsed_ms):
+        self.totals[name] = self.totals.get(name, 0.0) + elapsed_ms
+        self.counts[name] += 1
+
+    def _start_memory(self):
+        if self.use_cuda_events:
+            # The allocator keeps a single peak, so the peak of the enclosing scope so
+            # far is saved before resetting it.
+            if self.memory_stack:
+                self.memory_stack[-1] = max(self.memory_stack[-1], torch.cuda.max_memory_allocated(self.device))
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.memory_stack.append(0)
+
+    def _end_memory(self, name):
+        memory = {'rss_mb': current_rss_mb()}
+        peak = self.memory_stack.pop()
+        if self.use_cuda_events:
+            peak = max(peak, torch.cuda.max_memory_allocated(self.device))
+            memory['peak_cuda_mb'] = peak / 2**20
+            if self.memory_stack:
+                self.memory_stack[-1] = max(self.memory_stack[-1], peak)
+
+        for store in [self.memory, self.peaks]:
+            old = store.get(name)
+            store[name] = memory if old is None else {key: max(value, old[key]) for key, value in memory.items()}
+
+    def summarize(self, num_iters):
+        """Return the timings of the window and start a new one.
+
+        Args:
+            num_iters(int): Number of iterations in the window
+        Returns:
+            phases(dict): Key = phase name, val = dict with the time per iteration
+                'ms_per_iter' and the number of calls 'count', plus the max RSS at the
+                end of the phase 'rss_mb' and its peak CUDA memory 'peak_cuda_mb' if
+                memory is tracked
+        """
+        if self.pending:
+            self.pending[-1][2].synchronize()
+            for name, start, end in self.pending:
+                self._add(name, start.elapsed_time(end))
+
+        phases = collections.OrderedDict()
+        for name, total in self.totals.items():
+            phases[name] = {'ms_per_iter': total / max(num_iters, 1), 'count': self.counts[name]}
+            phases[name].update(self.memory.get(name, {}))
+        self.reset()
+        return phases
+
+
+class ProfilerWindow(object):
+    """Capture a torch profiler trace of the iterations [start, end).
+
+    Call step(i) at the beginning of each iteration. The trace is saved in trace_dir
+    as a Chrome trace, which can be opened in chrome://tracing or Perfetto, when the
+    window ends or at close(). A run resumed within the window profiles its remaining
+    iterations, and the trace is named after the iterations it actually covers.
+    """
+
+    def __init__(self, start, end, trace_dir, device, timer=None):
+        self.start = start
+        self.end = end
+        self.trace_dir = trace_dir
+        self.timer = timer
+        self.activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.device(device).type == 'cuda':
+            self.activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = None
+        self.profile_start = None
+        self.trace_path = None
+
+    def step(self, i):
+        """Start or stop profiling before iteration i. Returns the path of the trace
+        when it is saved, otherwise None."""
+        if self.start <= i < self.end and self.profiler is None and self.trace_path is None:
+            self.profile_start = i
+            self.profiler = torch.profiler.profile(activities=self.activities, record_shapes=True,
+                                                   profile_memory=True, with_stack=False)
+            self.profiler.__enter__()
+            if self.timer is not None:
+                self.timer.profiling = True
+        elif i >= self.end:
+            return self.close()
+        return None
+
+    def close(self):
+        """Stop profiling and save the trace. Returns its path, or None if not profiling."""
+        if self.profiler is None:
+            return None
+        self.profiler.__exit__(None, None, None)
+        if self.timer is not None:
+            self.timer.profiling = False
+
+        if not os.path.exists(self.trace_dir):
+            os.makedirs(self.trace_dir)
+        self.trace_path = os.path.join(self.trace_dir, 'trace-{}-{}.json'.format(self.profile_start + 1, self.end))
+        self.profiler.export_chrome_trace(self.trace_path)
+        self.profiler = None
+        return self.trace_path
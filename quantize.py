@@ -0,0 +1,186 @@
+"""Post-training int8 quantization of a trained generator for CPU inference.
+
+The generator is quantized statically: the activation ranges are calibrated on
+images of the CelebA test split. Dynamic quantization does not apply here since
+it only covers Linear and recurrent layers, and the generator is all convolutions.
+
+The int8 model is saved as TorchScript, so it can be loaded with torch.jit.load
+without this code.
+
+Usage:
+    python quantize.py --model_save_dir stargan_celeba_1/models --test_iters 100000 \
+        --c_dim 3 --selected_attrs Blond_Hair Male Young
+"""
+import argparse
+import io
+import os
+import time
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QConfig, QConfigMapping, default_weight_observer, get_default_qconfig
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from data_loader import get_loader
+from inference import create_celeba_labels, instance_stats_copy, load_generator
+
+
+def quantize_generator(G, calib_batches, backend='fbgemm'):
+    """Quantize the generator to int8 with FX graph mode static quantization.
+
+    The float model is the instance-statistics copy of G (see instance_stats_copy),
+    so that the quantized InstanceNorm layers, which always normalize each image with
+    its own statistics, are calibrated on the outputs Trainer.test() produces.
+    ConvTranspose2d only supports per-tensor weight quantization.
+
+    Args:
+        G(nn.Module): Trained generator
+        calib_batches(list<tuple>): (x, c) pairs used to calibrate the activation ranges
+        backend(str): Quantized engine, 'fbgemm' for x86 or 'qnnpack' for ARM
+    Returns:
+        Quantized generator (GraphModule)
+    """
+    torch.backends.quantized.engine = backend
+    float_G = instance_stats_copy(G).cpu()
+
+    qconfig = get_default_qconfig(backend)
+    transpose_qconfig = QConfig(activation=qconfig.activation, weight=default_weight_observer)
+    qconfig_mapping = (QConfigMapping()
+                       .set_global(qconfig)
+                       .set_object_type(nn.ConvTranspose2d, transpose_qconfig))
+
+    prepared = prepare_fx(float_G, qconfig_mapping, example_inputs=calib_batches[0])
+    with torch.no_grad():
+        for x, c in calib_batches:
+            prepared(x, c)
+    return convert_fx(prepared)
+
+
+def save_quantized(quantized_G, example_inputs, path):
+    """Save the quantized generator as TorchScript."""
+    with torch.no_grad():
+        scripted = torch.jit.trace(quantized_G, example_inputs)
+    torch.jit.save(scripted, path)
+    return scripted
+
+
+def serialized_size(state_dict):
+    """Size in bytes of a state dict saved with torch.save. The checkpoint file may hold
+    float16 weights (--half_precision_G_ckpt), so the fp32 size is measured on the model."""
+    buffer = io.BytesIO()
+    torch.save(state_dict, buffer)
+    return buffer.tell()
+
+
+def psnr(x, y):
+    """Mean PSNR in dB of image batches in [0, 1]."""
+    mse = ((x - y) ** 2).view(x.size(0), -1).mean(dim=1).clamp_min(1e-10)
+    return (10 * torch.log10(1 / mse)).mean().item()
+
+
+def evaluate(float_G, quantized_G, batches):
+    """Compare the quantized generator against the float one.
+
+    Returns:
+        report(dict): Latencies, speedup, L1 and PSNR of the int8 outputs vs. the fp32 outputs
+    """
+    float_time, quantized_time, l1, psnr_sum = 0.0, 0.0, 0.0, 0.0
+    with torch.no_grad():
+        # Warm up both models.
+        float_G(*batches[0])
+        quantized_G(*batches[0])
+
+        for x, c in batches:
+            start_time = time.perf_counter()
+            out_float = float_G(x, c)
+            float_time += time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            out_quantized = quantized_G(x, c)
+            quantized_time += time.perf_counter() - start_time
+
+            # Compare in the image range [0, 1].
+            out_float = ((out_float + 1) / 2).clamp(0, 1)
+            out_quantized = ((out_quantized + 1) / 2).clamp(0, 1)
+            l1 += torch.mean(torch.abs(out_float - out_quantized)).item()
+            psnr_sum += psnr(out_float, out_quantized)
+
+    return {
+        'fp32_time_s': float_time,
+        'int8_time_s': quantized_time,
+        'speedup': float_time / quantized_time,
+        'l1': l1 / len(batches),
+        'psnr_db': psnr_sum / len(batches)
+    }
+
+
+def main(args):
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    G = load_generator(args.model_save_dir, args.test_iters, args.g_conv_dim, args.c_dim, args.g_repeat_num)
+
+    # Calibrate on the first images of the test split and evaluate on the next ones.
+    data_loader = get_loader(args.celeba_image_dir, args.attr_path, args.selected_attrs,
+                             args.celeba_crop_size, args.image_size, args.batch_size,
+                             'CelebA', 'test', args.num_workers)
+    calib_batches, eval_batches = [], []
+    num_images = 0
+    for x_real, c_org in data_loader:
+        batches = calib_batches if num_images < args.num_calib_images else eval_batches
+        for c_trg in create_celeba_labels(c_org, args.selected_attrs):
+            batches.append((x_real, c_trg))
+        num_images += x_real.size(0)
+        if num_images >= args.num_calib_images + args.num_eval_images:
+            break
+    print("==> Calibrating on {} batches...".format(len(calib_batches)))
+
+    quantized_G = quantize_generator(G, calib_batches, args.backend)
+    quantized_path = args.quantized_path or os.path.join(
+        args.model_save_dir, '{}-G-int8.pt'.format(args.test_iters))
+    quantized_G = save_quantized(quantized_G, calib_batches[0], quantized_path)
+    print('Saved the int8 generator into {}...'.format(quantized_path))
+
+    print("==> Evaluating on {} batches...".format(len(eval_batches)))
+    report = evaluate(instance_stats_copy(G).cpu(), quantized_G, eval_batches)
+    report['fp32_size_mb'] = serialized_size(G.state_dict()) / 2**20
+    report['int8_size_mb'] = os.path.getsize(quantized_path) / 2**20
+
+    print("Speedup: {:.2f}x ({:.2f}s => {:.2f}s)".format(
+        report['speedup'], report['fp32_time_s'], report['int8_time_s']))
+    print("Model size: {:.1f} MB => {:.1f} MB".format(report['fp32_size_mb'], report['int8_size_mb']))
+    print("Quality vs. fp32: L1 {:.4f}, PSNR {:.2f} dB".format(report['l1'], report['psnr_db']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantization')
+
+    # Model configuration.
+    parser.add_argument('--c_dim', type=int, default=5)
+    parser.add_argument('--g_conv_dim', type=int, default=64)
+    parser.add_argument('--g_repeat_num', type=int, default=6)
+    parser.add_argument('--celeba_crop_size', type=int, default=178)
+    parser.add_argument('--image_size', type=int, default=128)
+    parser.add_argument('--selected_attrs', '--list', nargs='+',
+                        default=['Black_Hair', 'Blond_Hair', 'Brown_Hair', 'Male', 'Young'])
+    parser.add_argument('--model_save_dir', type=str, default='stargan/models')
+    parser.add_argument('--test_iters', type=int, default=100000, help='quantize the model from this step')
+
+    # Quantization configuration.
+    parser.add_argument('--backend', type=str, default='fbgemm', choices=['fbgemm', 'qnnpack'])
+    parser.add_argument('--num_calib_images', type=int, default=256, help='test images used for calibration')
+    parser.add_argument('--num_eval_images', type=int, default=256, help='test images used for the report')
+    parser.add_argument('--quantized_path', type=str, default=None,
+                        help='defaults to {model_save_dir}/{test_iters}-G-int8.pt')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--num_threads', type=int, default=0, help='torch threads, 0 to keep the default')
+
+    # Directories.
+    parser.add_argument('--celeba_image_dir', type=str, default='data/celeba/images')
+    parser.add_argument('--attr_path', type=str, default='data/celeba/list_attr_celeba.txt')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
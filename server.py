@@ -0,0 +1,295 @@
+"""Local HTTP server translating images with a trained StarGAN generator.
+
+The generator stays loaded in memory. Concurrent requests are merged into batches
+of at most max_batch_size (image, label) pairs; a batch is run as soon as it is
+full or the oldest request has waited max_wait_ms.
+
+Usage:
+    python server.py --model_save_dir stargan_celeba_1/models --test_iters 100000 --c_dim 3
+
+API:
+    POST /translate  {"image": <base64 encoded image>, "labels": [[0, 1, 1], ...]}
+                     => {"images": [<base64 encoded PNG>, ...]}, one image per label
+    GET  /stats      => latency percentiles, queue depth, batch sizes and cache hits/misses
+
+With --cache_dir, the translations are cached on disk and repeated requests skip the generator.
+"""
+import argparse
+import base64
+import collections
+import io
+import json
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+from PIL import Image
+from torchvision.transforms.functional import to_pil_image
+
+from cache import TranslationCache, file_hash, tensor_hash
+from data_loader import build_transform
+from inference import generate, load_generator
+
+
+class _Request(object):
+    """A translation request waiting in the queue."""
+
+    def __init__(self, image, labels):
+        self.image = image              # shape (C, H, W)
+        self.labels = labels            # shape (num_labels, c_dim)
+        self.enqueue_time = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class LatencyStats(object):
+    """Latency percentiles over the most recent requests."""
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.num_requests = 0
+
+    def add_request(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.num_requests += 1
+
+    def add_batch(self, batch_size):
+        with self.lock:
+            self.batch_sizes.append(batch_size)
+
+    def summarize(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            batch_sizes = list(self.batch_sizes)
+            num_requests = self.num_requests
+
+        stats = {'num_requests': num_requests}
+        for p in [50, 95, 99]:
+            key = 'latency_p{}_ms'.format(p)
+            stats[key] = percentile(latencies, p) * 1000 if latencies else None
+        stats['mean_batch_size'] = sum(batch_sizes) / len(batch_sizes) if batch_sizes else None
+        return stats
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of a sorted list."""
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class DynamicBatcher(object):
+    """Merge concurrent requests into batches and run them on a worker thread."""
+
+    def __init__(self, G, device, max_batch_size=32, max_wait_ms=10, max_queue_size=256):
+        self.G = G
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.stats = LatencyStats()
+
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def submit(self, image, labels):
+        """Translate the image into every label and wait for the result.
+
+        Raises queue.Full if the server is overloaded.
+        """
+        request = _Request(image, labels)
+        self.queue.put_nowait(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _collect_batch(self):
+        """Block for a request, then add requests until the batch is full or the wait expires."""
+        batch = [self.queue.get()]
+        num_pairs = batch[0].labels.size(0)
+        deadline = batch[0].enqueue_time + self.max_wait
+
+        while num_pairs < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            num_pairs += request.labels.size(0)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            num_pairs = sum(r.labels.size(0) for r in batch)
+            try:
+                # One (image, label) pair per requested label.
+                x = torch.cat([r.image.unsqueeze(0).expand(r.labels.size(0), -1, -1, -1)
+                               for r in batch], dim=0).to(self.device)
+                c = torch.cat([r.labels for r in batch], dim=0).to(self.device)
+                with torch.no_grad():
+                    x_fake = generate(self.G, x, c, self.max_batch_size).cpu()
+
+                outputs = x_fake.split([r.labels.size(0) for r in batch], dim=0)
+                for request, output in zip(batch, outputs):
+                    request.result = output
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+
+            self.stats.add_batch(num_pairs)
+            now = time.perf_counter()
+            for request in batch:
+                self.stats.add_request(now - request.enqueue_time)
+                request.done.set()
+
+
+def decode_image(data, transform):
+    """Decode a base64 encoded image into a normalized tensor of shape (C, H, W)."""
+    image = Image.open(io.BytesIO(base64.b64decode(data))).convert('RGB')
+    return transform(image)
+
+
+def encode_image(x):
+    """Encode a tensor in [-1, 1] of shape (C, H, W) as a base64 PNG."""
+    image = to_pil_image(((x + 1) / 2).clamp_(0, 1))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def translate_with_cache(batcher, image, labels, cache, cache_prefix):
+    """Translate the image into every label, only sending the labels missing from the cache to the batcher."""
+    if cache is None:
+        return batcher.submit(image, labels)
+
+    image_hash = tensor_hash(image)
+    keys = [cache.make_key(cache_prefix, image_hash, label) for label in labels]
+    outputs = [cache.get(key) for key in keys]
+    missing = [i for i, output in enumerate(outputs) if output is None]
+    if missing:
+        x_fake = batcher.submit(image, labels[missing])
+        for i, x_out in zip(missing, x_fake):
+            cache.put(keys[i], x_out)
+            outputs[i] = x_out
+    return outputs
+
+
+def build_handler(batcher, transform, c_dim, cache=None, cache_prefix=None):
+    """Build the HTTP request handler serving the batcher."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send_json(self, code, body):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path != '/stats':
+                return self._send_json(404, {'error': 'unknown path {}'.format(self.path)})
+            stats = batcher.stats.summarize()
+            stats['queue_depth'] = batcher.queue_depth()
+            if cache is not None:
+                stats['cache'] = cache.stats()
+            self._send_json(200, stats)
+
+        def do_POST(self):
+            if self.path != '/translate':
+                return self._send_json(404, {'error': 'unknown path {}'.format(self.path)})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                image = decode_image(body['image'], transform)
+                labels = torch.tensor(body['labels'], dtype=torch.float32)
+                assert labels.dim() == 2 and labels.size(1) == c_dim, \
+                    "labels must have shape (num_labels, {})".format(c_dim)
+            except Exception as e:
+                return self._send_json(400, {'error': str(e)})
+
+            try:
+                x_fake = translate_with_cache(batcher, image, labels, cache, cache_prefix)
+            except queue.Full:
+                return self._send_json(503, {'error': 'server overloaded'})
+            except Exception as e:
+                return self._send_json(500, {'error': str(e)})
+
+            self._send_json(200, {'images': [encode_image(x) for x in x_fake]})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main(args):
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device(args.device)
+
+    print("==> Loading the generator...")
+    G = load_generator(args.model_save_dir, args.test_iters, args.g_conv_dim,
+                       args.c_dim, args.g_repeat_num, device)
+
+    batcher = DynamicBatcher(G, device, args.max_batch_size, args.max_wait_ms, args.max_queue_size)
+    transform = build_transform(args.crop_size, args.image_size)
+    cache, cache_prefix = None, None
+    if args.cache_dir:
+        cache = TranslationCache(args.cache_dir, args.cache_size_mb)
+        G_path = os.path.join(args.model_save_dir, '{}-G.ckpt'.format(args.test_iters))
+        cache_prefix = TranslationCache.make_key(file_hash(G_path), 'server', args.crop_size, args.image_size)
+
+    handler = build_handler(batcher, transform, args.c_dim, cache, cache_prefix)
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+
+    print("==> Serving on http://{}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Translation server')
+
+    # Model configuration.
+    parser.add_argument('--c_dim', type=int, default=5)
+    parser.add_argument('--g_conv_dim', type=int, default=64)
+    parser.add_argument('--g_repeat_num', type=int, default=6)
+    parser.add_argument('--crop_size', type=int, default=178, help='center crop applied to the input images')
+    parser.add_argument('--image_size', type=int, default=128)
+    parser.add_argument('--model_save_dir', type=str, default='stargan/models')
+    parser.add_argument('--test_iters', type=int, default=100000, help='load the model from this step')
+
+    # Server configuration.
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch_size', type=int, default=32, help='max (image, label) pairs per batch')
+    parser.add_argument('--max_wait_ms', type=float, default=10, help='max time a request waits for a batch')
+    parser.add_argument('--max_queue_size', type=int, default=256, help='reject requests beyond this queue depth')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch threads, 0 to keep the default')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--cache_dir', type=str, default=None, help='cache the translations in this dir')
+    parser.add_argument('--cache_size_mb', type=int, default=2048)
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
@@ -1,4 +1,3 @@
-import numpy as np
 import torch
 import torch.nn.functional as F
 
@@ -20,10 +19,10 @@ def sliced_wasserstein_distance(true_samples, fake_samples, num_projections, dev
 
     num_features = true_samples.shape[1]
 
-    # Random projection directions, shape (num_features, num_projections)
-    projections = np.random.normal(size=(num_features, num_projections)).astype(np.float32)
-    projections = F.normalize(torch.from_numpy(projections), p=2, dim=0)
-    projections = torch.FloatTensor(projections).to(device)
+    # Random projection directions, shape (num_features, num_projections), drawn on the
+    # device so that no host-to-device copy is needed
+    projections = torch.randn(num_features, num_projections, device=device, dtype=true_samples.dtype)
+    projections = F.normalize(projections, p=2, dim=0)
 
     # Project the samples along the directions, get shape (N, num_projections)
     # Then transpose to (num_projections, N), format [projected_image1, projected_image2, ...]
@@ -0,0 +1,309 @@
+"""Run a grid of main.py trainings on one machine.
+
+The runs are queued and packed onto the CPU cores: each run gets threads_per_run
+cores, which it is pinned to, and the GPUs are shared round-robin between the
+slots. Failed runs are retried from their latest checkpoint. The state of the
+sweep is kept in {sweep_dir}/sweep.json, so an interrupted sweep resumes where it
+stopped when started again with the same arguments: finished runs are skipped and
+interrupted ones continue from their latest checkpoint.
+
+Options are given without the leading dashes. Grid values are separated by commas,
+and values with spaces are passed as several arguments (e.g. selected_attrs).
+
+Usage:
+    python sweep.py --sweep_dir sweeps/celeba_sw \
+        --set dataset=CelebA c_dim=3 "selected_attrs=Blond_Hair Male Young" use_sw_loss=True num_iters=100000 \
+        --grid num_projections=1000,10000 batch_size=16,32 \
+        --threads_per_run 8 --gpus cuda:0 cuda:1
+"""
+import argparse
+import itertools
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_assignments(items, multiple=False):
+    """Parse 'key=value' items, with comma-separated values if multiple."""
+    params = {}
+    for item in items:
+        key, sep, value = item.partition('=')
+        assert sep, "Expected key=value, got {}".format(item)
+        params[key.lstrip('-')] = value.split(',') if multiple else value
+    return params
+
+
+def build_runs(base, grid):
+    """One run per combination of the grid values.
+
+    Returns:
+        runs(list<dict>): Name and options of each run
+    """
+    keys = sorted(grid.keys())
+    runs = []
+    for values in itertools.product(*[grid[key] for key in keys]):
+        params = dict(base)
+        params.update(zip(keys, values))
+        suffix = '_'.join('{}={}'.format(key, value) for key, value in zip(keys, values))
+        name = re.sub(r'[^\w=.-]+', '-', suffix) if suffix else 'run'
+        runs.append({'name': name, 'params': params})
+    return runs
+
+
+def latest_checkpoint(model_save_dir):
+    """Latest step indexed by the checkpoint manager, or None."""
+    index_path = os.path.join(model_save_dir, 'checkpoints.json')
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as file:
+        return json.load(file).get('latest')
+
+
+def ran_out_of_memory(stdout_path, offset=0):
+    """Whether the output of a run written after offset reports running out of memory."""
+    if not os.path.exists(stdout_path):
+        return False
+    with open(stdout_path, 'rb') as file:
+        file.seek(offset)
+        return b'out of memory' in file.read()
+
+
+def last_logged_iteration(progress_path):
+    """Last iteration reported in a progress log, or 0."""
+    if not os.path.exists(progress_path):
+        return 0
+    iteration = 0
+    with open(progress_path) as file:
+        for line in file:
+            match = re.search(r'Iteration \[(\d+)/', line)
+            if match:
+                iteration = int(match.group(1))
+    return iteration
+
+
+class Sweep(object):
+    """Queue of runs executed in parallel slots, with its state saved in sweep.json."""
+
+    def __init__(self, args):
+        self.args = args
+        self.state_path = os.path.join(args.sweep_dir, 'sweep.json')
+
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        if args.cpus:
+            cpus = [int(cpu) for cpu in args.cpus]
+        num_slots = args.max_parallel or max(1, len(cpus) // args.threads_per_run)
+        self.slots = []
+        for k in range(num_slots):
+            slot_cpus = cpus[k * args.threads_per_run:(k + 1) * args.threads_per_run]
+            self.slots.append({
+                'cpus': slot_cpus or cpus,
+                'gpu': args.gpus[k % len(args.gpus)] if args.gpus else None,
+                'run': None
+            })
+
+        runs = build_runs(parse_assignments(args.set), parse_assignments(args.grid, multiple=True))
+        self.runs = self._load_state(runs)
+        self.processes = {}
+
+    def _load_state(self, runs):
+        """Merge the runs with their state from a previous invocation."""
+        previous = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as file:
+                previous = {run['name']: run for run in json.load(file)['runs']}
+
+        for run in runs:
+            old = previous.get(run['name'], {})
+            run['status'] = old.get('status', 'pending')
+            run['attempts'] = old.get('attempts', 0)
+            run['history'] = old.get('history', [])
+            # Runs left running by an interrupted sweep are resumed.
+            if run['status'] in ['running', 'interrupted']:
+                run['status'] = 'pending'
+        return runs
+
+    def save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'runs': self.runs}, file, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def run_dir(self, run):
+        return os.path.join(self.args.sweep_dir, run['name'])
+
+    def build_command(self, run, slot):
+        run_dir = self.run_dir(run)
+        options = dict(run['params'])
+        # Same layout as the scripts in scripts/
+        for option, dir_name in [('sample_dir', 'samples'), ('log_dir', 'logs'), ('model_save_dir', 'models'),
+                                 ('result_dir', 'results'), ('config_dir', 'configs'),
+                                 ('progress_dir', 'progress')]:
+            options[option] = os.path.join(run_dir, dir_name)
+        options['num_threads'] = len(slot['cpus'])
+        if slot['gpu'] is not None:
+            options['cuda_device_name'] = slot['gpu']
+        if latest_checkpoint(options['model_save_dir']) is not None:
+            options['resume_iters'] = -1
+
+        command = [sys.executable, os.path.join(REPO_DIR, 'main.py'), '--mode', 'train']
+        for key, value in sorted(options.items()):
+            command.append('--' + key)
+            command.extend(str(value).split())
+        return command, options['progress_dir']
+
+    def start(self, run, slot):
+        command, progress_dir = self.build_command(run, slot)
+        env = dict(os.environ)
+        for name in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS']:
+            env[name] = str(len(slot['cpus']))
+        if slot['gpu'] is None and not self.args.gpus:
+            env['CUDA_VISIBLE_DEVICES'] = ''
+        cpus = slot['cpus']
+
+        def pin():
+            if hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(0, cpus)
+
+        if not os.path.exists(self.run_dir(run)):
+            os.makedirs(self.run_dir(run))
+        stdout_path = os.path.join(self.run_dir(run), 'stdout.log')
+        stdout_offset = os.path.getsize(stdout_path) if os.path.exists(stdout_path) else 0
+        stdout = open(stdout_path, 'a')
+        process = subprocess.Popen(command, cwd=REPO_DIR, env=env, stdout=stdout,
+                                   stderr=subprocess.STDOUT, preexec_fn=pin)
+        stdout.close()
+
+        progress_path = os.path.join(progress_dir, 'progress.log')
+        run['status'] = 'running'
+        run['attempts'] += 1
+        run['history'].append({'start_time': time.time(), 'cpus': cpus, 'gpu': slot['gpu'],
+                               'start_iteration': last_logged_iteration(progress_path),
+                               'stdout_offset': stdout_offset})
+        slot['run'] = run
+        self.processes[run['name']] = (process, progress_path)
+        print("[{}] Started {} (attempt {}) on cpus {}{}".format(
+            time.strftime('%H:%M:%S'), run['name'], run['attempts'], cpus,
+            ' and ' + slot['gpu'] if slot['gpu'] else ''))
+        self.save_state()
+
+    def finish(self, run, slot, returncode):
+        _, progress_path = self.processes.pop(run['name'])
+        attempt = run['history'][-1]
+        attempt['end_time'] = time.time()
+        attempt['returncode'] = returncode
+        attempt['end_iteration'] = last_logged_iteration(progress_path)
+        elapsed = attempt['end_time'] - attempt['start_time']
+        attempt['iters_per_s'] = (attempt['end_iteration'] - attempt['start_iteration']) / elapsed if elapsed else None
+
+        # A config which does not fit in memory fails again when retried.
+        if returncode == 3:
+            attempt['failure'] = 'does not fit (dry run)'
+        elif returncode != 0 and ran_out_of_memory(os.path.join(self.run_dir(run), 'stdout.log'),
+                                                   attempt['stdout_offset']):
+            attempt['failure'] = 'out of memory'
+
+        if returncode == 0:
+            run['status'] = 'done'
+        elif 'failure' not in attempt and run['attempts'] <= self.args.max_retries:
+            run['status'] = 'pending'
+        else:
+            run['status'] = 'failed'
+        slot['run'] = None
+
+        speed = '{:.2f} it/s'.format(attempt['iters_per_s']) if attempt['iters_per_s'] is not None else ''
+        print("[{}] {} {} (exit code {}{}) {}".format(
+            time.strftime('%H:%M:%S'), run['name'],
+            'finished' if returncode == 0 else 'failed', returncode,
+            ', ' + attempt['failure'] if 'failure' in attempt else '', speed))
+        self.save_state()
+
+    def stop(self):
+        """Terminate the running runs; they are resumed by the next invocation."""
+        for slot in self.slots:
+            run = slot['run']
+            if run is None:
+                continue
+            process, _ = self.processes[run['name']]
+            process.terminate()
+            process.wait()
+            run['status'] = 'interrupted'
+            run['attempts'] -= 1
+            run['history'][-1]['end_time'] = time.time()
+        self.save_state()
+
+    def loop(self):
+        """Start the pending runs in the free slots until all the runs are finished."""
+        while True:
+            for slot in self.slots:
+                run = slot['run']
+                if run is not None:
+                    process, _ = self.processes[run['name']]
+                    if process.poll() is not None:
+                        self.finish(run, slot, process.returncode)
+
+            pending = [run for run in self.runs if run['status'] == 'pending']
+            free_slots = [slot for slot in self.slots if slot['run'] is None]
+            for run, slot in zip(pending, free_slots):
+                self.start(run, slot)
+
+            if not pending and len(free_slots) == len(self.slots):
+                return
+            time.sleep(self.args.poll_interval)
+
+    def summary(self):
+        print("{:<48} {:<8} {:>8} {:>10}  {}".format('run', 'status', 'attempts', 'it/s', 'failure'))
+        for run in self.runs:
+            speeds = [attempt['iters_per_s'] for attempt in run['history'] if attempt.get('iters_per_s')]
+            speed = '{:.2f}'.format(speeds[-1]) if speeds else '-'
+            failure = run['history'][-1].get('failure', '') if run['history'] else ''
+            print("{:<48} {:<8} {:>8} {:>10}  {}".format(run['name'], run['status'], run['attempts'], speed, failure))
+
+
+def main(args):
+    if not os.path.exists(args.sweep_dir):
+        os.makedirs(args.sweep_dir)
+
+    sweep = Sweep(args)
+    print("==> {} runs, {} slots of {} threads".format(len(sweep.runs), len(sweep.slots), args.threads_per_run))
+    if args.list:
+        sweep.summary()
+        return
+
+    # Stop the runs on SIGTERM as on Ctrl-C.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    try:
+        sweep.loop()
+    except (KeyboardInterrupt, SystemExit):
+        print("==> Interrupted, stopping the running runs...")
+        sweep.stop()
+        raise
+    sweep.summary()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep')
+
+    # Grid configuration.
+    parser.add_argument('--sweep_dir', type=str, required=True, help='dir of the runs and of the sweep state')
+    parser.add_argument('--set', nargs='*', default=[], help='main.py options shared by all runs, e.g. batch_size=16')
+    parser.add_argument('--grid', nargs='*', default=[], help='main.py options to sweep, e.g. num_projections=100,1000')
+
+    # Scheduling configuration.
+    parser.add_argument('--threads_per_run', type=int, default=4, help='cores pinned to each run')
+    parser.add_argument('--cpus', nargs='+', default=None, help='cores to use, defaults to all the available ones')
+    parser.add_argument('--max_parallel', type=int, default=0, help='max runs at a time, 0 to fill the cores')
+    parser.add_argument('--gpus', nargs='+', default=None, help='devices shared round-robin by the slots, e.g. cuda:0 cuda:1')
+    parser.add_argument('--max_retries', type=int, default=1, help='retries of a failed run, from its latest checkpoint')
+    parser.add_argument('--poll_interval', type=float, default=5, help='seconds between checks of the runs')
+    parser.add_argument('--list', action='store_true', help='only print the runs and their status')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
@@ -0,0 +1,37 @@
+import pytest
+
+pytest.importorskip('torch')
+
+from checkpoint import CheckpointManager
+
+
+def save(manager, step):
+    manager.save(step, {}, {'step': step})
+
+
+def test_processes_share_the_index(tmp_path):
+    # Two managers of the same dir stand for a training run and an evaluation.
+    training = CheckpointManager(str(tmp_path))
+    evaluation = CheckpointManager(str(tmp_path))
+    save(training, 10)
+    save(training, 20)
+
+    evaluation.set_score(10, 0.5)
+    save(training, 30)
+    assert training.steps() == [10, 20, 30]
+    assert evaluation.best_step() == 10
+
+    evaluation.set_score(30, 0.25)
+    assert training.best_step() == 30
+    assert training.latest_step() == 30
+
+
+def test_keep_last_keeps_the_best(tmp_path):
+    training = CheckpointManager(str(tmp_path), keep_last=1)
+    evaluation = CheckpointManager(str(tmp_path))
+    save(training, 10)
+    evaluation.set_score(10, 0.5)
+    save(training, 20)
+    save(training, 30)
+    assert training.steps() == [10, 30]
+    assert not (tmp_path / '20-G.ckpt').exists()
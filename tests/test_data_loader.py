@@ -0,0 +1,71 @@
+import collections
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+
+from torch.utils import data
+
+from data_loader import AlternatingLoader, RandomFlip, ResumableSampler, epoch_iter
+
+NUM_IMAGES = 24
+BATCH_SIZE = 4
+
+
+class ToyImages(data.Dataset):
+    """Images which differ from their mirror image, labelled by their index."""
+
+    def __getitem__(self, index):
+        image = torch.arange(3 * 4 * 4, dtype=torch.float32).view(3, 4, 4) + index
+        return image, index
+
+    def __len__(self):
+        return NUM_IMAGES
+
+
+def build_loader(num_workers, seed=7):
+    """Training loader built like get_loader()."""
+    dataset = RandomFlip(ToyImages(), seed)
+    sampler = ResumableSampler(dataset, seed=seed)
+    return data.DataLoader(dataset, batch_size=BATCH_SIZE, sampler=sampler, num_workers=num_workers,
+                           generator=torch.Generator())
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+def test_resumed_batch(num_workers):
+    epoch, batch_index = 1, 3
+    torch.manual_seed(0)
+    batches = list(epoch_iter(build_loader(num_workers), epoch))
+
+    # A new process resuming in the middle of the epoch, with another global RNG state.
+    torch.manual_seed(1)
+    x_resumed, label_resumed = next(epoch_iter(build_loader(num_workers), epoch, batch_index * BATCH_SIZE))
+
+    x_real, label_org = batches[batch_index]
+    assert torch.equal(label_resumed, label_org)
+    assert torch.equal(x_resumed, x_real)
+
+
+def test_random_flips():
+    flipped = []
+    for x, labels in epoch_iter(build_loader(0), 0):
+        for image, label in zip(x, labels):
+            original = ToyImages()[int(label)][0]
+            assert torch.equal(image, original) or torch.equal(image, original.flip(-1))
+            flipped.append(not torch.equal(image, original))
+    assert any(flipped) and not all(flipped)
+
+
+def test_prefetching_leaves_the_global_generator():
+    loaders = collections.OrderedDict([('A', build_loader(0, seed=1)), ('B', build_loader(0, seed=2))])
+    torch.manual_seed(0)
+    state = torch.get_rng_state()
+    alternating = AlternatingLoader(loaders, prefetch=2, max_lag=0)
+    alternating.start()
+    try:
+        names = [alternating.next()[0] for _ in range(4 * NUM_IMAGES // BATCH_SIZE)]
+    finally:
+        alternating.close()
+    assert names == ['A', 'B'] * (2 * NUM_IMAGES // BATCH_SIZE)
+    assert torch.equal(torch.get_rng_state(), state)
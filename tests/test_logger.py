@@ -0,0 +1,62 @@
+import glob
+import os
+import struct
+
+import pytest
+
+from logger import Logger, crc32c, masked_crc32c
+
+SCALARS = [('D/loss_real', 0.5, 10), ('G/loss_fake', -1.25, 10), ('D/loss_real', 0.25, 20)]
+
+
+def write_scalars(log_dir):
+    logger = Logger(str(log_dir), flush_secs=60)
+    for tag, value, step in SCALARS:
+        logger.scalar_summary(tag, value, step)
+    logger.close()
+    paths = glob.glob(os.path.join(str(log_dir), 'events.*'))
+    assert len(paths) == 1
+    return paths[0]
+
+
+def read_records(event_path):
+    """Split a TFRecord file into its records, checking the framing and CRCs."""
+    with open(event_path, 'rb') as file:
+        data = file.read()
+
+    records = []
+    pos = 0
+    while pos < len(data):
+        header = data[pos:pos + 8]
+        length = struct.unpack('<Q', header)[0]
+        assert struct.unpack('<I', data[pos + 8:pos + 12])[0] == masked_crc32c(header)
+        record = data[pos + 12:pos + 12 + length]
+        assert len(record) == length
+        assert struct.unpack('<I', data[pos + 12 + length:pos + 16 + length])[0] == masked_crc32c(record)
+        records.append(record)
+        pos += 16 + length
+    assert pos == len(data)
+    return records
+
+
+def test_crc32c():
+    assert crc32c(b'123456789') == 0xE3069283
+    assert crc32c(b'') == 0
+
+
+def test_records(tmp_path):
+    records = read_records(write_scalars(tmp_path))
+
+    # The file version event, then one event per scalar.
+    assert len(records) == 1 + len(SCALARS)
+    assert b'brain.Event:2' in records[0]
+
+
+def test_read_back(tmp_path):
+    pytest.importorskip('numpy')
+    from utils.file_io import read_scalars
+
+    event_path = write_scalars(tmp_path)
+    scalars, offset = read_scalars(event_path)
+    assert offset == os.path.getsize(event_path)
+    assert [(tag, value, step) for step, tag, value in scalars] == SCALARS
@@ -0,0 +1,140 @@
+"""Tiled translation of images larger than the training size.
+
+The image is split into overlapping tiles of tile_size, which are translated in
+batches of at most max_tiles_per_batch and blended back with a weight window
+that fades out towards the tile borders, so the memory used by the generator does
+not depend on the image resolution.
+
+InstanceNorm must normalize all the tiles the same way, otherwise every tile gets
+its own statistics and the seams show. By default the generator is therefore run
+in eval mode, i.e. with its running stats.
+
+Usage:
+    python tiling.py --model_save_dir stargan_celeba_1/models --test_iters 100000 --c_dim 3 \
+        --image photo.jpg --labels 1 0 1 --out_path photo_translated.png
+"""
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+
+def blend_window(tile_size, overlap, device):
+    """Weights of a tile, ramping linearly from the borders over the overlap.
+
+    Returns:
+        Tensor of shape (1, 1, tile_size, tile_size)
+    """
+    ramp = torch.ones(tile_size, device=device)
+    if overlap > 0:
+        steps = torch.arange(1, overlap + 1, dtype=torch.float32, device=device) / (overlap + 1)
+        ramp[:overlap] = steps
+        ramp[-overlap:] = steps.flip(0)
+    return (ramp.view(-1, 1) * ramp.view(1, -1)).view(1, 1, tile_size, tile_size)
+
+
+def tile_starts(length, tile_size, stride):
+    """Start offsets covering [0, length) with tiles of tile_size; the last tile ends at length."""
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, stride))
+    starts.append(length - tile_size)
+    return starts
+
+
+def translate_tiled(G, x, c, tile_size=128, overlap=32, max_tiles_per_batch=8):
+    """Translate an image of any size tile by tile.
+
+    Args:
+        G(nn.Module): Generator
+        x(tensor): Real image, shape (1, C, H, W), in [-1, 1]
+        c(tensor): Target label, shape (1, c_dim)
+        tile_size(int): Size of the square tiles; must be a multiple of 4
+        overlap(int): Overlap between neighbouring tiles in pixels
+        max_tiles_per_batch(int): Max number of tiles per generator forward
+    Returns:
+        Translated image, shape (1, C, H, W)
+    """
+    assert tile_size % 4 == 0, "tile_size must be a multiple of 4 (G down-samples twice)"
+    assert 0 <= overlap < tile_size // 2, "overlap must be smaller than half the tile size"
+
+    _, channels, height, width = x.size()
+
+    # Images smaller than a tile are padded up to a single tile.
+    pad_h, pad_w = max(0, tile_size - height), max(0, tile_size - width)
+    if pad_h or pad_w:
+        x = F.pad(x, (0, pad_w, 0, pad_h), mode='replicate')
+    padded_height, padded_width = x.size(2), x.size(3)
+
+    stride = tile_size - overlap
+    positions = [(top, left)
+                 for top in tile_starts(padded_height, tile_size, stride)
+                 for left in tile_starts(padded_width, tile_size, stride)]
+
+    window = blend_window(tile_size, overlap, x.device)
+    output = torch.zeros(1, channels, padded_height, padded_width, device=x.device)
+    weights = torch.zeros(1, 1, padded_height, padded_width, device=x.device)
+
+    for i in range(0, len(positions), max_tiles_per_batch):
+        batch_positions = positions[i:i + max_tiles_per_batch]
+        tiles = torch.cat([x[:, :, top:top + tile_size, left:left + tile_size]
+                           for top, left in batch_positions], dim=0)
+        out_tiles = G(tiles, c.expand(tiles.size(0), -1))
+
+        for (top, left), out_tile in zip(batch_positions, out_tiles):
+            output[:, :, top:top + tile_size, left:left + tile_size] += out_tile * window
+            weights[:, :, top:top + tile_size, left:left + tile_size] += window
+
+    output = output / weights
+    return output[:, :, :height, :width]
+
+
+def main(args):
+    from PIL import Image
+    from torchvision import transforms as T
+    from torchvision.utils import save_image
+
+    from inference import instance_stats_copy, load_generator
+
+    device = torch.device(args.device)
+    G = load_generator(args.model_save_dir, args.test_iters, args.g_conv_dim,
+                       args.c_dim, args.g_repeat_num, device)
+    G = G.eval() if args.norm_mode == 'running' else instance_stats_copy(G, inplace=True)
+
+    transform = T.Compose([T.ToTensor(), T.Normalize(mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5))])
+    x = transform(Image.open(args.image).convert('RGB')).unsqueeze(0).to(device)
+    c = torch.tensor([list(map(float, args.labels))], device=device)
+    assert c.size(1) == args.c_dim, "expected {} labels".format(args.c_dim)
+
+    with torch.no_grad():
+        x_fake = translate_tiled(G, x, c, args.tile_size, args.overlap, args.max_tiles_per_batch)
+    save_image(((x_fake + 1) / 2).clamp_(0, 1).cpu(), args.out_path, nrow=1, padding=0)
+    print('Saved the translated image into {}...'.format(args.out_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tiled translation')
+
+    # Model configuration.
+    parser.add_argument('--c_dim', type=int, default=5)
+    parser.add_argument('--g_conv_dim', type=int, default=64)
+    parser.add_argument('--g_repeat_num', type=int, default=6)
+    parser.add_argument('--model_save_dir', type=str, default='stargan/models')
+    parser.add_argument('--test_iters', type=int, default=100000, help='load the model from this step')
+
+    # Tiling configuration.
+    parser.add_argument('--image', type=str, required=True, help='path of the image to translate')
+    parser.add_argument('--labels', nargs='+', required=True, help='target label, e.g. 1 0 1')
+    parser.add_argument('--out_path', type=str, default='translated.png')
+    parser.add_argument('--tile_size', type=int, default=128, help='should match the training image size')
+    parser.add_argument('--overlap', type=int, default=32)
+    parser.add_argument('--max_tiles_per_batch', type=int, default=8)
+    parser.add_argument('--norm_mode', type=str, default='running', choices=['running', 'instance'],
+                        help="InstanceNorm statistics: the running stats shared by all tiles, "
+                             "or the statistics of each tile (may show seams)")
+    parser.add_argument('--device', type=str, default='cpu')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
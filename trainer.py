@@ -1,4 +1,6 @@
+import collections
 import datetime
+import json
 import os
 import time
 
@@ -6,9 +8,18 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision.utils import save_image
 
+from checkpoint import (AsyncCheckpointSaver, CheckpointManager, get_rng_state, load_checkpoint,
+                        set_rng_state, snapshot)
+from data_loader import AlternatingLoader, epoch_iter
+from distributed import all_gather_with_grad, average_gradients, broadcast_model
+from evaluation import (ImageDescriptor, ProjectedSets, RealSetCache, load_results, save_results,
+                        sliced_wasserstein_sorted)
+from image_writer import ImageWriter
+from inference import cached_translate, classify, create_celeba_labels, generate, translate
+from meters import LossMeter
 from model import Discriminator, Generator
+from profiling import PhaseTimer, ProfilerWindow, memory_usage
 from swd import sliced_wasserstein_distance, max_sliced_wasserstein_distance
 
 
@@ -33,6 +44,8 @@ class Trainer(object):
         self.lambda_cls = config.lambda_cls
         self.lambda_rec = config.lambda_rec
         self.lambda_gp = config.lambda_gp
+        self.g_checkpoint_bottleneck = config.g_checkpoint_bottleneck
+        self.g_checkpoint_downsample = config.g_checkpoint_downsample
 
         # Training configurations.
         self.dataset = config.dataset
@@ -45,7 +58,10 @@ class Trainer(object):
         self.beta1 = config.beta1
         self.beta2 = config.beta2
         self.resume_iters = config.resume_iters
+        self.seed = config.seed
         self.selected_attrs = config.selected_attrs
+        self.multi_prefetch = config.multi_prefetch
+        self.multi_max_lag = config.multi_max_lag
 
         # Training configuration for sliced wasserstein loss.
         self.d_criterion = config.d_criterion
@@ -61,22 +77,62 @@ class Trainer(object):
         self.test_iters = config.test_iters
         self.test_type = config.test_type
         self.celeba_image_dir = config.celeba_image_dir
+        self.rafd_image_dir = config.rafd_image_dir
         self.test_img_numbers = config.test_img_numbers
+        self.test_max_batch_size = config.test_max_batch_size
+        self.test_backend = config.test_backend
+        self.celeba_crop_size = config.celeba_crop_size
+        self.result_cache_dir = config.result_cache_dir
+        self.result_cache_size_mb = config.result_cache_size_mb
+        self.result_cache = None
+
+        # Evaluation configurations.
+        self.eval_iters = config.eval_iters
+        self.eval_features = config.eval_features
+        self.eval_swd_size = config.eval_swd_size
+        self.eval_patches_per_image = config.eval_patches_per_image
+        self.eval_num_projections = config.eval_num_projections
+        self.eval_num_images = config.eval_num_images
+        self.eval_cache_dir = config.eval_cache_dir or os.path.join(config.result_dir, 'eval_cache')
+
+        # Distributed training configurations.
+        self.rank = config.rank
+        self.world_size = config.world_size
+        self.is_main_process = self.rank == 0
+        if self.world_size > 1:
+            # Each rank draws its own target labels, gradient penalty weights and SWD
+            # projections. The models are broadcast from rank 0 after being built.
+            self.seed_rank(0)
 
         # Miscellaneous.
-        self.use_tensorboard = config.use_tensorboard
+        self.use_tensorboard = config.use_tensorboard and self.is_main_process
+        self.save_individual_images = config.save_individual_images
+        self.image_writer = ImageWriter(config.num_image_writers, config.max_pending_images)
+        self.checkpoint_saver = AsyncCheckpointSaver()
         if torch.cuda.is_available():
             device_name = config.cuda_device_name if config.cuda_device_name else 'cuda'
+            if self.world_size > 1:
+                device_name = 'cuda:{}'.format(self.rank % torch.cuda.device_count())
             self.device = torch.device(device_name)
         else:
             self.device = torch.device('cpu')
         # self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         print("Init solver on device {}".format(self.device))
 
+        # Profiling.
+        self.dry_run_mode = False
+        self.track_memory = config.track_memory
+        self.timer = PhaseTimer(self.device, config.phase_timers, config.track_memory)
+        self.profile_steps = config.profile_steps
+        self.profile_dir = config.profile_dir or os.path.join(config.log_dir, 'profile')
+        self.dry_run_margin_mb = config.dry_run_margin_mb
+
         # Directories.
         self.log_dir = config.log_dir
         self.sample_dir = config.sample_dir
         self.model_save_dir = config.model_save_dir
+        self.checkpoint_manager = CheckpointManager(self.model_save_dir, config.keep_last_ckpts,
+                                                    config.keep_every_ckpt, config.half_precision_G_ckpt)
         self.result_dir = config.result_dir
         self.progress_dir = config.progress_dir
 
@@ -97,18 +153,34 @@ class Trainer(object):
 
     def build_model(self):
         """Create a generator and a discriminator."""
-        self.G = Generator(self.g_conv_dim, self.c_dim, self.g_repeat_num)
-        self.D = Discriminator(self.image_size, self.d_conv_dim, self.c_dim, self.d_repeat_num,
+        # In joint training, G takes the labels of both datasets and the mask vector, and
+        # D classifies the domains of both datasets.
+        if self.dataset == 'Both':
+            self.g_c_dim = self.c_dim + self.c2_dim + 2
+            d_c_dim = self.c_dim + self.c2_dim
+        else:
+            self.g_c_dim = d_c_dim = self.c_dim
+
+        self.G = Generator(self.g_conv_dim, self.g_c_dim, self.g_repeat_num,
+                           checkpoint_bottleneck=self.g_checkpoint_bottleneck,
+                           checkpoint_downsample=self.g_checkpoint_downsample)
+        self.D = Discriminator(self.image_size, self.d_conv_dim, d_c_dim, self.d_repeat_num,
                                 use_d_feature=self.actual_use_d_feature_flag)
 
         self.g_optimizer = torch.optim.Adam(self.G.parameters(), self.g_lr, [self.beta1, self.beta2])
         self.d_optimizer = torch.optim.Adam(self.D.parameters(), self.d_lr, [self.beta1, self.beta2])
-        self.print_network(self.G, 'G')
-        self.print_network(self.D, 'D')
+        if self.is_main_process:
+            self.print_network(self.G, 'G')
+            self.print_network(self.D, 'D')
         
         self.G.to(self.device)
         self.D.to(self.device)
 
+        # Start all the replicas from the weights of rank 0.
+        if self.world_size > 1:
+            broadcast_model(self.G)
+            broadcast_model(self.D)
+
     def print_network(self, model, name):
         """Print out the network information."""
         num_params = 0
@@ -118,13 +190,65 @@ class Trainer(object):
         print(name)
         print("The number of parameters: {}".format(num_params))
 
-    def restore_model(self, resume_iters):
-        """Restore the trained generator and discriminator."""
+    def restore_model(self, resume_iters, restore_D=True):
+        """Restore the trained generator and, unless restore_D is False (testing), the
+        discriminator. The checkpoints are memory-mapped."""
         print('Loading the trained models from step {}...'.format(resume_iters))
-        G_path = os.path.join(self.model_save_dir, '{}-G.ckpt'.format(resume_iters))
-        D_path = os.path.join(self.model_save_dir, '{}-D.ckpt'.format(resume_iters))
-        self.G.load_state_dict(torch.load(G_path, map_location=lambda storage, loc: storage))
-        self.D.load_state_dict(torch.load(D_path, map_location=lambda storage, loc: storage))
+        G_path = self.checkpoint_manager.G_path(resume_iters)
+        self.G.load_state_dict(load_checkpoint(G_path))
+        if not restore_D:
+            return
+
+        D_path = self.checkpoint_manager.D_path(resume_iters)
+        if os.path.exists(D_path):
+            self.D.load_state_dict(load_checkpoint(D_path))
+        else:
+            # Newer runs only keep D in the training state.
+            state_path = self.checkpoint_manager.state_path(resume_iters)
+            self.D.load_state_dict(load_checkpoint(state_path, weights_only=False)['D'])
+
+    def restore_training_state(self, resume_iters):
+        """Restore the models, optimizers and RNG states saved by save_checkpoints().
+
+        Returns:
+            train_state(dict): The learning rates, data position, fixed debug batch and RNG
+                states to continue the training loop with, or None if only the models of the
+                given step were saved (older runs), in which case only the models are restored
+        """
+        state_path = self.checkpoint_manager.state_path(resume_iters)
+        if not os.path.exists(state_path):
+            self.restore_model(resume_iters)
+            return None
+
+        print('Loading the training state from step {}...'.format(resume_iters))
+        state = load_checkpoint(state_path, weights_only=False)
+        self.G.load_state_dict(state['G'])
+        self.D.load_state_dict(state['D'])
+        self.g_optimizer.load_state_dict(state['g_optimizer'])
+        self.d_optimizer.load_state_dict(state['d_optimizer'])
+
+        train_state = state['train_state']
+        train_state['rng'] = state['rng']
+        train_state['x_fixed'] = train_state['x_fixed'].to(self.device)
+        train_state['c_fixed_list'] = [c_fixed.to(self.device) for c_fixed in train_state['c_fixed_list']]
+        return train_state
+
+    def seed_rank(self, step):
+        """Seed the torch and numpy generators of this rank for training from step on,
+        with a different seed for each rank and step."""
+        seed = self.seed + step * self.world_size + self.rank
+        torch.manual_seed(seed)
+        np.random.seed(seed % 2**32)
+
+    def restore_rng_state(self, rng_state, resume_iters):
+        """Restore the RNG states of a training state.
+
+        Only rank 0 saves its RNG states, while the generators must differ across
+        ranks, so in distributed training they are reseeded instead.
+        """
+        set_rng_state(rng_state, restore_torch=self.world_size == 1)
+        if self.world_size > 1:
+            self.seed_rank(resume_iters)
 
     def build_tensorboard(self):
         """Build a tensorboard logger."""
@@ -132,10 +256,15 @@ class Trainer(object):
         self.logger = Logger(self.log_dir)
     
     def build_event_logger(self):
-        """Build an event logger."""
+        """Build an event logger. Only rank 0 logs in distributed training."""
+        import logging
         from logger import EventLogger
-        event_path = self.progress_dir + "/progress.log"
-        self.event_logger = EventLogger('training', event_path)
+        if self.is_main_process:
+            event_path = self.progress_dir + "/progress.log"
+            self.event_logger = EventLogger('training', event_path)
+        else:
+            self.event_logger = EventLogger('training-rank{}'.format(self.rank), None,
+                                            level=logging.WARNING)
 
     def update_lr(self, g_lr, d_lr):
         """Decay learning rates of the generator and discriminator."""
@@ -149,6 +278,21 @@ class Trainer(object):
         self.g_optimizer.zero_grad()
         self.d_optimizer.zero_grad()
 
+    def sync_grad(self, model):
+        """Average the gradients of the model across ranks in distributed training."""
+        if self.world_size > 1:
+            average_gradients(model)
+
+    def backward_and_step(self, loss, model, optimizer, name):
+        """Backpropagate the loss, average the gradients across ranks and update the model.
+        The two stages are timed as the phases '{name}/backward' and '{name}/step'."""
+        with self.timer.scope('{}/backward'.format(name)):
+            self.reset_grad()
+            loss.backward()
+            self.sync_grad(model)
+        with self.timer.scope('{}/step'.format(name)):
+            optimizer.step()
+
     def denorm(self, x):
         """Convert the range from [-1, 1] to [0, 1]."""
         out = (x + 1) / 2
@@ -156,7 +300,7 @@ class Trainer(object):
 
     def gradient_penalty(self, y, x):
         """Compute gradient penalty: (L2_norm(dy/dx) - 1)**2."""
-        weight = torch.ones(y.size()).to(self.device)
+        weight = torch.ones_like(y)
         dydx = torch.autograd.grad(outputs=y,
                                    inputs=x,
                                    grad_outputs=weight,
@@ -169,38 +313,59 @@ class Trainer(object):
         return torch.mean((dydx_l2norm-1)**2)
 
     def label2onehot(self, labels, dim):
-        """Convert label indices to one-hot vectors."""
-        batch_size = labels.size(0)
-        out = torch.zeros(batch_size, dim)
-        out[np.arange(batch_size), labels.long()] = 1
-        return out
+        """Convert label indices to one-hot vectors, on the device of the labels."""
+        return F.one_hot(labels.long(), dim).float()
+
+    def mask_labels(self, c, dataset):
+        """In joint training, pad the domain labels c of a dataset with zeros for the other
+        dataset and append the mask vector, i.e. the one-hot index of the dataset, so that
+        G only attends to the labels of the dataset. Otherwise, return c.
+
+        Args:
+            c(tensor): Domain labels, shape (N, c_dim) for CelebA or (N, c2_dim) for RaFD
+            dataset(str): 'CelebA' or 'RaFD'
+        """
+        if self.dataset != 'Both':
+            return c
+
+        num_samples = c.size(0)
+        if dataset == 'CelebA':
+            labels = [c, torch.zeros(num_samples, self.c2_dim, device=c.device)]
+            dataset_index = 0
+        elif dataset == 'RaFD':
+            labels = [torch.zeros(num_samples, self.c_dim, device=c.device), c]
+            dataset_index = 1
+        mask = self.label2onehot(torch.full((num_samples,), dataset_index, dtype=torch.long, device=c.device), 2)
+        return torch.cat(labels + [mask], dim=1)
+
+    def select_logits(self, out_cls, dataset):
+        """Keep the classification logits of the dataset of a batch. In joint training, D
+        classifies the CelebA attributes and the RaFD expressions with a single head."""
+        if self.dataset != 'Both':
+            return out_cls
+        return out_cls[:, :self.c_dim] if dataset == 'CelebA' else out_cls[:, self.c_dim:]
 
     def create_labels(self, c_org, c_dim=5, dataset='CelebA', selected_attrs=None):
         """Generate target domain labels for debugging and testing."""
-        # Get hair color indices.
+        # Copy the labels to the device once and derive the targets there.
+        c_org = c_org.to(self.device)
+
         if dataset == 'CelebA':
-            hair_color_indices = []
-            for i, attr_name in enumerate(selected_attrs):
-                if attr_name in ['Black_Hair', 'Blond_Hair', 'Brown_Hair', 'Gray_Hair']:
-                    hair_color_indices.append(i)
+            return create_celeba_labels(c_org, selected_attrs)
 
         c_trg_list = []
         for i in range(c_dim):
-            if dataset == 'CelebA':
-                c_trg = c_org.clone()
-                if i in hair_color_indices:  # Set one hair color to 1 and the rest to 0.
-                    c_trg[:, i] = 1
-                    for j in hair_color_indices:
-                        if j != i:
-                            c_trg[:, j] = 0
-                else:
-                    c_trg[:, i] = (c_trg[:, i] == 0)  # Reverse attribute value.
-            elif dataset == 'RaFD':
-                c_trg = self.label2onehot(torch.ones(c_org.size(0))*i, c_dim)
-
-            c_trg_list.append(c_trg.to(self.device))
+            c_trg_list.append(self.label2onehot(torch.full((c_org.size(0),), i, dtype=torch.long, device=self.device), c_dim))
         return c_trg_list
 
+    def create_multi_labels(self, c_org):
+        """Generate the target labels of all the CelebA and RaFD domains for CelebA images,
+        for debugging and testing joint training."""
+        c_celeba_list = self.create_labels(c_org, self.c_dim, 'CelebA', self.selected_attrs)
+        c_rafd_list = self.create_labels(c_org, self.c2_dim, 'RaFD')
+        return ([self.mask_labels(c_trg, 'CelebA') for c_trg in c_celeba_list] +
+                [self.mask_labels(c_trg, 'RaFD') for c_trg in c_rafd_list])
+
     def classification_loss(self, logit, target, dataset='CelebA'):
         """Compute binary or softmax cross entropy loss.
         
@@ -213,25 +378,100 @@ class Trainer(object):
         elif dataset == 'RaFD':
             return F.cross_entropy(logit, target)
 
-    def log_training_info(self, et, loss, step):
+    def log_training_info(self, et, loss, step, phases=None):
         """Helper function for training - Print out training information and 
         save the info to file. Add summary to tensorboard if enabled.
 
         Args:
             et: Elasped time of the current training step from the start time
-            loss(dict): Dictionary containing loss of the generator and discriminator
+            loss(dict): Dictionary containing the mean, min and max loss of the
+                generator and discriminator over the log window
             step(int): Currrent iteration step
+            phases(dict): Time per iteration of each training phase over the log
+                window, as returned by PhaseTimer.summarize()
         """
         et = str(datetime.timedelta(seconds=et))[:-7]
         info = "Elapsed [{}], Iteration [{}/{}]".format(et, step+1, self.num_iters)
-        for tag, value in loss.items():
-            info += ", {}: {:.4f}".format(tag, value)
+        for tag, stats in loss.items():
+            info += ", {}: {:.4f} [{:.4f}, {:.4f}]".format(tag, stats['mean'], stats['min'], stats['max'])
 
         self.event_logger.log(info)
+        if phases:
+            self.event_logger.log("Phases (ms/iter): " + ", ".join(
+                "{}: {:.2f}".format(name, timing['ms_per_iter']) for name, timing in phases.items()))
+
+        memory = None
+        if self.track_memory:
+            memory = self.window_memory(phases or {})
+            self.event_logger.log("Memory (MB): " + ", ".join(
+                "{}: {:.0f}".format(key[:-len('_mb')], value) for key, value in memory.items()))
 
         if self.use_tensorboard:
-            for tag, value in loss.items():
-                self.logger.scalar_summary(tag, value, step+1)
+            for tag, stats in loss.items():
+                self.logger.scalar_summary(tag, stats['mean'], step+1)
+            for name, timing in (phases or {}).items():
+                self.logger.scalar_summary('time/' + name, timing['ms_per_iter'], step+1)
+            for key, value in (memory or {}).items():
+                self.logger.scalar_summary('memory/' + key, value, step+1)
+
+    def window_memory(self, phases):
+        """Memory usage over a log window: the current and peak RSS, the max RSS and peak
+        CUDA memory of each phase, and the current CUDA memory.
+
+        Args:
+            phases(dict): Phases returned by PhaseTimer.summarize() with memory tracking
+        """
+        usage = memory_usage(self.device)
+        memory = {'rss_mb': usage['rss_mb'], 'peak_rss_mb': usage['peak_rss_mb']}
+        if 'cuda_allocated_mb' in usage:
+            memory['cuda_allocated_mb'] = usage['cuda_allocated_mb']
+            memory['cuda_reserved_mb'] = usage['cuda_reserved_mb']
+        for name, phase in phases.items():
+            if 'peak_cuda_mb' in phase:
+                memory['{}/peak_cuda_mb'.format(name)] = phase['peak_cuda_mb']
+            if 'rss_mb' in phase:
+                memory['{}/rss_mb'.format(name)] = phase['rss_mb']
+        return memory
+
+    def domain_names(self):
+        """Names of the target domains, in the order of the labels of create_labels() or
+        create_multi_labels(): the selected CelebA attributes and the RaFD expressions,
+        i.e. the class folders of rafd_image_dir."""
+        names = []
+        if self.dataset in ['CelebA', 'Both']:
+            names += list(self.selected_attrs)
+        if self.dataset in ['RaFD', 'Both']:
+            c_dim = self.c2_dim if self.dataset == 'Both' else self.c_dim
+            classes = []
+            if os.path.isdir(self.rafd_image_dir):
+                classes = sorted(entry.name for entry in os.scandir(self.rafd_image_dir) if entry.is_dir())
+            if len(classes) != c_dim:
+                classes = ['domain{}'.format(k) for k in range(c_dim)]
+            names += classes
+        return names
+
+    def save_translations(self, x_fake_list, path):
+        """Queue the grid of real and translated images for writing. If save_individual_images
+        is enabled, each image is also written on its own as '{path}-{sample}-{domain}.jpg',
+        where domain is 'real' or a name from domain_names().
+
+        Args:
+            x_fake_list(list<tensor>): Real images followed by the translated images of
+                each target domain, each item's shape = (N, C, H, W)
+            path(str): Path of the grid
+        """
+        # A single copy to the host, which the individual images are views of.
+        x_concat = self.denorm(torch.cat(x_fake_list, dim=3).detach()).cpu()
+        self.image_writer.submit(x_concat, path, nrow=1, padding=0)
+
+        if self.save_individual_images:
+            root, ext = os.path.splitext(path)
+            names = ['real'] + self.domain_names()
+            width = x_fake_list[0].size(3)
+            for k, name in enumerate(names[:len(x_fake_list)]):
+                x = x_concat[:, :, :, k * width:(k + 1) * width]
+                for j in range(x.size(0)):
+                    self.image_writer.submit(x[j], '{}-{}-{}{}'.format(root, j+1, name, ext))
 
     def translate_samples(self, step, x_fixed, c_fixed_list):
         """Helper function for training - Translate fixed images for debugging.
@@ -246,60 +486,82 @@ class Trainer(object):
             limit = x_fixed.size(0) if x_fixed.size(0) < 16 else 16
 
             x_fixed = x_fixed[:limit, :, :, :]
-            x_fake_list = [x_fixed]
-            for c_fixed in c_fixed_list:
-                x_fake_list.append(self.G(x_fixed, c_fixed[:limit, :]))
-            
-            x_concat = torch.cat(x_fake_list, dim=3)
+            c_fixed_list = [c_fixed[:limit, :] for c_fixed in c_fixed_list]
+            x_fake_list = [x_fixed] + translate(self.G, x_fixed, c_fixed_list, self.test_max_batch_size)
+            if self.dry_run_mode:
+                return
+
             sample_path = os.path.join(self.sample_dir, '{}-images.jpg'.format(step + 1))
-            save_image(self.denorm(x_concat.data.cpu()), sample_path, nrow=1, padding=0)
+            self.save_translations(x_fake_list, sample_path)
             info = 'Saved real and fake images into {}...'.format(sample_path)
             self.event_logger.log(info)
     
-    def translate_samples_multi(self, step, x_fixed, c_celeba_list, c_rafd_list,
-                                zero_rafd, zero_celeba, mask_celeba, mask_rafd):
-        """Helper function for training - Translate fixed images for debugging.
-        
+    def prepare_batch(self, x_real, label_org, dataset):
+        """Helper function for training - Copy a batch to the device, draw random target
+        domains and build the domain labels on the device.
+
         Args:
-            step(int): Currrent iteration step
-            x_fixed(tensor): Real images, shape (N, C, H, W)
-            c_celeba_list, c_rafd_list(list<tensor>): Target labels, each item's shape = (N, c_dim)
-            zero_rafd, zero_celeba(tensor): shape (N, c_dim)
-            mask_celeba, mask_rafd(tensor): shape (N, c_dim)
+            x_real(tensor): Input images
+            label_org(tensor): Attribute labels (CelebA) or expression indices (RaFD)
+            dataset(str): Dataset of the batch, 'CelebA' or 'RaFD'
+        Returns:
+            data(dict): Data for the training methods, see _train_D_wasserstein_GP()
         """
-        with torch.no_grad():
-            # Control the number of sampled used
-            limit = x_fixed.size(0) if x_fixed.size(0) < 16 else 16
+        # Copies from pinned memory do not block the host.
+        x_real = x_real.to(self.device, non_blocking=True)           # Input images.
+        label_org = label_org.to(self.device, non_blocking=True)     # Labels for computing classification loss.
 
-            x_fixed = x_fixed[:limit, :, :, :]
-            x_fake_list = [x_fixed]
-            for c_fixed in c_celeba_list:
-                c_trg = torch.cat(
-                    [c_fixed[:limit, :], zero_rafd[:limit, :], mask_celeba[:limit, :]], 
-                    dim=1
-                )
-                x_fake_list.append(self.G(x_fixed, c_trg))
-            for c_fixed in c_rafd_list:
-                c_trg = torch.cat(
-                    [zero_celeba[:limit, :], c_fixed[:limit, :], mask_rafd[:limit, :]], 
-                    dim=1
-                )
-                x_fake_list.append(self.G(x_fixed, c_trg))
-            
-            x_concat = torch.cat(x_fake_list, dim=3)
-            sample_path = os.path.join(self.sample_dir, '{}-images.jpg'.format(step + 1))
-            save_image(self.denorm(x_concat.data.cpu()), sample_path, nrow=1, padding=0)
-            info = 'Saved real and fake images into {}...'.format(sample_path)
+        # Generate target domain labels randomly.
+        rand_idx = torch.randperm(label_org.size(0), device=self.device)
+        label_trg = label_org[rand_idx]                               # Labels for computing classification loss.
+
+        if dataset == 'CelebA':
+            c_org = label_org.clone()
+            c_trg = label_trg.clone()
+        elif dataset == 'RaFD':
+            c_dim = self.c2_dim if self.dataset == 'Both' else self.c_dim
+            c_org = self.label2onehot(label_org, c_dim)
+            c_trg = self.label2onehot(label_trg, c_dim)
+
+        return {
+            'dataset': dataset,
+            'x_real': x_real,
+            'c_org': self.mask_labels(c_org, dataset),                # Original domain labels.
+            'c_trg': self.mask_labels(c_trg, dataset),                # Target domain labels.
+            'label_org': label_org,
+            'label_trg': label_trg
+        }
+
+    def save_checkpoints(self, step, train_state):
+        """Helper function for training - Save the generator for testing and the full
+        training state for resuming.
+
+        The state is copied to the CPU here and written by a background thread through
+        the checkpoint manager, so training continues while it is written.
+
+        Args:
+            step(int): Currrent iteration step
+            train_state(dict): Learning rates, data position and fixed debug batch of
+                the training loop
+        """
+        state = snapshot({
+            'iteration': step + 1,
+            'G': self.G.state_dict(),
+            'D': self.D.state_dict(),
+            'g_optimizer': self.g_optimizer.state_dict(),
+            'd_optimizer': self.d_optimizer.state_dict(),
+            'rng': get_rng_state(),
+            'train_state': train_state
+        })
+        if self.dry_run_mode:
+            return
+
+        def save():
+            self.checkpoint_manager.save(step + 1, state['G'], state)
+            info = 'Saved model checkpoints into {}...'.format(self.model_save_dir)
             self.event_logger.log(info)
-    
-    def save_checkpoints(self, step):
-        """Helper function for training - Save model checkpoints."""
-        G_path = os.path.join(self.model_save_dir, '{}-G.ckpt'.format(step + 1))
-        D_path = os.path.join(self.model_save_dir, '{}-D.ckpt'.format(step + 1))
-        torch.save(self.G.state_dict(), G_path)
-        torch.save(self.D.state_dict(), D_path)
-        info = 'Saved model checkpoints into {}...'.format(self.model_save_dir)
-        self.event_logger.log(info)
+
+        self.checkpoint_saver.save(save)
     
     def decay_learning_rates(self, g_lr, d_lr):
         """Helper function for training - Decay learning rates."""
@@ -318,13 +580,14 @@ class Trainer(object):
         
         Args:
             data(dict): Dict containing image and label data, namely:
+                dataset(str): Dataset of the batch, 'CelebA' or 'RaFD'
                 x_real(tensor): Input images
                 c_org(tensor):
                 c_trg(tensor): Target domain labels
                 label_org(tensor): Labels for computing classification loss
                 label_trg(tensor): Labels for computing classification loss
         Returns:
-            loss(dict): Dict containing loss of the current step for tensorboard logging
+            loss(dict): Dict containing the detached loss tensors of the current step for logging
         """
 
         # Unpack the data
@@ -332,41 +595,42 @@ class Trainer(object):
         c_trg = data['c_trg']
         label_org = data['label_org']
 
-        # Compute loss with real images.
-        outputs = self.D(x_real)            # len will be either 2 or 3
-        out_src, out_cls = outputs[0], outputs[1]
+        with self.timer.scope('D/forward'):
+            # Compute loss with real images.
+            outputs = self.D(x_real)            # len will be either 2 or 3
+            out_src, out_cls = outputs[0], outputs[1]
 
-        d_loss_real = - torch.mean(out_src)
-        d_loss_cls = self.classification_loss(out_cls, label_org, self.dataset)
+            d_loss_real = - torch.mean(out_src)
+            d_loss_cls = self.classification_loss(self.select_logits(out_cls, data['dataset']), label_org,
+                                                  data['dataset'])
 
-        # Compute loss with fake images.
-        x_fake = self.G(x_real, c_trg)
-        outputs = self.D(x_fake.detach())
-        out_src, out_cls = outputs[0], outputs[1]
+            # Compute loss with fake images.
+            x_fake = self.G(x_real, c_trg)
+            outputs = self.D(x_fake.detach())
+            out_src, out_cls = outputs[0], outputs[1]
 
-        d_loss_fake = torch.mean(out_src)
+            d_loss_fake = torch.mean(out_src)
 
         # Compute loss for gradient penalty.
-        alpha = torch.rand(x_real.size(0), 1, 1, 1).to(self.device)
-        x_hat = (alpha * x_real.data + (1 - alpha) * x_fake.data).requires_grad_(True)
-        
-        outputs = self.D(x_hat)         # len will be either 2 or 3
-        out_src = outputs[0]
-        
-        d_loss_gp = self.gradient_penalty(out_src, x_hat)
+        with self.timer.scope('D/gradient_penalty'):
+            alpha = torch.rand(x_real.size(0), 1, 1, 1, device=self.device)
+            x_hat = (alpha * x_real.data + (1 - alpha) * x_fake.data).requires_grad_(True)
+
+            outputs = self.D(x_hat)         # len will be either 2 or 3
+            out_src = outputs[0]
+
+            d_loss_gp = self.gradient_penalty(out_src, x_hat)
 
         # Backward and optimize.
         d_loss = d_loss_real + d_loss_fake + self.lambda_cls * d_loss_cls + self.lambda_gp * d_loss_gp
-        self.reset_grad()
-        d_loss.backward()
-        self.d_optimizer.step()
+        self.backward_and_step(d_loss, self.D, self.d_optimizer, 'D')
 
         # Logging.
         loss = {}
-        loss['D/loss_real'] = d_loss_real.item()
-        loss['D/loss_fake'] = d_loss_fake.item()
-        loss['D/loss_cls'] = d_loss_cls.item()
-        loss['D/loss_gp'] = d_loss_gp.item()
+        loss['D/loss_real'] = d_loss_real.detach()
+        loss['D/loss_fake'] = d_loss_fake.detach()
+        loss['D/loss_cls'] = d_loss_cls.detach()
+        loss['D/loss_gp'] = d_loss_gp.detach()
 
         return loss
     
@@ -382,27 +646,27 @@ class Trainer(object):
         c_trg = data['c_trg']
         label_trg = data['label_trg']
 
-        # Original-to-target domain.
-        x_fake = self.G(x_real, c_trg)
-        out_src, out_cls = self.D(x_fake)
-        g_loss_fake = - torch.mean(out_src)
-        g_loss_cls = self.classification_loss(out_cls, label_trg, self.dataset)
+        with self.timer.scope('G/forward'):
+            # Original-to-target domain.
+            x_fake = self.G(x_real, c_trg)
+            out_src, out_cls = self.D(x_fake)
+            g_loss_fake = - torch.mean(out_src)
+            g_loss_cls = self.classification_loss(self.select_logits(out_cls, data['dataset']), label_trg,
+                                                  data['dataset'])
 
-        # Target-to-original domain.
-        x_reconst = self.G(x_fake, c_org)
-        g_loss_rec = torch.mean(torch.abs(x_real - x_reconst))
+            # Target-to-original domain.
+            x_reconst = self.G(x_fake, c_org)
+            g_loss_rec = torch.mean(torch.abs(x_real - x_reconst))
 
         # Backward and optimize.
         g_loss = g_loss_fake + self.lambda_rec * g_loss_rec + self.lambda_cls * g_loss_cls
-        self.reset_grad()
-        g_loss.backward()
-        self.g_optimizer.step()
+        self.backward_and_step(g_loss, self.G, self.g_optimizer, 'G')
 
         # Logging.
         loss = {}
-        loss['G/loss_fake'] = g_loss_fake.item()
-        loss['G/loss_rec'] = g_loss_rec.item()
-        loss['G/loss_cls'] = g_loss_cls.item()
+        loss['G/loss_fake'] = g_loss_fake.detach()
+        loss['G/loss_rec'] = g_loss_rec.detach()
+        loss['G/loss_cls'] = g_loss_cls.detach()
         
         return loss
     
@@ -416,35 +680,35 @@ class Trainer(object):
         c_trg = data['c_trg']
         label_org = data['label_org']
         
-        # Compute loss with real images
-        outputs = self.D(x_real)
-        assert ((len(outputs) == 3 and self.actual_use_d_feature_flag) or 
-            (len(outputs) == 2 and not self.actual_use_d_feature_flag)), print(len(outputs))
-        
-        out_src, out_cls = outputs[0], outputs[1]
-        d_loss_real = F.binary_cross_entropy_with_logits(out_src, torch.ones_like(out_src))
-        d_loss_cls = self.classification_loss(out_cls, label_org, self.dataset)
-
-        # Compute loss with fake images
-        x_fake = self.G(x_real, c_trg)
-        outputs = self.D(x_fake.detach())
-        assert ((len(outputs) == 3 and self.actual_use_d_feature_flag) or 
-            (len(outputs) == 2 and not self.actual_use_d_feature_flag)), print(len(outputs))
-        
-        out_src, out_cls = outputs[0], outputs[1]
-        d_loss_fake = F.binary_cross_entropy_with_logits(out_src, torch.zeros_like(out_src))
+        with self.timer.scope('D/forward'):
+            # Compute loss with real images
+            outputs = self.D(x_real)
+            assert ((len(outputs) == 3 and self.actual_use_d_feature_flag) or
+                (len(outputs) == 2 and not self.actual_use_d_feature_flag)), print(len(outputs))
+
+            out_src, out_cls = outputs[0], outputs[1]
+            d_loss_real = F.binary_cross_entropy_with_logits(out_src, torch.ones_like(out_src))
+            d_loss_cls = self.classification_loss(self.select_logits(out_cls, data['dataset']), label_org,
+                                                  data['dataset'])
+
+            # Compute loss with fake images
+            x_fake = self.G(x_real, c_trg)
+            outputs = self.D(x_fake.detach())
+            assert ((len(outputs) == 3 and self.actual_use_d_feature_flag) or
+                (len(outputs) == 2 and not self.actual_use_d_feature_flag)), print(len(outputs))
+
+            out_src, out_cls = outputs[0], outputs[1]
+            d_loss_fake = F.binary_cross_entropy_with_logits(out_src, torch.zeros_like(out_src))
 
         # Backward and optimize.
         d_loss = d_loss_real + d_loss_fake + self.lambda_cls * d_loss_cls
-        self.reset_grad()
-        d_loss.backward()
-        self.d_optimizer.step()
+        self.backward_and_step(d_loss, self.D, self.d_optimizer, 'D')
 
         # Logging.
         loss = {}
-        loss['D/loss_real'] = d_loss_real.item()
-        loss['D/loss_fake'] = d_loss_fake.item()
-        loss['D/loss_cls'] = d_loss_cls.item()
+        loss['D/loss_real'] = d_loss_real.detach()
+        loss['D/loss_fake'] = d_loss_fake.detach()
+        loss['D/loss_cls'] = d_loss_cls.detach()
 
         return loss
     
@@ -461,46 +725,50 @@ class Trainer(object):
         c_trg = data['c_trg']
         label_trg = data['label_trg']
         
-        # Original-to-target domain
-        x_fake = self.G(x_real, c_trg)
-        num_samples = x_real.shape[0]
-
-        outputs = self.D(x_fake)
-
-        if self.use_d_feature:
-            assert len(outputs) == 3
-            out_src, out_cls, h_fake = outputs
-            _, _, h_real = self.D(x_real)
-
-            g_loss_fake = sliced_wasserstein_distance(
-                h_real.view(num_samples, -1), h_fake.view(num_samples, -1),
-                self.num_projections, self.device
-            )
-        else:
-            assert len(outputs) == 2
-            out_src, out_cls = outputs
-            g_loss_fake = sliced_wasserstein_distance(
-                x_real.view(num_samples, -1), x_fake.view(num_samples, -1),
-                self.num_projections, self.device
-            )
-        
-        g_loss_cls = self.classification_loss(out_cls, label_trg, self.dataset)
-        
-        # Target-to-original domain.
-        x_reconst = self.G(x_fake, c_org)
-        g_loss_rec = torch.mean(torch.abs(x_real - x_reconst))
+        with self.timer.scope('G/forward'):
+            # Original-to-target domain
+            x_fake = self.G(x_real, c_trg)
+            num_samples = x_real.shape[0]
+
+            outputs = self.D(x_fake)
+
+            if self.use_d_feature:
+                assert len(outputs) == 3
+                out_src, out_cls, h_fake = outputs
+                _, _, h_real = self.D(x_real)
+
+                with self.timer.scope('G/swd'):
+                    g_loss_fake = sliced_wasserstein_distance(
+                        all_gather_with_grad(h_real.view(num_samples, -1)),
+                        all_gather_with_grad(h_fake.view(num_samples, -1)),
+                        self.num_projections, self.device
+                    )
+            else:
+                assert len(outputs) == 2
+                out_src, out_cls = outputs
+                with self.timer.scope('G/swd'):
+                    g_loss_fake = sliced_wasserstein_distance(
+                        all_gather_with_grad(x_real.view(num_samples, -1)),
+                        all_gather_with_grad(x_fake.view(num_samples, -1)),
+                        self.num_projections, self.device
+                    )
+
+            g_loss_cls = self.classification_loss(self.select_logits(out_cls, data['dataset']), label_trg,
+                                                  data['dataset'])
+
+            # Target-to-original domain.
+            x_reconst = self.G(x_fake, c_org)
+            g_loss_rec = torch.mean(torch.abs(x_real - x_reconst))
 
         # Backward and optimize.
         g_loss = g_loss_fake + self.lambda_rec * g_loss_rec + self.lambda_cls * g_loss_cls
-        self.reset_grad()
-        g_loss.backward()
-        self.g_optimizer.step()
+        self.backward_and_step(g_loss, self.G, self.g_optimizer, 'G')
 
         # Logging.
         loss = {}
-        loss['G/loss_fake'] = g_loss_fake.item()
-        loss['G/loss_rec'] = g_loss_rec.item()
-        loss['G/loss_cls'] = g_loss_cls.item()
+        loss['G/loss_fake'] = g_loss_fake.detach()
+        loss['G/loss_rec'] = g_loss_rec.detach()
+        loss['G/loss_cls'] = g_loss_cls.detach()
 
         return loss
     
@@ -514,54 +782,56 @@ class Trainer(object):
         c_trg = data['c_trg']
         label_trg = data['label_trg']
 
-        # Original-to-target domain
-        x_fake = self.G(x_real, c_trg)
-        num_samples = x_real.shape[0]
-
-        outputs = self.D(x_fake)
-        assert len(outputs) == 3        # We must use D's feature in this case
-        
-        if not self.sort_scalar:
-            out_src, out_cls, projected_fake = outputs
-            _, _, projected_real = self.D(x_real)
-
-            # Pass output of D's penultimate layer to max swd (sort vector)
-            g_loss_fake = max_sliced_wasserstein_distance(
-                projected_real.view(num_samples, -1), 
-                projected_fake.view(num_samples, -1),
-                self.device
-            )
-
-        else:
-            out_src_real, out_cls, projected_fake = outputs
-            out_src_fake, _, _ = self.D(x_real)
-
-            # Pass out_src of D's last layer to max swd (sort scalar)
-            # According to the paper, we just need 1 projection direction
-            # NOTE: transform out_src (N, 1, 1, 1) to (N, 1)
-            g_loss_fake = max_sliced_wasserstein_distance(
-                out_src_real.view(num_samples, -1), 
-                out_src_fake.view(num_samples, -1),
-                self.device
-            )
-
-        g_loss_cls = self.classification_loss(out_cls, label_trg, self.dataset)
-
-        # Target-to-original domain.
-        x_reconst = self.G(x_fake, c_org)
-        g_loss_rec = torch.mean(torch.abs(x_real - x_reconst))
+        with self.timer.scope('G/forward'):
+            # Original-to-target domain
+            x_fake = self.G(x_real, c_trg)
+            num_samples = x_real.shape[0]
+
+            outputs = self.D(x_fake)
+            assert len(outputs) == 3        # We must use D's feature in this case
+
+            if not self.sort_scalar:
+                out_src, out_cls, projected_fake = outputs
+                _, _, projected_real = self.D(x_real)
+
+                # Pass output of D's penultimate layer to max swd (sort vector)
+                with self.timer.scope('G/swd'):
+                    g_loss_fake = max_sliced_wasserstein_distance(
+                        all_gather_with_grad(projected_real.view(num_samples, -1)),
+                        all_gather_with_grad(projected_fake.view(num_samples, -1)),
+                        self.device
+                    )
+
+            else:
+                out_src_real, out_cls, projected_fake = outputs
+                out_src_fake, _, _ = self.D(x_real)
+
+                # Pass out_src of D's last layer to max swd (sort scalar)
+                # According to the paper, we just need 1 projection direction
+                # NOTE: transform out_src (N, 1, 1, 1) to (N, 1)
+                with self.timer.scope('G/swd'):
+                    g_loss_fake = max_sliced_wasserstein_distance(
+                        all_gather_with_grad(out_src_real.view(num_samples, -1)),
+                        all_gather_with_grad(out_src_fake.view(num_samples, -1)),
+                        self.device
+                    )
+
+            g_loss_cls = self.classification_loss(self.select_logits(out_cls, data['dataset']), label_trg,
+                                                  data['dataset'])
+
+            # Target-to-original domain.
+            x_reconst = self.G(x_fake, c_org)
+            g_loss_rec = torch.mean(torch.abs(x_real - x_reconst))
 
         # Backward and optimize.
         g_loss = g_loss_fake + self.lambda_rec * g_loss_rec + self.lambda_cls * g_loss_cls
-        self.reset_grad()
-        g_loss.backward()
-        self.g_optimizer.step()
+        self.backward_and_step(g_loss, self.G, self.g_optimizer, 'G')
 
         # Logging.
         loss = {}
-        loss['G/loss_fake'] = g_loss_fake.item()
-        loss['G/loss_rec'] = g_loss_rec.item()
-        loss['G/loss_cls'] = g_loss_cls.item()
+        loss['G/loss_fake'] = g_loss_fake.detach()
+        loss['G/loss_rec'] = g_loss_rec.detach()
+        loss['G/loss_cls'] = g_loss_cls.detach()
 
         return loss
 
@@ -617,21 +887,35 @@ class Trainer(object):
         elif self.dataset == 'RaFD':
             data_loader = self.rafd_loader
 
-        # Fetch fixed inputs for debugging.
-        data_iter = iter(data_loader)
-        x_fixed, c_org = next(data_iter)
-        x_fixed = x_fixed.to(self.device)
-        c_fixed_list = self.create_labels(c_org, self.c_dim, self.dataset, self.selected_attrs)
-
-        # Learning rate cache for decaying.
-        g_lr = self.g_lr
-        d_lr = self.d_lr
-
         # Start training from scratch or resume training.
         start_iters = 0
+        train_state = None
         if self.resume_iters:
+            self.resume_iters = self.checkpoint_manager.resolve_step(self.resume_iters)
             start_iters = self.resume_iters
-            self.restore_model(self.resume_iters)
+            train_state = self.restore_training_state(self.resume_iters)
+
+        # The data order only depends on the seed and the epoch; each rank gets a different
+        # shard of the data. Resumed runs continue the epoch where the checkpoint was saved.
+        epoch = batch_index = 0
+        if train_state is not None:
+            epoch, batch_index = train_state['epoch'], train_state['batch_index']
+        data_iter = epoch_iter(data_loader, epoch, batch_index * self.batch_size)
+
+        if train_state is not None:
+            self.restore_rng_state(train_state['rng'], self.resume_iters)
+            x_fixed, c_fixed_list = train_state['x_fixed'], train_state['c_fixed_list']
+            g_lr, d_lr = train_state['g_lr'], train_state['d_lr']
+        else:
+            # Fetch fixed inputs for debugging.
+            x_fixed, c_org = next(data_iter)
+            batch_index += 1
+            x_fixed = x_fixed.to(self.device)
+            c_fixed_list = self.create_labels(c_org, self.c_dim, self.dataset, self.selected_attrs)
+
+            # Learning rate cache for decaying.
+            g_lr = self.g_lr
+            d_lr = self.d_lr
         
         # Load the correct training method
         methods = self.load_training_method()
@@ -639,89 +923,306 @@ class Trainer(object):
         for key in methods:
             self.event_logger.log("{} method: {}".format(key, methods[key].__name__))
 
+        # Losses are accumulated on the device and only fetched at log time.
+        loss_meter = LossMeter()
+
+        # Opt-in torch profiler trace of a window of steps.
+        profiler_window = None
+        if self.profile_steps:
+            profiler_window = ProfilerWindow(self.profile_steps[0] - 1, self.profile_steps[1],
+                                             self.profile_dir, self.device, self.timer)
+        window_start = start_iters
+
         # Start training.
         self.event_logger.log('==> Start training...')
         start_time = time.time()
 
         for i in range(start_iters, self.num_iters):
+            if profiler_window is not None and profiler_window.step(i) is not None:
+                self.event_logger.log('Saved the profiler trace into {}...'.format(profiler_window.trace_path))
 
             # =========================== 1. Preprocess input data ============================== #
 
             # Fetch real images and labels.
-            try:
-                x_real, label_org = next(data_iter)
-            except:
-                data_iter = iter(data_loader)
-                x_real, label_org = next(data_iter)
-
-            # Generate target domain labels randomly.
-            rand_idx = torch.randperm(label_org.size(0))
-            label_trg = label_org[rand_idx]
-
-            if self.dataset == 'CelebA':
-                c_org = label_org.clone()
-                c_trg = label_trg.clone()
-            elif self.dataset == 'RaFD':
-                c_org = self.label2onehot(label_org, self.c_dim)
-                c_trg = self.label2onehot(label_trg, self.c_dim)
-
-            x_real = x_real.to(self.device)           # Input images.
-            c_org = c_org.to(self.device)             # Original domain labels.
-            c_trg = c_trg.to(self.device)             # Target domain labels.
-            label_org = label_org.to(self.device)     # Labels for computing classification loss.
-            label_trg = label_trg.to(self.device)     # Labels for computing classification loss.
-
-            # Pack the data for the training methods
-            data = {
-                'x_real': x_real,
-                'c_org': c_org,
-                'c_trg': c_trg,
-                'label_org': label_org,
-                'label_trg': label_trg
-            }
+            with self.timer.scope('data', host=True):
+                try:
+                    x_real, label_org = next(data_iter)
+                except:
+                    epoch, batch_index = epoch + 1, 0
+                    data_iter = epoch_iter(data_loader, epoch)
+                    x_real, label_org = next(data_iter)
+                batch_index += 1
+
+            # Generate target domain labels randomly and pack the data for the training methods.
+            data = self.prepare_batch(x_real, label_org, self.dataset)
 
             # =================================== 2. Training =================================== #
 
-            # For logging the loss.
-            loss = {}
-
             # Train the discriminator
             d_loss = methods['train_D'](data)
-            loss.update(d_loss)
+            loss_meter.update(d_loss)
 
             # Train the generator 
             if (i + 1) % self.n_critic == 0:
                 g_loss = methods['train_G'](data)
-                loss.update(g_loss)
+                loss_meter.update(g_loss)
 
             # =============================== 3. Miscellaneous ================================== #
 
             # Print out training information.
             if (i + 1) % self.log_step == 0:
-                et = time.time() - start_time  ### Pass this et to log_training_info
-                self.log_training_info(et, loss, i)
+                # All ranks resolve their timings so that none accumulates them.
+                phases = self.timer.summarize(i + 1 - window_start)
+                window_start = i + 1
+                if self.is_main_process:
+                    et = time.time() - start_time  ### Pass this et to log_training_info
+                    self.log_training_info(et, loss_meter.summarize(), i, phases)
 
             # Translate fixed images for debugging.
-            if (i + 1) % self.sample_step == 0:
-                self.translate_samples(i, x_fixed, c_fixed_list)
-
-            # Save model checkpoints.
-            if (i + 1) % self.model_save_step == 0 or (i+1) == self.num_iters:
-                self.save_checkpoints(i)
+            if (i + 1) % self.sample_step == 0 and self.is_main_process:
+                with self.timer.scope('sample', host=True):
+                    self.translate_samples(i, x_fixed, c_fixed_list)
 
             # Decay learning rates.
             if (i + 1) % self.lr_update_step == 0 and (i+1) > (self.num_iters - self.num_iters_decay):
                 g_lr, d_lr = self.decay_learning_rates(g_lr, d_lr)
 
+            # Save model checkpoints, after the decay so that a resumed run starts from
+            # the learning rates of the next step.
+            if ((i + 1) % self.model_save_step == 0 or (i+1) == self.num_iters) and self.is_main_process:
+                with self.timer.scope('checkpoint', host=True):
+                    self.save_checkpoints(i, {
+                        'g_lr': g_lr,
+                        'd_lr': d_lr,
+                        'epoch': epoch,
+                        'batch_index': batch_index,
+                        'x_fixed': x_fixed,
+                        'c_fixed_list': c_fixed_list
+                    })
+
+        if profiler_window is not None and profiler_window.close() is not None:
+            self.event_logger.log('Saved the profiler trace into {}...'.format(profiler_window.trace_path))
+        self.checkpoint_saver.wait()
+        self.image_writer.flush()
+
+
+    def dry_run(self, num_steps):
+        """Run a few training steps with memory tracking to check whether the config fits
+        in memory. Samples are translated and checkpoints snapshotted as in training,
+        but nothing is written. The report is logged and saved as progress_dir/dry_run.json.
+
+        Every phase of the training loop runs at least once, after which the memory
+        usage is steady, so the peaks of the dry run are the projected peaks of training.
+        The config fits if the projected peak leaves dry_run_margin_mb of the device free,
+        for the CUDA context and fragmentation. A config running out of memory during the
+        dry run does not fit; the report then records the phase which failed.
+
+        Args:
+            num_steps(int): Number of steps to run, at least n_critic so that G is trained.
+                When training on both datasets, G trains every n_critic steps of each
+                dataset, so at least 2 * n_critic steps plus the lag the loaders are
+                allowed are run
+        Returns:
+            report(dict): Peak memory of the process, of each phase and, on CUDA, the
+                projected peak device memory and whether it fits in the device memory
+        """
+        self.dry_run_mode = True
+        self.track_memory = True
+        self.timer.enabled = self.timer.track_memory = True
+
+        if self.dataset == 'Both':
+            max_lag = self.multi_max_lag if self.world_size == 1 else 0
+            num_steps = max(num_steps, 2 * self.n_critic + max_lag)
+        else:
+            num_steps = max(num_steps, self.n_critic)
+        if self.resume_iters:
+            self.resume_iters = self.checkpoint_manager.resolve_step(self.resume_iters)
+        self.num_iters = (self.resume_iters or 0) + num_steps
+        self.log_step = self.sample_step = self.model_save_step = num_steps
+        self.event_logger.log('==> Dry run of {} steps...'.format(num_steps))
+        error = None
+        try:
+            if self.dataset == 'Both':
+                self.train_multi()
+            else:
+                self.train()
+        except RuntimeError as e:
+            # torch.cuda.OutOfMemoryError is a RuntimeError; older versions raise a plain one.
+            if 'out of memory' not in str(e):
+                raise
+            error = str(e).split('\n')[0]
+        if error is not None and torch.cuda.is_available():
+            # The frames of the exception, which held the tensors, are released by now.
+            torch.cuda.empty_cache()
+
+        usage = memory_usage(self.device)
+        report = {
+            'num_steps': num_steps,
+            'batch_size': self.batch_size,
+            'image_size': self.image_size,
+            'num_projections': self.num_projections,
+            'use_d_feature': self.use_d_feature,
+            'peak_rss_mb': usage['peak_rss_mb'],
+            'phases': self.timer.peaks
+        }
+        info = 'Projected peak memory: RSS {:.0f} MB'.format(report['peak_rss_mb'])
+        if 'cuda_total_mb' in usage:
+            # The allocator may hold more than the peak allocated because of fragmentation.
+            peak_cuda = max([phase.get('peak_cuda_mb', 0) for phase in self.timer.peaks.values()] +
+                            [usage['cuda_reserved_mb']])
+            report['projected_cuda_mb'] = peak_cuda
+            report['cuda_total_mb'] = usage['cuda_total_mb']
+            report['margin_mb'] = self.dry_run_margin_mb
+            report['fits'] = peak_cuda + self.dry_run_margin_mb <= usage['cuda_total_mb']
+            info += ', CUDA {:.0f} + {} margin / {:.0f} MB'.format(
+                peak_cuda, self.dry_run_margin_mb, usage['cuda_total_mb'])
+        if error is not None:
+            report['fits'] = False
+            report['oom_phase'] = self.timer.failed_phase
+            report['error'] = error
+            info += ', out of memory in phase {}'.format(self.timer.failed_phase)
+        if 'fits' in report:
+            info += ' ({})'.format('fits' if report['fits'] else 'does NOT fit')
+        self.event_logger.log(info)
+
+        report_path = os.path.join(self.progress_dir, 'dry_run.json')
+        with open(report_path, 'w') as file:
+            json.dump(report, file, indent=2)
+        self.event_logger.log('Saved the dry run report into {}...'.format(report_path))
+        return report
 
     def train_multi(self):
-        """TODO: Train StarGAN with multiple datasets."""        
-        pass
+        """Train StarGAN with multiple datasets.
+
+        Each iteration trains on a batch of CelebA or RaFD, with the domain labels padded
+        and masked as described in mask_labels(). The two loaders are prefetched
+        concurrently and their batches alternate (see AlternatingLoader). D is trained on
+        every batch, and G on every n_critic-th batch of each dataset.
+        """
+        loaders = collections.OrderedDict([('CelebA', self.celeba_loader), ('RaFD', self.rafd_loader)])
+
+        # Start training from scratch or resume training.
+        start_iters = 0
+        train_state = None
+        if self.resume_iters:
+            self.resume_iters = self.checkpoint_manager.resolve_step(self.resume_iters)
+            start_iters = self.resume_iters
+            train_state = self.restore_training_state(self.resume_iters)
+
+        max_lag = self.multi_max_lag if self.world_size == 1 else 0
+        if train_state is not None:
+            data_loader = AlternatingLoader(loaders, self.multi_prefetch, max_lag, train_state['positions'])
+            data_loader.start()
+
+            # The prefetching threads never draw from the global generators (see
+            # AlternatingLoader), so restoring them is independent of the threads.
+            self.restore_rng_state(train_state['rng'], self.resume_iters)
+            x_fixed, c_fixed_list = train_state['x_fixed'], train_state['c_fixed_list']
+            g_lr, d_lr = train_state['g_lr'], train_state['d_lr']
+            d_steps = train_state['d_steps']
+        else:
+            # Fetch fixed CelebA inputs for debugging, translated into the domains of both datasets.
+            x_fixed, c_org = next(iter(self.celeba_loader))
+            x_fixed = x_fixed.to(self.device)
+            c_fixed_list = self.create_multi_labels(c_org)
+
+            data_loader = AlternatingLoader(loaders, self.multi_prefetch, max_lag)
+            data_loader.start()
+
+            # Learning rate cache for decaying.
+            g_lr = self.g_lr
+            d_lr = self.d_lr
+            d_steps = {name: 0 for name in loaders}
+
+        # Load the correct training method
+        methods = self.load_training_method()
+        self.event_logger.log("==> Loaded training methods")
+        for key in methods:
+            self.event_logger.log("{} method: {}".format(key, methods[key].__name__))
+
+        # Losses are accumulated on the device and only fetched at log time.
+        loss_meter = LossMeter()
+
+        # Opt-in torch profiler trace of a window of steps.
+        profiler_window = None
+        if self.profile_steps:
+            profiler_window = ProfilerWindow(self.profile_steps[0] - 1, self.profile_steps[1],
+                                             self.profile_dir, self.device, self.timer)
+        window_start = start_iters
+
+        # Start training.
+        self.event_logger.log('==> Start training with multiple datasets...')
+        start_time = time.time()
+
+        for i in range(start_iters, self.num_iters):
+            if profiler_window is not None and profiler_window.step(i) is not None:
+                self.event_logger.log('Saved the profiler trace into {}...'.format(profiler_window.trace_path))
+
+            # =========================== 1. Preprocess input data ============================== #
+
+            # Fetch the next batch of either dataset.
+            with self.timer.scope('data', host=True):
+                dataset, (x_real, label_org) = data_loader.next()
+
+            # Generate target domain labels randomly and pack the data for the training methods.
+            data = self.prepare_batch(x_real, label_org, dataset)
+
+            # =================================== 2. Training =================================== #
+
+            # Train the discriminator. The losses are logged per dataset.
+            d_loss = methods['train_D'](data)
+            loss_meter.update({'{}/{}'.format(tag, dataset): value for tag, value in d_loss.items()})
+            d_steps[dataset] += 1
+
+            # Train the generator
+            if d_steps[dataset] % self.n_critic == 0:
+                g_loss = methods['train_G'](data)
+                loss_meter.update({'{}/{}'.format(tag, dataset): value for tag, value in g_loss.items()})
+
+            # =============================== 3. Miscellaneous ================================== #
+
+            # Print out training information.
+            if (i + 1) % self.log_step == 0:
+                # All ranks resolve their timings so that none accumulates them.
+                phases = self.timer.summarize(i + 1 - window_start)
+                window_start = i + 1
+                if self.is_main_process:
+                    et = time.time() - start_time
+                    self.log_training_info(et, loss_meter.summarize(), i, phases)
+
+            # Translate fixed images for debugging.
+            if (i + 1) % self.sample_step == 0 and self.is_main_process:
+                with self.timer.scope('sample', host=True):
+                    self.translate_samples(i, x_fixed, c_fixed_list)
+
+            # Decay learning rates.
+            if (i + 1) % self.lr_update_step == 0 and (i+1) > (self.num_iters - self.num_iters_decay):
+                g_lr, d_lr = self.decay_learning_rates(g_lr, d_lr)
+
+            # Save model checkpoints, after the decay so that a resumed run starts from
+            # the learning rates of the next step.
+            if ((i + 1) % self.model_save_step == 0 or (i+1) == self.num_iters) and self.is_main_process:
+                with self.timer.scope('checkpoint', host=True):
+                    self.save_checkpoints(i, {
+                        'g_lr': g_lr,
+                        'd_lr': d_lr,
+                        'positions': dict(data_loader.positions),
+                        'd_steps': dict(d_steps),
+                        'x_fixed': x_fixed,
+                        'c_fixed_list': c_fixed_list
+                    })
+
+        data_loader.close()
+        if profiler_window is not None and profiler_window.close() is not None:
+            self.event_logger.log('Saved the profiler trace into {}...'.format(profiler_window.trace_path))
+        self.checkpoint_saver.wait()
+        self.image_writer.flush()
 
     def test(self):
         """Translate images using StarGAN trained on a single dataset."""
         # Load the trained generator.
-        self.restore_model(self.test_iters)
+        self.test_iters = self.checkpoint_manager.resolve_step(self.test_iters)
+        self.restore_model(self.test_iters, restore_D=False)
         
         # Set data loader.
         if self.dataset == 'CelebA':
@@ -737,11 +1238,49 @@ class Trainer(object):
         assert self.test_type in list(test_methods.keys()), print(self.test_type)
 
         # Test
-        self.event_logger.log("==> Testing using {} method..."
-                              .format(test_methods[self.test_type].__name__))
-        test_methods[self.test_type](data_loader)
+        G = self.build_test_generator()
+        if self.result_cache_dir:
+            self.build_result_cache()
+        self.event_logger.log("==> Testing using {} method with the {} backend..."
+                              .format(test_methods[self.test_type].__name__, self.test_backend))
+        test_methods[self.test_type](data_loader, G)
+
+        if self.result_cache is not None:
+            self.event_logger.log("Result cache: {}".format(self.result_cache.stats()))
+
+    def build_result_cache(self):
+        """Build the cache of translated images. The entries are keyed by the checkpoint
+        hash and the test config along with the input image and the target label."""
+        from cache import TranslationCache, file_hash
+        self.result_cache = TranslationCache(self.result_cache_dir, self.result_cache_size_mb)
+        G_path = self.checkpoint_manager.G_path(self.test_iters)
+        self.result_cache_prefix = TranslationCache.make_key(
+            file_hash(G_path), self.test_backend, self.dataset, self.celeba_crop_size, self.image_size)
+
+    def translate_images(self, G, x, c_trg_list):
+        """Translate the images into every target domain, through the result cache if enabled."""
+        if self.result_cache is None:
+            return translate(G, x, c_trg_list, self.test_max_batch_size)
+        return cached_translate(G, x, c_trg_list, self.result_cache, self.result_cache_prefix,
+                                self.test_max_batch_size)
+
+    def build_test_generator(self):
+        """Return the generator to test with, run by the backend set in test_backend."""
+        if self.test_backend == 'onnx':
+            from onnx_export import OnnxGenerator, export_generator, get_onnx_path
+            onnx_path = get_onnx_path(self.model_save_dir, self.test_iters)
+            if not os.path.exists(onnx_path):
+                export_generator(self.G, onnx_path, self.g_c_dim, self.image_size)
+                self.event_logger.log('Exported the generator into {}...'.format(onnx_path))
+            return OnnxGenerator(onnx_path)
+        elif self.test_backend == 'fused':
+            from fusion import optimize_for_inference
+            self.event_logger.log('The fused generator normalizes with the running stats (eval mode), '
+                                  'its outputs differ from the default train-mode test.')
+            return optimize_for_inference(self.G)
+        return self.G
     
-    def _general_test(self, data_loader):
+    def _general_test(self, data_loader, G):
         """Test on the entire test dataset"""
 
         with torch.no_grad():
@@ -752,17 +1291,16 @@ class Trainer(object):
                 c_trg_list = self.create_labels(c_org, self.c_dim, self.dataset, self.selected_attrs)
 
                 # Translate images.
-                x_fake_list = [x_real]
-                for c_trg in c_trg_list:
-                    x_fake_list.append(self.G(x_real, c_trg))
+                x_fake_list = [x_real] + self.translate_images(G, x_real, c_trg_list)
 
                 # Save the translated images.
-                x_concat = torch.cat(x_fake_list, dim=3)
                 result_path = os.path.join(self.result_dir, '{}-images.jpg'.format(i+1))
-                save_image(self.denorm(x_concat.data.cpu()), result_path, nrow=1, padding=0)
+                self.save_translations(x_fake_list, result_path)
                 print('Saved real and fake images into {}...'.format(result_path))
+
+        self.image_writer.flush()
     
-    def _small_test(self, data_loader):
+    def _small_test(self, data_loader, G):
         """Test on some specific images of the test dataset. Used to generate plots.
         This method currently supports CelebA dataset only."""
         # self.test_type 
@@ -787,16 +1325,204 @@ class Trainer(object):
                 c_trg_list = self.create_labels(c_org, self.c_dim, self.dataset, self.selected_attrs)
 
                 # Translate images.
-                x_fake_list = [x_real]
-                for c_trg in c_trg_list:
-                    x_fake_list.append(self.G(x_real, c_trg))
+                x_fake_list = [x_real] + self.translate_images(G, x_real, c_trg_list)
 
                 # Save the translated images.
-                x_concat = torch.cat(x_fake_list, dim=3)
                 result_path = os.path.join(self.result_dir, '{}-images.jpg'.format(count))
-                save_image(self.denorm(x_concat.data.cpu()), result_path, nrow=1, padding=0)
+                self.save_translations(x_fake_list, result_path)
                 print('Saved real and fake images into {}...'.format(result_path))
 
+        self.image_writer.flush()
+
+    def evaluate(self):
+        """Compute quantitative metrics of checkpoints on the test set.
+
+        For each checkpoint, the test set is translated into every target domain once and
+        the following metrics are computed on the fly:
+        - swd: SWD between the images translated into each domain and the real test images
+          of that domain, on pixels or patches (see evaluation.ImageDescriptor), averaged
+          over the domains. The sets are usually of different sizes and are compared on
+          their quantiles. A CelebA domain is an attribute value (e.g. 'Male=0'), a RaFD
+          domain a label; domains without real or translated images are left out
+        - domain_accuracy: accuracy of the checkpoint's own D.conv2 classifier on the
+          target domain of the translated images
+        - rec_l1: L1 distance between the real images and their reconstructions
+
+        The projection directions and the sorted projections of the real domains are computed
+        along with the first checkpoint and cached in eval_cache_dir, so each checkpoint
+        only costs the generator passes. The metrics are saved in result_dir/eval.json,
+        checkpoints already evaluated with the same options are skipped, and the SWD is
+        recorded as the score of the checkpoint, which sets the best checkpoint.
+
+        The evaluation can run while training continues: the scores are merged into the
+        checkpoint index shared with the training process, and checkpoints deleted by
+        the training process before being evaluated are skipped.
+        """
+        if self.dataset == 'CelebA':
+            data_loader = self.celeba_loader
+        elif self.dataset == 'RaFD':
+            data_loader = self.rafd_loader
+
+        steps = self.eval_iters
+        if not steps:
+            steps = self.checkpoint_manager.steps()
+        steps = [self.checkpoint_manager.resolve_step(step) for step in steps]
+        assert steps, "No checkpoint found in {}".format(self.model_save_dir)
+
+        descriptor = ImageDescriptor(self.eval_features, self.eval_swd_size, self.eval_patches_per_image,
+                                     self.image_size, self.seed)
+        real_cache = RealSetCache(self.eval_cache_dir, descriptor, self.eval_num_projections, self.seed,
+                                  self.dataset, self.selected_attrs, self.celeba_crop_size,
+                                  self.image_size, self.eval_num_images)
+        real_stats = real_cache.load()
+        real_set_name = os.path.basename(real_cache.path)
+
+        results_path = os.path.join(self.result_dir, 'eval.json')
+        results = load_results(results_path)
+        for step in steps:
+            if results.get(str(step), {}).get('real_set') == real_set_name:
+                self.event_logger.log("Checkpoint {} already evaluated, skipping".format(step))
+                continue
+
+            start_time = time.time()
+            try:
+                self.restore_model(step)
+            except FileNotFoundError:
+                if step in self.checkpoint_manager.steps():
+                    raise
+                self.event_logger.log("Checkpoint {} was deleted, skipping".format(step))
+                continue
+            metrics, real_stats = self.evaluate_checkpoint(data_loader, descriptor, real_cache, real_stats)
+            metrics['real_set'] = real_set_name
+            results[str(step)] = metrics
+            save_results(results, results_path)
+            self.checkpoint_manager.set_score(step, metrics['swd'])
+
+            self.event_logger.log("Checkpoint {}: swd {:.4e}, domain accuracy {:.4f}, rec L1 {:.4f} "
+                                  "on {} images ({:.1f}s)".format(
+                                      step, metrics['swd'], metrics['domain_accuracy'], metrics['rec_l1'],
+                                      metrics['num_images'], time.time() - start_time))
+            if self.use_tensorboard:
+                for key in ['swd', 'domain_accuracy', 'rec_l1']:
+                    self.logger.scalar_summary('eval/' + key, metrics[key], step)
+
+        if self.use_tensorboard:
+            self.logger.flush()
+        self.event_logger.log("Best checkpoint: {}".format(self.checkpoint_manager.best_step()))
+        return results
+
+    def domain_masks(self, labels, i):
+        """Masks of the images of labels (of shape (N, c_dim), one-hot for RaFD) which
+        belong to the evaluation domains of attribute or label i.
+
+        Returns:
+            masks(dict): Key = domain name, val = bool tensor of shape (N,)
+        """
+        if self.dataset == 'CelebA':
+            return {'{}={}'.format(self.selected_attrs[i], v): labels[:, i] == v for v in [0, 1]}
+        elif self.dataset == 'RaFD':
+            return {str(i): labels[:, i] > 0.5}
+
+    def evaluate_checkpoint(self, data_loader, descriptor, real_cache, real_stats=None):
+        """Evaluate the loaded models in a single pass over the test set.
+
+        Args:
+            real_stats(tuple): Projections and sorted real projections of each domain
+                returned by RealSetCache.load(), or None to compute and cache them in this pass
+        Returns:
+            metrics(dict): The metrics described in evaluate()
+            real_stats(tuple): The real set statistics
+        """
+        if real_stats is None:
+            projections = real_cache.new_projections().to(self.device)
+            real_sets = ProjectedSets(descriptor, projections)
+        else:
+            projections = real_stats[0].to(self.device)
+            real_sets = None
+        fake_sets = ProjectedSets(descriptor, projections)
+        correct = np.zeros(self.c_dim)
+        rec_l1 = 0.0
+        num_images = 0
+
+        with torch.no_grad():
+            for x_real, c_org in data_loader:
+                if self.eval_num_images:
+                    if num_images >= self.eval_num_images:
+                        break
+                    x_real = x_real[:self.eval_num_images - num_images]
+                    c_org = c_org[:self.eval_num_images - num_images]
+                num_samples = x_real.size(0)
+
+                x_real = x_real.to(self.device)
+                c_trg_list = self.create_labels(c_org, self.c_dim, self.dataset, self.selected_attrs)
+                if self.dataset == 'RaFD':
+                    c_org = self.label2onehot(c_org, self.c_dim)
+                c_org = c_org.to(self.device)
+                if real_sets is not None:
+                    for i in range(self.c_dim):
+                        real_sets.add(x_real, self.domain_masks(c_org, i))
+
+                # Translate into all the domains, then back to the original one.
+                x_fake_list = translate(self.G, x_real, c_trg_list, self.test_max_batch_size)
+                x_fake = torch.cat(x_fake_list, dim=0)
+                x_rec = generate(self.G, x_fake, c_org.repeat(self.c_dim, 1), self.test_max_batch_size)
+                rec_l1 += torch.abs(x_rec - x_real.repeat(self.c_dim, 1, 1, 1)).mean(dim=(1, 2, 3)).sum().item()
+
+                out_cls = classify(self.D, x_fake, self.test_max_batch_size).view(self.c_dim, num_samples, -1)
+                for i, c_trg in enumerate(c_trg_list):
+                    fake_sets.add(x_fake_list[i], self.domain_masks(c_trg, i))
+                    if self.dataset == 'CelebA':
+                        correct[i] += ((out_cls[i, :, i] > 0) == (c_trg[:, i] > 0.5)).sum().item()
+                    elif self.dataset == 'RaFD':
+                        correct[i] += (out_cls[i].argmax(dim=1) == i).sum().item()
+                num_images += num_samples
+
+        if real_sets is not None:
+            real_stats = (projections.cpu(), real_sets.sorted())
+            real_cache.save(*real_stats)
+        sorted_real = real_stats[1]
+
+        sorted_fake = fake_sets.sorted()
+        swd_per_domain = {name: sliced_wasserstein_sorted(sorted_real[name], sorted_fake[name])
+                          for name in sorted_fake if name in sorted_real}
+        accuracy_per_domain = (correct / max(num_images, 1)).tolist()
+        metrics = {
+            'swd': float(np.mean(list(swd_per_domain.values()))),
+            'swd_per_domain': swd_per_domain,
+            'domain_accuracy': float(np.mean(accuracy_per_domain)),
+            'domain_accuracy_per_domain': accuracy_per_domain,
+            'rec_l1': rec_l1 / max(num_images * self.c_dim, 1),
+            'num_images': num_images
+        }
+        return metrics, real_stats
+
     def test_multi(self):
-        """TODO: Translate images using StarGAN trained on multiple datasets."""
-        pass
\ No newline at end of file
+        """Translate images using StarGAN trained on multiple datasets. The CelebA test
+        images are translated into the domains of both datasets."""
+        # Load the trained generator.
+        self.test_iters = self.checkpoint_manager.resolve_step(self.test_iters)
+        self.restore_model(self.test_iters, restore_D=False)
+
+        G = self.build_test_generator()
+        if self.result_cache_dir:
+            self.build_result_cache()
+        self.event_logger.log("==> Testing with multiple datasets with the {} backend...".format(self.test_backend))
+
+        with torch.no_grad():
+            for i, (x_real, c_org) in enumerate(self.celeba_loader):
+
+                # Prepare input images and target domain labels.
+                x_real = x_real.to(self.device)
+                c_trg_list = self.create_multi_labels(c_org)
+
+                # Translate images.
+                x_fake_list = [x_real] + self.translate_images(G, x_real, c_trg_list)
+
+                # Save the translated images.
+                result_path = os.path.join(self.result_dir, '{}-images.jpg'.format(i+1))
+                self.save_translations(x_fake_list, result_path)
+                print('Saved real and fake images into {}...'.format(result_path))
+
+        self.image_writer.flush()
+        if self.result_cache is not None:
+            self.event_logger.log("Result cache: {}".format(self.result_cache.stats()))
\ No newline at end of file
@@ -0,0 +1,170 @@
+"""Translate every image of a folder into a list of target attributes.
+
+The images are split into chunks that are translated by a pool of worker
+processes, each holding its own generator and using threads_per_worker threads.
+Each result is written as soon as its chunk is done. Interrupted runs can be
+resumed: the images whose results all exist are skipped.
+
+The result of an image is named after the image file name and a hash of the target,
+e.g. 'photo.jpg-3fa2c1d07b9e.jpg', so results are only reused for the same image,
+target and model options, whatever the order of --targets. targets.json maps the
+hashes to their targets.
+
+A target is a comma-separated list of selected attributes to set, e.g.
+'Black_Hair,Young' or 'Black_Hair=1,Male=0'; the attributes not listed are 0.
+
+Usage:
+    python translate_folder.py --input_dir photos --output_dir translated \
+        --model_save_dir stargan_celeba_1/models --test_iters 100000 \
+        --selected_attrs Blond_Hair Male Young --targets Blond_Hair Male,Young \
+        --num_workers 8 --threads_per_worker 4
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def parse_target(spec, selected_attrs):
+    """Convert a target spec such as 'Black_Hair=1,Male=0' into a label vector."""
+    label = [0.0] * len(selected_attrs)
+    for item in spec.split(','):
+        name, _, value = item.partition('=')
+        assert name in selected_attrs, "{} is not one of the selected attributes {}".format(name, selected_attrs)
+        label[selected_attrs.index(name)] = float(value) if value else 1.0
+    return label
+
+
+def target_key(label, args):
+    """Hash of a target label and of the options the translation depends on."""
+    key = json.dumps([args.selected_attrs, label, os.path.abspath(args.model_save_dir), args.test_iters,
+                      args.crop_size, args.image_size])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:12]
+
+
+def output_paths(output_dir, filename, target_keys, ext):
+    """Paths of the results of an image, one per target."""
+    return [os.path.join(output_dir, '{}-{}{}'.format(filename, key, ext)) for key in target_keys]
+
+
+# State of a worker process.
+_worker = {}
+
+
+def _init_worker(args, labels, target_keys):
+    import torch
+    from data_loader import build_transform
+    from inference import instance_stats_copy, load_generator
+
+    torch.set_num_threads(args.threads_per_worker)
+    G = load_generator(args.model_save_dir, args.test_iters, args.g_conv_dim,
+                       len(args.selected_attrs), args.g_repeat_num)
+    # Same outputs as the train-mode G of Trainer.test(), without updating the running stats.
+    _worker['G'] = instance_stats_copy(G, inplace=True)
+    _worker['transform'] = build_transform(args.crop_size, args.image_size)
+    _worker['labels'] = torch.tensor(labels)
+    _worker['target_keys'] = target_keys
+    _worker['args'] = args
+
+
+def _translate_chunk(filenames):
+    """Translate a chunk of images and write the results. Returns the number of images."""
+    import torch
+    from PIL import Image
+    from torchvision.utils import save_image
+    from inference import translate
+
+    G, transform, labels, args = _worker['G'], _worker['transform'], _worker['labels'], _worker['args']
+
+    # Images of different sizes (if not center cropped) cannot share a batch.
+    groups = {}
+    for filename in filenames:
+        image = Image.open(os.path.join(args.input_dir, filename)).convert('RGB')
+        x = transform(image)
+        groups.setdefault(tuple(x.shape), []).append((filename, x))
+
+    with torch.no_grad():
+        for items in groups.values():
+            x = torch.stack([x for _, x in items])
+            c_trg_list = [label.expand(x.size(0), -1) for label in labels]
+            x_fake_list = translate(G, x, c_trg_list, args.max_batch_size)
+
+            for j, (filename, _) in enumerate(items):
+                paths = output_paths(args.output_dir, filename, _worker['target_keys'], args.ext)
+                for x_fake, path in zip(x_fake_list, paths):
+                    # Write then rename, so an interrupted run never leaves a partial result.
+                    tmp_path = path + '.tmp' + args.ext
+                    save_image(((x_fake[j] + 1) / 2).clamp_(0, 1), tmp_path, nrow=1, padding=0)
+                    os.replace(tmp_path, path)
+    return len(filenames)
+
+
+def main(args):
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    labels = [parse_target(spec, args.selected_attrs) for spec in args.targets]
+    target_keys = [target_key(label, args) for label in labels]
+
+    # Keep the targets of previous runs, whose results may still be in the folder.
+    targets_path = os.path.join(args.output_dir, 'targets.json')
+    targets = {}
+    if os.path.exists(targets_path):
+        with open(targets_path) as file:
+            targets = json.load(file)
+    for key, spec, label in zip(target_keys, args.targets, labels):
+        targets[key] = {'spec': spec, 'label': label, 'test_iters': args.test_iters}
+    with open(targets_path, 'w') as file:
+        json.dump(targets, file, indent=2, sort_keys=True)
+
+    # Skip the images translated by a previous run.
+    filenames = sorted(f for f in os.listdir(args.input_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+    todo = [f for f in filenames
+            if not all(os.path.exists(p) for p in output_paths(args.output_dir, f, target_keys, args.ext))]
+    print("==> {} images, {} already translated".format(len(filenames), len(filenames) - len(todo)))
+    if not todo:
+        return
+
+    chunks = [todo[i:i + args.batch_size] for i in range(0, len(todo), args.batch_size)]
+    ctx = multiprocessing.get_context('spawn')
+    start_time = time.time()
+    num_done = 0
+    with ctx.Pool(args.num_workers, initializer=_init_worker, initargs=(args, labels, target_keys)) as pool:
+        for num_images in pool.imap_unordered(_translate_chunk, chunks):
+            num_done += num_images
+            elapsed = time.time() - start_time
+            print("Translated [{}/{}] images, {:.1f} images/s".format(num_done, len(todo), num_done / elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Folder translation')
+
+    # Model configuration.
+    parser.add_argument('--g_conv_dim', type=int, default=64)
+    parser.add_argument('--g_repeat_num', type=int, default=6)
+    parser.add_argument('--crop_size', type=int, default=178, help='center crop, 0 to keep the whole image')
+    parser.add_argument('--image_size', type=int, default=128)
+    parser.add_argument('--selected_attrs', nargs='+',
+                        default=['Black_Hair', 'Blond_Hair', 'Brown_Hair', 'Male', 'Young'])
+    parser.add_argument('--model_save_dir', type=str, default='stargan/models')
+    parser.add_argument('--test_iters', type=int, default=100000, help='load the model from this step')
+
+    # Translation configuration.
+    parser.add_argument('--input_dir', type=str, required=True)
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--targets', nargs='+', required=True, help="target specs, e.g. 'Black_Hair=1,Male=0'")
+    parser.add_argument('--ext', type=str, default='.jpg', help='format of the results')
+    parser.add_argument('--batch_size', type=int, default=16, help='images per chunk of work')
+    parser.add_argument('--max_batch_size', type=int, default=64, help='max images per generator forward')
+    parser.add_argument('--num_workers', type=int, default=max(1, os.cpu_count() // 4),
+                        help='number of worker processes')
+    parser.add_argument('--threads_per_worker', type=int, default=4, help='torch threads per worker process')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
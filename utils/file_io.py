@@ -1,30 +1,227 @@
-import tensorflow as tf
 import glob
-from collections import defaultdict
+import json
 import os
+import struct
 
-def load_single_loss_file(logdir):
-    """Load loss data from a single TF event file.
+import numpy as np
+
+CACHE_NAME = '.loss_cache.npz'
+CACHE_VERSION = 1
+
+
+def _read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _iter_fields(data):
+    """Yield (field number, wire type, value) of an encoded protobuf message.
+    Length-delimited values are returned as bytes, fixed-size ones as raw bytes."""
+    pos, end = 0, len(data)
+    while pos < end:
+        key, pos = _read_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == 1:
+            value, pos = data[pos:pos + 8], pos + 8
+        elif wire_type == 2:
+            length, pos = _read_varint(data, pos)
+            value, pos = data[pos:pos + length], pos + length
+        elif wire_type == 5:
+            value, pos = data[pos:pos + 4], pos + 4
+        else:
+            raise ValueError('Unsupported protobuf wire type {}'.format(wire_type))
+        yield field, wire_type, value
+
+
+def parse_scalars(event):
+    """Return the (step, tag, simple_value) scalars of an encoded tensorflow.Event."""
+    step, summary = 0, None
+    for field, _, value in _iter_fields(event):
+        if field == 2:
+            step = value
+        elif field == 5:
+            summary = value
+    if summary is None:
+        return []
+
+    scalars = []
+    for field, _, summary_value in _iter_fields(summary):
+        if field != 1:
+            continue
+        tag, simple_value = None, None
+        for value_field, wire_type, value in _iter_fields(summary_value):
+            if value_field == 1:
+                tag = value.decode('utf-8')
+            elif value_field == 2 and wire_type == 5:
+                simple_value = struct.unpack('<f', value)[0]
+        if tag is not None and simple_value is not None:
+            scalars.append((step, tag, simple_value))
+    return scalars
+
+
+def read_scalars(event_path, offset=0):
+    """Read the scalars of a TFRecord event file from a byte offset.
+
+    A record still being written at the end of the file is left for the next read.
+    The CRCs are not checked, which would dominate the read time in pure Python.
+
+    Returns:
+        scalars(list<tuple>): (step, tag, value) of each scalar summary
+        offset(int): Offset of the first record not read
+    """
+    with open(event_path, 'rb') as file:
+        file.seek(offset)
+        data = file.read()
+
+    scalars = []
+    pos = 0
+    while pos + 12 <= len(data):
+        length = struct.unpack_from('<Q', data, pos)[0]
+        end = pos + 12 + length + 4
+        if end > len(data):
+            break
+        scalars.extend(parse_scalars(data[pos + 12:pos + 12 + length]))
+        pos = end
+    return scalars, offset + pos
+
+
+def _merge(history, scalars):
+    """Merge (step, tag, value) scalars into tag => (steps, values) arrays. Values of
+    the new scalars replace the existing ones at the same step."""
+    new = {}
+    for step, tag, value in scalars:
+        new.setdefault(tag, {})[step] = value
+
+    for tag, points in new.items():
+        steps = np.fromiter(points.keys(), dtype=np.int64, count=len(points))
+        values = np.fromiter(points.values(), dtype=np.float32, count=len(points))
+        if tag in history:
+            old_steps, old_values = history[tag]
+            keep = ~np.isin(old_steps, steps)
+            steps = np.concatenate([old_steps[keep], steps])
+            values = np.concatenate([old_values[keep], values])
+        order = np.argsort(steps, kind='stable')
+        history[tag] = (steps[order], values[order])
+    return history
+
+
+def _load_cache(cache_path):
+    try:
+        with np.load(cache_path, allow_pickle=False) as cache:
+            meta = json.loads(str(cache['meta']))
+            if meta['version'] != CACHE_VERSION:
+                return None, None
+            history = {tag: (cache['steps_{}'.format(i)], cache['values_{}'.format(i)])
+                       for i, tag in enumerate(meta['tags'])}
+        return meta, history
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _save_cache(cache_path, files, history):
+    tags = sorted(history.keys())
+    arrays = {'meta': np.array(json.dumps({'version': CACHE_VERSION, 'files': files, 'tags': tags}))}
+    for i, tag in enumerate(tags):
+        arrays['steps_{}'.format(i)], arrays['values_{}'.format(i)] = history[tag]
+
+    # Write then rename, so a concurrent reader never sees a partial cache.
+    tmp_path = cache_path + '.tmp.npz'
+    try:
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # E.g. read-only log dir; the history is simply not cached.
+        pass
+
+
+def _is_extension(cached, files):
+    """Whether files only differ from the cached ones by records appended to the last
+    cached file and by new files."""
+    if len(files) < len(cached) or [f['name'] for f in files[:len(cached)]] != [f['name'] for f in cached]:
+        return False
+    for i, (f, old) in enumerate(zip(files, cached)):
+        if i == len(cached) - 1:
+            return f['size'] >= old['offset']
+        if f['size'] != old['size'] or f['mtime'] != old['mtime']:
+            return False
+    return True
+
+
+def load_loss_history(logdir, use_cache=True):
+    """Load the scalar history of all the event files of a log dir, merged by step.
+
+    The files are read in name (i.e. creation time) order, so the values of a resumed
+    run replace those logged at the same steps before. The history is cached as
+    columnar arrays in logdir/.loss_cache.npz along with the size and mtime of each
+    file: unchanged files are not read again, and only the new records of the latest
+    file are read while a run is in progress.
 
     Args:
-        logdir(str): Path of the dir storing the event file, 
+        logdir(str): Path of the dir storing the event files,
             e.g., 'stargan_celeba_sw_d_5/logs'
+        use_cache(bool): Read and update the cache
     Returns:
-        loss(dict): Dict, key = loss tag, val = list of losses
+        history(dict): Key = tag, val = (steps, values) numpy arrays sorted by step,
+            or None if there is no event file
     """
-    paths = glob.glob(logdir + '/events.*')
+    paths = sorted(glob.glob(os.path.join(logdir, 'events.*')))
     if not paths:
         return None
-    
-    event_path = paths[1] if len(paths) > 1 else paths[0]
-    loss = defaultdict(list)
-    
-    for e in tf.train.summary_iterator(event_path):
-        for v in e.summary.value:
-            if 'loss' in v.tag:
-                loss[v.tag].append(v.simple_value)
-    
-    return loss
+
+    files = []
+    for path in paths:
+        stat = os.stat(path)
+        files.append({'name': os.path.basename(path), 'size': stat.st_size,
+                      'mtime': stat.st_mtime, 'offset': 0})
+
+    cache_path = os.path.join(logdir, CACHE_NAME)
+    meta, history = _load_cache(cache_path) if use_cache else (None, None)
+
+    # Reuse the cache if only the latest cached file got new records and new files
+    # were added after it; event files are only appended to.
+    start = 0
+    if meta is not None and _is_extension(meta['files'], files):
+        for f, cached in zip(files, meta['files']):
+            f['offset'] = cached['offset']
+        start = max(len(meta['files']) - 1, 0)
+    else:
+        history = {}
+
+    changed = meta is None
+    for f in files[start:]:
+        if f['offset'] == f['size']:
+            continue
+        scalars, f['offset'] = read_scalars(os.path.join(logdir, f['name']), f['offset'])
+        _merge(history, scalars)
+        changed = True
+
+    if use_cache and changed:
+        _save_cache(cache_path, files, history)
+    return history
+
+
+def load_single_loss_file(logdir):
+    """Load loss data from the TF event files of a log dir.
+
+    Args:
+        logdir(str): Path of the dir storing the event files,
+            e.g., 'stargan_celeba_sw_d_5/logs'
+    Returns:
+        loss(dict): Dict, key = loss tag, val = (steps, losses) arrays sorted by step
+    """
+    history = load_loss_history(logdir)
+    if not history:
+        return None
+
+    return {tag: curve for tag, curve in history.items() if 'loss' in tag}
 
 def load_loss_files(root, exp_name, exp_ids):
     """Load all loss files for the same type of experiments.
@@ -42,15 +239,15 @@ def load_loss_files(root, exp_name, exp_ids):
         loss(list<dict>): Each entry is the loss dict of an exp
     """
     loss = []
-    
+
     for exp_id in exp_ids:
         # Get folder in form 'expName_expID/logs', eg, 'stargan_celeba_1/logs'
         exp_dir_name = '{}_{}'.format(exp_name, exp_id)
         exp_path = os.path.join(root, exp_dir_name, 'logs')
-        
+
         # Get loss for each experiment
         single_loss = load_single_loss_file(exp_path)
         if single_loss:
             loss.append(single_loss)
-    
+
     return loss
@@ -4,68 +4,176 @@ Created on April 20, 2019
 @author: Ziyu
 """
 import matplotlib
-matplotlib.use("TkAgg")         # prevent matplotlib from crashing on MacOS
+matplotlib.use("Agg")           # the plots are only saved; also prevents crashes on MacOS
 import matplotlib.pyplot as plt
 import matplotlib.font_manager as font_manager
 
 import numpy as np
 import argparse
+import multiprocessing
 import os
 
 from file_io import load_loss_files
 
-def plot_all_loss(log_step, all_loss, plot_dir, labels):
+def smooth(y, method, param):
+    """Smooth a loss curve.
+
+    Args:
+        y(np.array): Loss values
+        method(str): 'ema' for a debiased exponential moving average with weight param
+            (as in TensorBoard), 'window' for a trailing moving average over param points,
+            'none' to keep the values
+        param(float): Weight in [0, 1) or window size
+    """
+    if method == 'ema':
+        out = np.empty(len(y))
+        last = 0.0
+        for i, value in enumerate(y):
+            last = last * param + (1 - param) * value
+            out[i] = last / (1 - param ** (i + 1))
+        return out
+    elif method == 'window':
+        window = max(1, int(param))
+        cumsum = np.concatenate([[0.0], np.cumsum(y, dtype=np.float64)])
+        end = np.arange(1, len(y) + 1)
+        start = np.maximum(0, end - window)
+        return (cumsum[end] - cumsum[start]) / (end - start)
+    return y
+
+def lttb(x, y, num_points):
+    """Largest-Triangle-Three-Buckets downsampling to num_points points, which keeps the
+    visual shape of the curve."""
+    n = len(y)
+    if num_points >= n or num_points < 3:
+        return x, y
+
+    bucket_size = (n - 2) / (num_points - 2)
+    indices = np.empty(num_points, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(num_points - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+
+        # Keep the point of the bucket forming the largest triangle with the previously
+        # kept point and the average of the next bucket.
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return x[indices], y[indices]
+
+def minmax_decimate(x, y, num_points):
+    """Keep the min and max of num_points / 2 buckets, which keeps the envelope of the curve."""
+    n = len(y)
+    num_buckets = num_points // 2
+    if num_points >= n or num_buckets < 1:
+        return x, y
+
+    edges = np.linspace(0, n, num_buckets + 1).astype(np.int64)
+    indices = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        segment = y[start:end]
+        indices.extend(sorted({start + int(np.argmin(segment)), start + int(np.argmax(segment))}))
+    indices = np.array(indices)
+    return x[indices], y[indices]
+
+DOWNSAMPLERS = {
+    'lttb': lttb,
+    'minmax': minmax_decimate
+}
+
+# Plot every logged point without smoothing.
+DEFAULT_OPTIONS = {
+    'smoothing': 'none',
+    'smoothing_param': 0.6,
+    'downsample': 'none',
+    'max_points': 2000
+}
+
+def prepare_curve(steps, values, options):
+    """Smooth then downsample a loss curve. Returns the (x, y) points to plot, at the
+    recorded steps."""
+    y = smooth(np.asarray(values, dtype=np.float64), options['smoothing'], options['smoothing_param'])
+    x = np.asarray(steps, dtype=np.float64)
+    if options['downsample'] in DOWNSAMPLERS and options['max_points'] > 0:
+        x, y = DOWNSAMPLERS[options['downsample']](x, y, options['max_points'])
+    return x, y
+
+def plot_loss(loss_tag, curves, plot_dir, labels, options):
+    """Plot a loss tag for all the experiments and save it as plot_dir/loss_tag.png.
+
+    Args:
+        loss_tag(str): Loss tag, e.g. 'D/loss_real'
+        curves(list<tuple>): (steps, values) arrays of each experiment
+    Returns:
+        save_path(str): Path of the figure
+    """
+    # Font of the plots: 'serif', 'sans-serif'
+    font = {'fontname': 'serif'}
+
+    # Create a new figure
+    plt.figure()
+
+    # Plot loss for each exp
+    total_num_iters = 0
+    for i, (steps, values) in enumerate(curves):
+        x, y = prepare_curve(steps, values, options)
+        plt.plot(x, y, label=labels[i],
+                 alpha=0.6, linewidth=0.6, clip_on=False)
+
+        total_num_iters = max(total_num_iters, int(steps[-1]))
+
+    # Set x axis, limit to 5 ticks only
+    inteval = max(total_num_iters // 5, 1)
+    x_ticks = list(range(0, total_num_iters + 1, inteval))
+
+    # Change labels of x_ticks to ['0', '20k', '40k', ...]
+    x_tick_labels = [str(num // 1000) + 'k' for num in x_ticks]
+    x_tick_labels[0] = '0'
+
+    # Configure the plot info cmunrm
+    plt.xticks(x_ticks, labels=x_tick_labels, **font)
+    plt.xlabel('Iterations', **font)
+    plt.yticks(**font)
+    plt.ylabel('Training loss [{}]'.format(loss_tag), **font)
+
+    font_prop = font_manager.FontProperties(family=font['fontname'])
+    plt.legend(loc='upper right', prop=font_prop)
+
+    # Convert loss_tag 'D/loss_real' => 'D_loss_real' and save
+    save_path = '{}/{}.png'.format(plot_dir, '_'.join(loss_tag.split('/')))
+    plt.savefig(save_path, format='png', dpi=200)
+
+    # Clear the current figure
+    plt.close()
+    return save_path
+
+def _plot_loss_job(job):
+    return plot_loss(*job)
+
+def plot_all_loss(all_loss, plot_dir, labels, options=DEFAULT_OPTIONS, num_workers=1):
     """Plot all items for the loss of specified experiments.
     Note that only loss of the same type of experiments can be put together.
-    Plots will be saved as plot_dir/loss_tag.png
+    Plots will be saved as plot_dir/loss_tag.png. With num_workers > 1, the loss
+    tags are plotted in parallel by a pool of processes.
     """
 
     # Get all loss tags
     loss_tags = list(all_loss[0].keys())
-
-    # Font of the plots: 'serif', 'sans-serif'
-    font = {'fontname': 'serif'}
-
-    # Create a plot for each loss tag
-    for loss_tag in loss_tags:
-        print("Plotting {}...".format(loss_tag))
-
-        # Create a new figure
-        plt.figure()
-
-        # Plot loss for each exp
-        for i, loss_dict in enumerate(all_loss):
-            x = list( range(0, len(loss_dict[loss_tag]) * log_step, log_step) )
-            plt.plot(x, loss_dict[loss_tag], label=labels[i], 
-                     alpha=0.6, linewidth=0.6, clip_on=False)
-        
-            num_iters = len(loss_dict[loss_tag])
-        
-        # Set x axis, limit to 5 ticks only
-        total_num_iters = num_iters * log_step
-        inteval = total_num_iters // 5
-        x_ticks = list(range(0, total_num_iters + log_step, inteval))
-
-        # Change labels of x_ticks to ['0', '20k', '40k', ...]
-        x_tick_labels = [str(num // 1000) + 'k' for num in x_ticks]
-        x_tick_labels[0] = '0'
-        
-        # Configure the plot info cmunrm
-        plt.xticks(x_ticks, labels=x_tick_labels, **font)
-        plt.xlabel('Iterations', **font)
-        plt.yticks(**font)
-        plt.ylabel('Training loss [{}]'.format(loss_tag), **font)
-
-        font_prop = font_manager.FontProperties(family=font['fontname'])
-        plt.legend(loc='upper right', prop=font_prop)
-
-        # Convert loss_tag 'D/loss_real' => 'D_loss_real' and save
-        save_path = '{}/{}.png'.format(plot_dir, '_'.join(loss_tag.split('/')))
-        plt.savefig(save_path, format='png', dpi=200)
-        print('Figure saved as', save_path)
-
-        # Clear the current figure
-        plt.close()
+    jobs = [(loss_tag, [loss_dict[loss_tag] for loss_dict in all_loss], plot_dir, labels, options)
+            for loss_tag in loss_tags]
+
+    if num_workers > 1:
+        with multiprocessing.Pool(min(num_workers, len(jobs))) as pool:
+            save_paths = pool.imap(_plot_loss_job, jobs)
+            for save_path in save_paths:
+                print('Figure saved as', save_path)
+    else:
+        for job in jobs:
+            print("Plotting {}...".format(job[0]))
+            print('Figure saved as', _plot_loss_job(job))
 
 def main(args):
     # Get the experiments to be loaded
@@ -94,7 +202,13 @@ def main(args):
         os.makedirs(plot_dir)
     
     print("==> Generating plots...")
-    plot_all_loss(args.log_step, all_loss, plot_dir, labels)
+    options = {
+        'smoothing': args.smoothing,
+        'smoothing_param': args.smoothing_param,
+        'downsample': args.downsample,
+        'max_points': args.max_points
+    }
+    plot_all_loss(all_loss, plot_dir, labels, options, args.num_workers)
     
 
 if __name__ == '__main__':
@@ -109,10 +223,17 @@ if __name__ == '__main__':
                         help='list of the IDs of the experiments to be loaded')
     
     # Plot settings
-    parser.add_argument('--log_step', type=int, default=10)
     parser.add_argument('--label_attr', type=str, help='attribute name of the plot labels')
     parser.add_argument('--label_vals', nargs='+', help='values of the plot labels')
     parser.add_argument('--plot_root', type=str, default='./plots', help='root dir to save the plots')
+    parser.add_argument('--smoothing', type=str, default='none', choices=['none', 'ema', 'window'])
+    parser.add_argument('--smoothing_param', type=float, default=0.6,
+                        help='ema weight in [0, 1) or window size in points')
+    parser.add_argument('--downsample', type=str, default='none', choices=['none', 'lttb', 'minmax'],
+                        help='shape-preserving downsampling of each curve')
+    parser.add_argument('--max_points', type=int, default=2000, help='points per curve after downsampling')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(),
+                        help='processes plotting the loss tags in parallel')
 
     args = parser.parse_args()
     print(args)